@@ -26,6 +26,7 @@ typedef struct _sch_xml_to_gnode_parms_s
     int in_flags;
     char *in_def_op;
     bool in_is_edit;
+    xmlTextReaderPtr in_reader;
     GNode *out_tree;
     nc_error_parms out_error;
     GList *out_deletes;
@@ -133,43 +134,329 @@ sch_node_find_name (sch_instance *instance, xmlNs *ns, sch_node *parent, const c
     return found;
 }
 
+/* The conditions of each schema node, read from the schema once */
+struct sch_conditions
+{
+    char *when;
+    char *must;
+    char *if_feature;
+};
+
+static GHashTable *condition_cache = NULL;
+static GMutex condition_lock;
+static struct
+{
+    uint32_t evaluated;
+    uint32_t cached;
+    uint64_t time_us;
+} condition_stats;
+
+static void
+sch_conditions_free (struct sch_conditions *conditions)
+{
+    g_free (conditions->when);
+    g_free (conditions->must);
+    g_free (conditions->if_feature);
+    g_free (conditions);
+}
+
+static struct sch_conditions *
+sch_conditions_get (sch_node *node)
+{
+    struct sch_conditions *conditions;
+
+    g_mutex_lock (&condition_lock);
+    if (!condition_cache)
+        condition_cache = g_hash_table_new_full (g_direct_hash, g_direct_equal, NULL,
+                                                 (GDestroyNotify) sch_conditions_free);
+    conditions = g_hash_table_lookup (condition_cache, node);
+    if (!conditions)
+    {
+        xmlChar *when_clause = xmlGetProp ((xmlNode *) node, BAD_CAST "when");
+        xmlChar *must_clause = xmlGetProp ((xmlNode *) node, BAD_CAST "must");
+        xmlChar *if_feature = xmlGetProp ((xmlNode *) node, BAD_CAST "if-feature");
+
+        conditions = g_malloc0 (sizeof (struct sch_conditions));
+        if (when_clause)
+        {
+            conditions->when = g_strdup ((char *) when_clause);
+            xmlFree (when_clause);
+        }
+        if (must_clause)
+        {
+            conditions->must = g_strdup ((char *) must_clause);
+            xmlFree (must_clause);
+        }
+        if (if_feature)
+        {
+            conditions->if_feature = g_strdup_printf ("if-feature(%s)", (char *) if_feature);
+            xmlFree (if_feature);
+        }
+        g_hash_table_insert (condition_cache, node, conditions);
+    }
+    g_mutex_unlock (&condition_lock);
+
+    /* Entries live until the schema is freed */
+    return conditions;
+}
+
 static void
 sch_check_condition_parms (_sch_xml_to_gnode_parms *_parms, sch_node *node, char *new_xpath)
 {
-    xmlChar *when_clause = xmlGetProp ((xmlNode *) node, BAD_CAST "when");
-    xmlChar *must_clause = xmlGetProp ((xmlNode *) node, BAD_CAST "must");
-    xmlChar *if_feature = xmlGetProp ((xmlNode *) node, BAD_CAST "if-feature");
+    struct sch_conditions *conditions = sch_conditions_get (node);
 
-    if (when_clause)
+    if (conditions->when)
     {
         _parms->conditions = g_list_append (_parms->conditions, g_strdup (new_xpath));
-        _parms->conditions = g_list_append (_parms->conditions, g_strdup ((char *) when_clause));
-        DEBUG ("when_clause <%s - %s>\n", new_xpath, when_clause);
-        xmlFree (when_clause);
+        _parms->conditions = g_list_append (_parms->conditions, g_strdup (conditions->when));
+        DEBUG ("when_clause <%s - %s>\n", new_xpath, conditions->when);
     }
 
-    if (must_clause)
+    if (conditions->must)
     {
         _parms->conditions = g_list_append (_parms->conditions, g_strdup (new_xpath));
-        _parms->conditions = g_list_append (_parms->conditions, g_strdup ((char *) must_clause));
-        DEBUG ("must_clause <%s - %s>\n", new_xpath, must_clause);
-        xmlFree (must_clause);
+        _parms->conditions = g_list_append (_parms->conditions, g_strdup (conditions->must));
+        DEBUG ("must_clause <%s - %s>\n", new_xpath, conditions->must);
     }
 
-    if (if_feature)
+    if (conditions->if_feature)
     {
         _parms->conditions = g_list_append (_parms->conditions, g_strdup (new_xpath));
-        _parms->conditions = g_list_append (_parms->conditions,
-                                                 g_strdup_printf ("if-feature(%s)", (char *) if_feature));
-        DEBUG("if_feature <%s - %s>\n", new_xpath, if_feature);
-        xmlFree (if_feature);
+        _parms->conditions = g_list_append (_parms->conditions, g_strdup (conditions->if_feature));
+        DEBUG("if_feature <%s - %s>\n", new_xpath, conditions->if_feature);
+    }
+}
+
+/* What is known about a condition expression from parsing it once */
+struct sch_condition
+{
+    /* The result does not depend on the node the condition is on */
+    bool fixed;
+};
+
+static GHashTable *compiled_conditions = NULL;
+
+static bool
+xpath_name_char (char c)
+{
+    return g_ascii_isalnum (c) || c == '_' || c == '-' || c == '.' || c == ':';
+}
+
+/* Whether an expression only reads absolute paths. Anything that may be
+ * relative to the context node - a location path not starting at the root,
+ * ".", "..", current() or a variable - makes it depend on that node.
+ * Predicates are relative to their own step so are not checked. */
+static bool
+xpath_is_fixed (const char *expr)
+{
+    const char *c = expr;
+    int depth = 0;
+    char prev = '\0';
+
+    while (*c)
+    {
+        if (*c == '\'' || *c == '"')
+        {
+            const char *end = strchr (c + 1, *c);
+
+            if (!end)
+                return false;
+            c = end + 1;
+            prev = '"';
+            continue;
+        }
+        if (*c == '[')
+            depth++;
+        else if (*c == ']')
+            depth--;
+        else if (*c == '$')
+            return false;
+        else if (depth == 0 && (*c == '*' || *c == '@') && prev != '/')
+            return false;
+        else if (g_ascii_isalpha (*c) || *c == '_' || *c == '.')
+        {
+            const char *start = c;
+            gchar *name;
+            bool path;
+
+            while (xpath_name_char (*c) && !(c[0] == ':' && c[1] == ':'))
+                c++;
+            name = g_strndup (start, c - start);
+            while (g_ascii_isspace (*c))
+                c++;
+            if (*c == '(')
+            {
+                /* A function call. Features are named, not found by path. */
+                path = false;
+                if (g_strcmp0 (name, "current") == 0)
+                {
+                    g_free (name);
+                    return false;
+                }
+                if (g_strcmp0 (name, "if-feature") == 0 && strchr (c, ')'))
+                    c = strchr (c, ')');
+            }
+            else if (g_strcmp0 (name, "and") == 0 || g_strcmp0 (name, "or") == 0 ||
+                     g_strcmp0 (name, "div") == 0 || g_strcmp0 (name, "mod") == 0)
+                path = false;
+            else
+                path = !g_ascii_isdigit (start[0]) && !(start[0] == '.' && g_ascii_isdigit (start[1]));
+            g_free (name);
+            if (path && depth == 0 && prev != '/')
+                return false;
+            prev = 'a';
+            continue;
+        }
+        if (!g_ascii_isspace (*c))
+            prev = *c;
+        c++;
+    }
+    return true;
+}
+
+/* Parse a condition once, keeping the result for as long as the schema */
+static struct sch_condition *
+sch_condition_compile (const char *condition)
+{
+    struct sch_condition *compiled;
+
+    g_mutex_lock (&condition_lock);
+    if (!compiled_conditions)
+        compiled_conditions = g_hash_table_new_full (g_str_hash, g_str_equal, g_free, g_free);
+    compiled = g_hash_table_lookup (compiled_conditions, condition);
+    if (!compiled)
+    {
+        compiled = g_malloc0 (sizeof (struct sch_condition));
+        compiled->fixed = xpath_is_fixed (condition);
+        g_hash_table_insert (compiled_conditions, g_strdup (condition), compiled);
+    }
+    g_mutex_unlock (&condition_lock);
+    return compiled;
+}
+
+/* Evaluate a condition, reusing an earlier result from the memo table if one
+ * is given. Results of conditions that do not depend on the node they are on
+ * are shared by every path. */
+bool
+sch_condition_evaluate (sch_instance *instance, GNode *tree, char *path, char *condition,
+                        GHashTable *memo)
+{
+    char *key = NULL;
+    gpointer result;
+    gint64 start;
+    bool ret;
+
+    if (memo)
+    {
+        if (sch_condition_compile (condition)->fixed)
+            key = g_strdup_printf ("\n%s", condition);
+        else
+            key = g_strdup_printf ("%s\n%s", path, condition);
+        if (g_hash_table_lookup_extended (memo, key, NULL, &result))
+        {
+            g_free (key);
+            g_mutex_lock (&condition_lock);
+            condition_stats.cached++;
+            g_mutex_unlock (&condition_lock);
+            return GPOINTER_TO_INT (result);
+        }
+    }
+
+    start = g_get_monotonic_time ();
+    ret = sch_process_condition (instance, tree, path, condition);
+    g_mutex_lock (&condition_lock);
+    condition_stats.evaluated++;
+    condition_stats.time_us += g_get_monotonic_time () - start;
+    g_mutex_unlock (&condition_lock);
+
+    if (memo)
+        g_hash_table_insert (memo, key, GINT_TO_POINTER (ret));
+    return ret;
+}
+
+void
+sch_condition_stats (uint32_t *evaluated, uint32_t *cached, uint64_t *time_us)
+{
+    g_mutex_lock (&condition_lock);
+    *evaluated = condition_stats.evaluated;
+    *cached = condition_stats.cached;
+    *time_us = condition_stats.time_us;
+    g_mutex_unlock (&condition_lock);
+}
+
+/* Leaf value validation results, kept per schema node. Values are always
+ * checked by sch_validate_pattern() the first time they are seen, so the
+ * library's pattern dialect, ranges and enumerations decide what is valid. */
+#define SCH_VALUE_CACHE_MAX 256
+
+static GHashTable *value_check_cache = NULL;
+static GMutex value_check_lock;
+
+static bool
+sch_value_valid (sch_node *schema, const char *value)
+{
+    GHashTable *results;
+    gpointer result;
+    bool valid;
+
+    if (!value)
+        return sch_validate_pattern (schema, value);
+
+    g_mutex_lock (&value_check_lock);
+    if (!value_check_cache)
+        value_check_cache = g_hash_table_new_full (g_direct_hash, g_direct_equal, NULL,
+                                                   (GDestroyNotify) g_hash_table_destroy);
+    results = g_hash_table_lookup (value_check_cache, schema);
+    if (!results)
+    {
+        results = g_hash_table_new_full (g_str_hash, g_str_equal, g_free, NULL);
+        g_hash_table_insert (value_check_cache, schema, results);
+    }
+    if (g_hash_table_lookup_extended (results, value, NULL, &result))
+    {
+        g_mutex_unlock (&value_check_lock);
+        return GPOINTER_TO_INT (result);
+    }
+    g_mutex_unlock (&value_check_lock);
+
+    valid = sch_validate_pattern (schema, value);
+
+    g_mutex_lock (&value_check_lock);
+    if (value_check_cache)
+    {
+        /* Start again once full, so the values in current use get cached */
+        results = g_hash_table_lookup (value_check_cache, schema);
+        if (results && g_hash_table_size (results) >= SCH_VALUE_CACHE_MAX)
+            g_hash_table_remove_all (results);
+        if (results)
+            g_hash_table_insert (results, g_strdup (value), GINT_TO_POINTER (valid));
     }
+    g_mutex_unlock (&value_check_lock);
+    return valid;
+}
+
+void
+sch_cache_free (void)
+{
+    g_mutex_lock (&condition_lock);
+    if (condition_cache)
+        g_hash_table_destroy (condition_cache);
+    condition_cache = NULL;
+    if (compiled_conditions)
+        g_hash_table_destroy (compiled_conditions);
+    compiled_conditions = NULL;
+    g_mutex_unlock (&condition_lock);
+    g_mutex_lock (&value_check_lock);
+    if (value_check_cache)
+        g_hash_table_destroy (value_check_cache);
+    value_check_cache = NULL;
+    g_mutex_unlock (&value_check_lock);
 }
 
 
 static xmlNode *
 _sch_gnode_to_xml (sch_instance * instance, sch_node * schema, sch_ns *ns, xmlNode * parent,
-                   GNode * node, int flags, int depth)
+                   GNode * node, int flags, int depth, GHashTable *memo)
 {
     sch_node *pschema = schema;
     xmlNode *data = NULL;
@@ -181,7 +468,7 @@ _sch_gnode_to_xml (sch_instance * instance, sch_node * schema, sch_ns *ns, xmlNo
     /* Get the actual node name */
     if (depth == 0 && strlen (APTERYX_NAME (node)) == 1)
     {
-        return _sch_gnode_to_xml (instance, schema, ns, parent, node->children, flags, depth);
+        return _sch_gnode_to_xml (instance, schema, ns, parent, node->children, flags, depth, memo);
     }
     else if (depth == 0 && APTERYX_NAME (node)[0] == '/')
     {
@@ -269,7 +556,7 @@ _sch_gnode_to_xml (sch_instance * instance, sch_node * schema, sch_ns *ns, xmlNo
     sch_check_condition (schema, node, flags, &path, &condition);
     if (condition)
     {
-        if (!sch_process_condition (netconf_get_g_schema (), node, path, condition))
+        if (!sch_condition_evaluate (netconf_get_g_schema (), node, path, condition, memo))
         {
             g_free (condition);
             g_free (path);
@@ -336,7 +623,7 @@ _sch_gnode_to_xml (sch_instance * instance, sch_node * schema, sch_ns *ns, xmlNo
             for (GNode * field = child->children; field; field = field->next)
             {
                 if (_sch_gnode_to_xml (instance, sch_node_child_first (schema), ns,
-                                       list_data, field, flags, depth + 1))
+                                       list_data, field, flags, depth + 1, memo))
                 {
                     has_child = true;
                 }
@@ -390,7 +677,7 @@ _sch_gnode_to_xml (sch_instance * instance, sch_node * schema, sch_ns *ns, xmlNo
         sch_gnode_sort_children (schema, node);
         for (GNode * child = node->children; child; child = child->next)
         {
-            if (_sch_gnode_to_xml (instance, schema, ns, data, child, flags, depth + 1))
+            if (_sch_gnode_to_xml (instance, schema, ns, data, child, flags, depth + 1, memo))
             {
                 has_child = true;
             }
@@ -455,16 +742,19 @@ _sch_gnode_to_xml (sch_instance * instance, sch_node * schema, sch_ns *ns, xmlNo
 xmlNode *
 sch_gnode_to_xml (sch_instance * instance, sch_node * schema, GNode * node, int flags)
 {
+    /* Conditions that do not depend on their node are evaluated once */
+    GHashTable *memo = g_hash_table_new_full (g_str_hash, g_str_equal, g_free, NULL);
+    xmlNode *first = NULL;
+
     if (node && g_node_n_children (node) > 1 && strlen (APTERYX_NAME (node)) == 1)
     {
-        xmlNode *first = NULL;
         xmlNode *last = NULL;
         xmlNode *next;
 
         apteryx_sort_children (node, g_strcmp0);
         for (GNode * child = node->children; child; child = child->next)
         {
-            next = _sch_gnode_to_xml (instance, schema, NULL, NULL, child, flags, 1);
+            next = _sch_gnode_to_xml (instance, schema, NULL, NULL, child, flags, 1, memo);
             if (next)
             {
                 if (last)
@@ -474,10 +764,11 @@ sch_gnode_to_xml (sch_instance * instance, sch_node * schema, GNode * node, int
                     first = next;
             }
         }
-        return first;
     }
     else
-        return _sch_gnode_to_xml (instance, schema, NULL, NULL, node, flags, 0);
+        first = _sch_gnode_to_xml (instance, schema, NULL, NULL, node, flags, 0, memo);
+    g_hash_table_destroy (memo);
+    return first;
 }
 
 static bool
@@ -588,6 +879,34 @@ _perform_actions (_sch_xml_to_gnode_parms *_parms, int depth, char *curr_op, cha
     }
 }
 
+/* The element child of xml following child, or the first if child is NULL.
+ * When streaming, the reader is moved on to it from the end of child. */
+static xmlNode *
+_sch_xml_next_child (_sch_xml_to_gnode_parms *_parms, xmlNode *xml, xmlNode *child,
+                     int rdepth, bool stream)
+{
+    xmlTextReaderPtr reader = _parms->in_reader;
+    int rc;
+
+    if (!stream)
+        return child ? xmlNextElementSibling (child) : xmlFirstElementChild (xml);
+
+    rc = child ? xmlTextReaderNext (reader) : xmlTextReaderRead (reader);
+    while (rc == 1 && xmlTextReaderDepth (reader) > rdepth)
+    {
+        if (xmlTextReaderNodeType (reader) == XML_READER_TYPE_ELEMENT)
+            return xmlTextReaderCurrentNode (reader);
+        rc = xmlTextReaderNext (reader);
+    }
+    if (rc < 0)
+    {
+        DEBUG ("XML parse failed below %s\n", xml->name);
+        _parms->out_error.tag = NC_ERR_TAG_MALFORMED_MSG;
+        _parms->out_error.type = NC_ERR_TYPE_RPC;
+    }
+    return NULL;
+}
+
 static GNode *
 _sch_xml_to_gnode (_sch_xml_to_gnode_parms *_parms, sch_node * schema, sch_ns *ns, char * part_xpath,
                    char * curr_op, GNode * pparent, xmlNode * xml, int depth, sch_node **rschema, char ** edit_op)
@@ -595,7 +914,16 @@ _sch_xml_to_gnode (_sch_xml_to_gnode_parms *_parms, sch_node * schema, sch_ns *n
     sch_instance *instance = _parms->in_instance;
     int flags = _parms->in_flags;
     char *name = (char *) xml->name;
+    xmlTextReaderPtr reader = _parms->in_reader;
+    /* When streaming only the start of xml has been read. Children are read
+     * as they are converted, apart from leaves which are read in full. */
+    bool stream = reader && xmlTextReaderCurrentNode (reader) == xml &&
+        xmlTextReaderIsEmptyElement (reader) == 0;
+    int rdepth = stream ? xmlTextReaderDepth (reader) : 0;
     xmlNode *child;
+    xmlNode *first;
+    bool has_children = false;
+    unsigned long n_children = xmlChildElementCount (xml);
     char *attr;
     GNode *tree = NULL;
     GNode *node = NULL;
@@ -678,6 +1006,27 @@ _sch_xml_to_gnode (_sch_xml_to_gnode_parms *_parms, sch_node * schema, sch_ns *n
     if (edit_op && new_op)
         *edit_op = new_op;
 
+    if (stream && (sch_is_leaf (schema) || sch_is_leaf_list (schema)))
+    {
+        if (!xmlTextReaderExpand (reader))
+        {
+            DEBUG ("XML parse failed in %s\n", name);
+            _parms->out_error.tag = NC_ERR_TAG_MALFORMED_MSG;
+            _parms->out_error.type = NC_ERR_TYPE_RPC;
+            free (new_xpath);
+            free (name);
+            return NULL;
+        }
+        stream = false;
+    }
+    first = _sch_xml_next_child (_parms, xml, NULL, rdepth, stream);
+    if (_parms->out_error.tag)
+    {
+        free (new_xpath);
+        free (name);
+        return NULL;
+    }
+
     /* LIST */
     if (sch_is_leaf_list (schema))
     {
@@ -694,7 +1043,7 @@ _sch_xml_to_gnode (_sch_xml_to_gnode_parms *_parms, sch_node * schema, sch_ns *n
                 sch_check_condition_parms (_parms, parent, new_xpath);
 
             char *content = (char *) xmlNodeGetContent (xml);
-            if (_parms->in_is_edit && !sch_validate_pattern (schema, content))
+            if (_parms->in_is_edit && !sch_value_valid (schema, content))
             {
                 DEBUG ("Invalid value \"%s\" for node \"%s\"\n", content, name);
                 g_free (content);
@@ -752,7 +1101,7 @@ _sch_xml_to_gnode (_sch_xml_to_gnode_parms *_parms, sch_node * schema, sch_ns *n
             free (attr);
             node = APTERYX_NODE (node, key_value);
             DEBUG ("%*s%s\n", depth * 2, " ", APTERYX_NAME (node));
-            if (!(_parms->in_flags & SCH_F_STRIP_KEY) || xmlFirstElementChild (xml))
+            if (!(_parms->in_flags & SCH_F_STRIP_KEY) || first)
             {
                 GNode *_node = APTERYX_NODE (node, g_strdup (key));
                 DEBUG ("%*s%s\n", (depth + 1) * 2, " ", key);
@@ -760,11 +1109,10 @@ _sch_xml_to_gnode (_sch_xml_to_gnode_parms *_parms, sch_node * schema, sch_ns *n
                     g_node_prepend_data (_node, NULL);
             }
         }
-        else if (xmlFirstElementChild (xml) &&
-                 g_strcmp0 ((const char *) xmlFirstElementChild (xml)->name, key) == 0 &&
-                 xml_node_has_content (xmlFirstElementChild (xml)))
+        else if (first && g_strcmp0 ((const char *) first->name, key) == 0 &&
+                 (!stream || xmlTextReaderExpand (reader)) && xml_node_has_content (first))
         {
-            char *content = (char *) xmlNodeGetContent (xmlFirstElementChild (xml));
+            char *content = (char *) xmlNodeGetContent (first);
             key_value = _sch_key_encode (content);
             free (content);
             node = APTERYX_NODE (node, key_value);
@@ -837,7 +1185,7 @@ _sch_xml_to_gnode (_sch_xml_to_gnode_parms *_parms, sch_node * schema, sch_ns *n
             /* Can now validate value, whether or not it is an empty string */
             if (validate)
             {
-                if (_parms->in_is_edit && !sch_validate_pattern (schema, value))
+                if (_parms->in_is_edit && !sch_value_valid (schema, value))
                 {
                     DEBUG ("Invalid value \"%s\" for node \"%s\"\n", value, name);
                     free (value);
@@ -909,13 +1257,14 @@ _sch_xml_to_gnode (_sch_xml_to_gnode_parms *_parms, sch_node * schema, sch_ns *n
     /* Carry out actions for this operation. Does nothing if not edit-config. */
     _perform_actions (_parms, depth, curr_op, new_op, new_xpath);
 
-    for (child = xmlFirstElementChild (xml); child; child = xmlNextElementSibling (child))
+    for (child = first; child; child = _sch_xml_next_child (_parms, xml, child, rdepth, stream))
     {
+        has_children = true;
         if ((_parms->in_flags & SCH_F_STRIP_KEY) && key &&
             g_strcmp0 ((const char *) child->name, key) == 0)
         {
             /* The only child is the key with value */
-            if (xmlChildElementCount (xml) == 1)
+            if (n_children == 1)
             {
                 if (xml_node_has_content (child))
                 {
@@ -934,7 +1283,7 @@ _sch_xml_to_gnode (_sch_xml_to_gnode_parms *_parms, sch_node * schema, sch_ns *n
                 break;
             }
             /* Multiple children - make sure key appears */
-            else if (xmlChildElementCount (xml) > 1 && !sch_is_proxy (schema))
+            else if (n_children > 1 && !sch_is_proxy (schema))
             {
                 GNode *_node = APTERYX_NODE (node, g_strdup ((const char *) child->name));
                 DEBUG ("%*s%s\n", depth * 2, " ", APTERYX_NAME (node));
@@ -963,6 +1312,12 @@ _sch_xml_to_gnode (_sch_xml_to_gnode_parms *_parms, sch_node * schema, sch_ns *n
             }
         }
     }
+    if (_parms->out_error.tag)
+    {
+        apteryx_free_tree (tree);
+        tree = NULL;
+        goto exit;
+    }
 
     /* If no children added, no point in returning anything. */
     if (!ret_tree && _parms->in_is_edit)
@@ -973,7 +1328,7 @@ _sch_xml_to_gnode (_sch_xml_to_gnode_parms *_parms, sch_node * schema, sch_ns *n
     }
 
     /* Get everything from here down if a trunk of a subtree */
-    if (!xmlFirstElementChild (xml) && sch_node_child_first (schema) &&
+    if (!has_children && sch_node_child_first (schema) &&
         g_strcmp0 (APTERYX_NAME (node), "*") != 0)
     {
         node = APTERYX_NODE (node, g_strdup ("*"));
@@ -1002,6 +1357,7 @@ sch_parms_init (sch_instance * instance, int flags, char * def_op, bool is_edit)
     _parms->in_flags = flags;
     _parms->in_def_op = def_op;
     _parms->in_is_edit = is_edit;
+    _parms->in_reader = NULL;
     _parms->out_tree = NULL;
     _parms->out_error = NC_ERROR_PARMS_INIT;
     _parms->out_deletes = NULL;
@@ -1030,6 +1386,32 @@ sch_xml_to_gnode (sch_instance * instance, sch_node * schema, xmlNode * xml, int
     return (sch_xml_to_gnode_parms) _parms;
 }
 
+/* Convert the element a reader is at to a GNode tree as it is read, giving
+ * the same results as sch_xml_to_gnode without building the whole document.
+ * The reader is left at the end of the element, or its start if it was read
+ * in full. */
+sch_xml_to_gnode_parms
+sch_reader_to_gnode (sch_instance * instance, xmlTextReaderPtr reader, int flags,
+                     char * def_op, bool is_edit, sch_node **rschema, char ** edit_op)
+{
+    _sch_xml_to_gnode_parms *_parms = sch_parms_init(instance, flags, def_op, is_edit);
+    xmlNode *xml = xmlTextReaderCurrentNode (reader);
+
+    if (xml && xmlTextReaderNodeType (reader) == XML_READER_TYPE_ELEMENT)
+    {
+        _parms->in_reader = reader;
+        _parms->out_tree = _sch_xml_to_gnode (_parms, NULL, NULL, "", def_op, NULL, xml, 0,
+                                              rschema, edit_op);
+        _parms->in_reader = NULL;
+    }
+    else
+    {
+        _parms->out_error.tag = NC_ERR_TAG_INVALID_VAL;
+        _parms->out_error.type = NC_ERR_TYPE_PROTOCOL;
+    }
+    return (sch_xml_to_gnode_parms) _parms;
+}
+
 GNode *
 sch_parm_tree (sch_xml_to_gnode_parms parms)
 {
@@ -29,6 +29,7 @@
 #include <syslog.h>
 #include <apteryx.h>
 #include <libxml/tree.h>
+#include <libxml/xmlreader.h>
 #define APTERYX_XML_LIBXML2
 #include <libxml/xpath.h>
 #include <libxml/xpathInternals.h>
@@ -69,6 +70,7 @@ typedef enum
     LOG_KILL_SESSION            = (1 << 3),  /* Log kill-session requests */
     LOG_LOCK                    = (1 << 4),  /* Log lock requests */
     LOG_UNLOCK                  = (1 << 5),  /* Log unlock requests */
+    LOG_SLOW_RPC                = (1 << 6),  /* Log RPCs slower than the threshold */
 } logging_flags;
 
 /* Define session counters from the RFC 6022 /netconf-state/sessions group
@@ -80,6 +82,13 @@ typedef struct
     uint32_t in_bad_rpcs;
     uint32_t out_rpc_errors;
     uint32_t out_notifications;
+    /* Traffic counters beyond RFC 6022 */
+    uint64_t in_bytes;
+    uint64_t out_bytes;
+    uint32_t in_chunks;
+    uint32_t out_chunks;
+    uint32_t max_request;
+    uint32_t max_reply;
 } session_counters_t;
 
 /* Define global counters from the RFC 6022 /netconf-state/statistics group */
@@ -180,6 +189,9 @@ xmlNode *sch_gnode_to_xml (sch_instance * instance, sch_node * schema, GNode * n
 sch_xml_to_gnode_parms sch_xml_to_gnode (sch_instance * instance, sch_node * schema,
                                          xmlNode * xml, int flags, char * def_op,
                                          bool is_edit, sch_node **rschema, char ** edit_op);
+sch_xml_to_gnode_parms sch_reader_to_gnode (sch_instance * instance, xmlTextReaderPtr reader,
+                                            int flags, char * def_op, bool is_edit,
+                                            sch_node **rschema, char ** edit_op);
 GNode *sch_parm_tree (sch_xml_to_gnode_parms parms);
 nc_error_parms sch_parm_error (sch_xml_to_gnode_parms parms);
 GList *sch_parm_deletes (sch_xml_to_gnode_parms parms);
@@ -189,6 +201,10 @@ GList *sch_parm_replaces (sch_xml_to_gnode_parms parms);
 GList *sch_parm_merges (sch_xml_to_gnode_parms parms);
 GList *sch_parm_conditions (sch_xml_to_gnode_parms parms);
 bool sch_parm_need_tree_set (sch_xml_to_gnode_parms parms);
+bool sch_condition_evaluate (sch_instance *instance, GNode *tree, char *path, char *condition,
+                             GHashTable *memo);
+void sch_condition_stats (uint32_t *evaluated, uint32_t *cached, uint64_t *time_us);
+void sch_cache_free (void);
 void sch_parm_free (sch_xml_to_gnode_parms parms);
 GNode *sch_xpath_to_gnode (sch_instance * instance, sch_node * schema, const char *path, int flags,
                            sch_node ** rschema, xpath_type *x_type, char *schema_path);
@@ -51,7 +51,7 @@ load_logging_options (void)
         {
             /* Remove any trailing LF */
             buf[strcspn(buf, "\n")] = '\0';
-            split = g_strsplit (buf, " ", 6);
+            split = g_strsplit (buf, " ", 7);
             count = g_strv_length (split);
             for (i = 0; i < count; i++)
             {
@@ -67,6 +67,8 @@ load_logging_options (void)
                     flags |= LOG_LOCK;
                 else if (g_strcmp0 (split[i], "unlock") == 0)
                     flags |= LOG_UNLOCK;
+                else if (g_strcmp0 (split[i], "slow-rpc") == 0)
+                    flags |= LOG_SLOW_RPC;
             }
             g_strfreev (split);
         }
@@ -21,17 +21,58 @@
 #define __USE_GNU
 #include <sys/socket.h>
 #include <pwd.h>
+#include <errno.h>
 #define APTERYX_XML_LIBXML2
 #include <apteryx-xml.h>
 #include <libxml/xpath.h>
 #include <libxml/xpathInternals.h>
 #include <libxml/debugXML.h>
+#include <libxml/xmlsave.h>
 
 #define DEFAULT_LANG "en"
 #define RECV_TIMEOUT_SEC 60
 
 static sch_instance *g_schema = NULL;
 
+/* RPC latency in microseconds, counted in power of two buckets. Bucket n
+ * holds latencies from 2^(n-1) to 2^n - 1. */
+#define LATENCY_BUCKETS 32
+
+struct latency_hist
+{
+    uint32_t buckets[LATENCY_BUCKETS];
+    uint32_t max;
+};
+
+/* Phases of handling an RPC timed for the slow RPC log */
+enum rpc_phase
+{
+    RPC_PHASE_RECEIVE,
+    RPC_PHASE_PARSE,
+    RPC_PHASE_FILTER,
+    RPC_PHASE_QUERY,
+    RPC_PHASE_DEFAULTS,
+    RPC_PHASE_TO_XML,
+    RPC_PHASE_XPATH,
+    RPC_PHASE_SERIALISE,
+    RPC_PHASE_SEND,
+    RPC_PHASE_MAX,
+};
+
+static const char *rpc_phase_names[RPC_PHASE_MAX] = {
+    "receive", "parse", "filter", "query", "defaults", "to-xml", "xpath", "serialise", "send",
+};
+
+/* Time spent (microseconds) in each phase of the current RPC of a session */
+struct rpc_trace
+{
+    bool enabled;
+    gint64 phases[RPC_PHASE_MAX];
+    size_t in_bytes;
+    size_t out_bytes;
+    gchar *filter;
+};
+
 struct netconf_session
 {
     int fd;
@@ -40,18 +81,25 @@ struct netconf_session
     gchar *rem_addr;
     gchar *rem_port;
     gchar *login_time;
+    uint32_t pid;
+    gint64 connected;
+    gsize data_loaded;
     bool running;
     session_counters_t counters;
+    struct latency_hist latency;
+    struct rpc_trace trace;
+    gint64 rpc_arrived;
 };
 
-static struct _running_ds_lock_t
+static struct _ds_lock_t
 {
     struct netconf_session nc_sess;
     gboolean locked;
-} running_ds_lock;
+} running_ds_lock, candidate_ds_lock;
 
 #define NETCONF_BASE_1_0_END "]]>]]>"
 #define NETCONF_BASE_1_1_END "\n##\n"
+#define NETCONF_PARTIAL_LOCK_NS "urn:ietf:params:xml:ns:netconf:partial-lock:1.0"
 #define NETCONF_HELLO_END "hello>]]>]]>"
 #define NETCONF_HELLO_END_LEN 12
 #define HELLO_RX_SIZE 1024
@@ -63,19 +111,195 @@ static struct _running_ds_lock_t
 #define NETCONF_SESSION_STATUS "/netconf-state/sessions/session/*/status"
 #define NETCONF_CONFIG_MAX_SESSIONS "/netconf/config/max-sessions"
 #define NETCONF_STATE "/netconf/state"
+#define NETCONF_STATE_PROXIES_PATH "/netconf-state/proxies/proxy"
+#define NETCONF_CONFIG_PROXY_TIMEOUT "/netconf/config/proxy-timeout"
+#define NETCONF_CONFIG_PROXY_CACHE_TTL "/netconf/config/proxy-cache-ttl"
+#define NETCONF_CONFIG_CACHE_TTL "/netconf/config/cache-ttl"
+#define NETCONF_STATE_COALESCING_PATH "/netconf/state/coalescing"
+#define NETCONF_CONFIG_EDIT_DIFF "/netconf/config/edit-diff"
+#define NETCONF_STATE_EDIT_DIFF_PATH "/netconf/state/edit-diff"
+#define NETCONF_STATE_CONDITIONS_PATH "/netconf/state/conditions"
+#define NETCONF_CONFIG_LOCK_WAIT "/netconf/config/lock-wait"
+#define NETCONF_STATE_LOCK_WAIT_PATH "/netconf-state/lock-wait"
+#define NETCONF_STATE_EDIT_PRUNE_PATH "/netconf/state/edit-prune"
+#define NETCONF_CONFIG_STATE_REFRESH "/netconf/config/state-refresh"
+#define NETCONF_CONFIG_SLOW_RPC "/netconf/config/slow-rpc"
 
 /* Defines for the max-sessions variable - the maximum number of sessions allowed */
 #define NETCONF_MAX_SESSIONS_MIN 1
 #define NETCONF_MAX_SESSIONS_MAX 10
 #define NETCONF_MAX_SESSIONS_DEF 4
 
+/* Defines for queries to proxied databases (all times in milliseconds) */
+#define NETCONF_PROXY_TIMEOUT_DEF 5000
+#define NETCONF_PROXY_CACHE_TTL_DEF 1000
+#define NETCONF_PROXY_CACHE_MAX 64
+#define NETCONF_PROXY_WORKERS_MAX 8
+
+/* Defines for waiting on a held datastore lock (milliseconds, 0 fails at once) */
+#define NETCONF_LOCK_WAIT_DEF 0
+#define NETCONF_LOCK_WAIT_SAMPLES 256
+
+/* Defines for how long published /netconf-state data is valid (milliseconds) */
+#define NETCONF_STATE_REFRESH_MIN 100
+#define NETCONF_STATE_REFRESH_DEF 1000
+
+/* Default time above which RPCs are written to the slow RPC log (milliseconds) */
+#define NETCONF_SLOW_RPC_DEF 1000
+#define NETCONF_SLOW_RPC_FILTER_MAX 256
+
+/* How long a looked up username is remembered for a user ID (seconds) */
+#define NETCONF_USERNAME_CACHE_TTL 60
+
 static uint32_t netconf_session_id = 1;
 static uint32_t netconf_max_sessions = NETCONF_MAX_SESSIONS_DEF;
 static uint32_t netconf_num_sessions = 0;
 
-/* Maintain a list of open sessions */
-static GList *open_sessions_list = NULL;
-GMutex session_lock;
+/* Open sessions indexed by session ID. Lookups and monitoring only take the
+ * lock for reading so they do not hold up each other */
+static GHashTable *open_sessions = NULL;
+static GRWLock session_lock;
+
+/* Proxied database queries - run concurrently, with per target statistics and
+ * a short lived cache of results from read-only proxies */
+struct proxy_stats
+{
+    uint32_t requests;
+    uint32_t timeouts;
+    uint32_t cache_hits;
+    uint64_t last_latency;
+    uint64_t max_latency;
+    uint64_t total_latency;
+};
+
+struct proxy_cache_entry
+{
+    GNode *tree;
+    gint64 expires;
+};
+
+static uint32_t netconf_proxy_timeout = NETCONF_PROXY_TIMEOUT_DEF;
+static uint32_t netconf_proxy_cache_ttl = NETCONF_PROXY_CACHE_TTL_DEF;
+static GThreadPool *proxy_workers = NULL;
+static GHashTable *proxy_stats_table = NULL;
+static GHashTable *proxy_cache = NULL;
+static GMutex proxy_lock;
+
+/* Operational data cache - per path lifetimes (milliseconds) are configured
+ * in /netconf/config/cache-ttl/<path> and apply to config false subtrees only */
+
+struct state_cache_entry
+{
+    GNode *tree;
+    gint64 expires;
+    bool fetching;
+};
+
+static GHashTable *state_cache_ttls = NULL;
+static GHashTable *state_cache = NULL;
+static GMutex state_cache_lock;
+static GCond state_cache_cond;
+
+/* Identical concurrent reads share one execution of the request */
+struct get_flight
+{
+    int refcount;
+    bool done;
+    gint64 started;
+    char *data;
+};
+
+static struct
+{
+    uint32_t executed;
+    uint32_t coalesced;
+} coalesce_stats;
+
+static GHashTable *get_flights = NULL;
+static GMutex get_flight_lock;
+static GCond get_flight_cond;
+
+/* Optionally only write the parts of an edit that change the database */
+static bool netconf_edit_diff = false;
+static struct
+{
+    uint32_t edits;
+    uint32_t written;
+    uint32_t skipped;
+    uint32_t pruned;
+} edit_diff_stats;
+static GMutex edit_diff_lock;
+
+/* Edits prune only the top-most of any nested paths */
+static struct
+{
+    uint32_t executed;
+    uint32_t saved;
+} edit_prune_stats;
+static GMutex edit_prune_lock;
+
+/* Lock requests wait in order for a held datastore lock, up to lock-wait */
+struct lock_waiter
+{
+    struct _ds_lock_t *ds_lock;
+};
+
+static uint32_t netconf_lock_wait = NETCONF_LOCK_WAIT_DEF;
+static uint32_t netconf_slow_rpc = NETCONF_SLOW_RPC_DEF;
+static GQueue lock_waiters = G_QUEUE_INIT;
+static GMutex ds_lock_mutex;
+static GCond ds_lock_cond;
+static struct
+{
+    uint32_t waits;
+    uint32_t timeouts;
+    uint32_t samples;
+    uint64_t wait_times[NETCONF_LOCK_WAIT_SAMPLES];
+} lock_wait_stats;
+
+/* Partial locks (RFC 5717) on running, indexed by the nodes they lock so
+ * overlap checks follow a path rather than scan every lock */
+struct partial_lock
+{
+    uint32_t id;
+    uint32_t session_id;
+    GList *nodes;
+    GList *paths;
+};
+
+struct lock_scope
+{
+    char *name;
+    GList *holders;
+    unsigned int locks;
+};
+
+static GNode *partial_lock_scopes = NULL;
+static GList *partial_locks = NULL;
+static uint32_t partial_lock_id = 1;
+static GMutex partial_lock_mutex;
+
+/* The candidate datastore, held as the changes still to be made to running */
+static GNode *candidate_sets = NULL;
+static GList *candidate_prunes = NULL;
+static GMutex candidate_lock;
+
+/* Configuration to put back if a change has to be undone */
+struct snapshot
+{
+    GList *paths;
+    GList *trees;
+};
+
+/* A confirmed commit waiting to be confirmed, protected by the candidate lock */
+#define NETCONF_CONFIRM_TIMEOUT_DEF 600
+static struct
+{
+    GList *snapshots;
+    guint timer;
+    uint32_t session_id;
+    char *persist;
+} confirmed_commit;
 
 /* Global statistics */
 global_statistics_t netconf_global_stats;
@@ -308,44 +532,106 @@ generate_apteryx_query_node_paths (GNode *query, GString* qpath, GList *paths)
 void
 netconf_close_open_sessions (void)
 {
-    if (open_sessions_list)
+    GHashTableIter iter;
+    struct netconf_session *nc_session;
+
+    if (!open_sessions)
+        return;
+
+    g_rw_lock_reader_lock (&session_lock);
+    g_hash_table_iter_init (&iter, open_sessions);
+    while (g_hash_table_iter_next (&iter, NULL, (gpointer *) &nc_session))
     {
-        for (GList *iter = open_sessions_list; iter; iter = g_list_next (iter))
+        if (nc_session->fd >= 0)
         {
-            struct netconf_session *nc_session = iter->data;
-            if (nc_session && nc_session->fd >= 0)
-            {
-                close (nc_session->fd);
-                nc_session->fd = -1;
-            }
+            close (nc_session->fd);
+            nc_session->fd = -1;
         }
     }
+    g_rw_lock_reader_unlock (&session_lock);
+}
+
+/* Byte counters are 64 bit. They are only written by their own session but
+ * are read by the refreshes. */
+static void
+counter64_add (uint64_t *counter, uint64_t value)
+{
+    __atomic_add_fetch (counter, value, __ATOMIC_RELAXED);
+}
+
+static uint64_t
+counter64_get (uint64_t *counter)
+{
+    return __atomic_load_n (counter, __ATOMIC_RELAXED);
+}
+
+static void
+counter_max (uint32_t *counter, uint32_t value)
+{
+    if (value > (uint32_t) g_atomic_int_get (counter))
+        g_atomic_int_set (counter, value);
+}
+
+/* Count a message received or sent by a session */
+static void
+session_count_message (struct netconf_session *session, bool in, uint32_t len, uint32_t chunks)
+{
+    session_counters_t *counters = &session->counters;
+
+    if (in)
+    {
+        counter64_add (&counters->in_bytes, len);
+        g_atomic_int_add (&counters->in_chunks, chunks);
+        counter_max (&counters->max_request, len);
+    }
+    else
+    {
+        counter64_add (&counters->out_bytes, len);
+        g_atomic_int_add (&counters->out_chunks, chunks);
+        counter_max (&counters->max_reply, len);
+    }
+}
+
+/* Each session counts its own RPCs. Global totals are the sum of the open
+ * sessions and the totals kept from sessions that have closed. */
+static void
+session_counters_add (session_counters_t *total, session_counters_t *counters)
+{
+    total->in_rpcs += g_atomic_int_get (&counters->in_rpcs);
+    total->in_bad_rpcs += g_atomic_int_get (&counters->in_bad_rpcs);
+    total->out_rpc_errors += g_atomic_int_get (&counters->out_rpc_errors);
+    total->out_notifications += g_atomic_int_get (&counters->out_notifications);
+    total->in_bytes += counter64_get (&counters->in_bytes);
+    total->out_bytes += counter64_get (&counters->out_bytes);
+    total->in_chunks += g_atomic_int_get (&counters->in_chunks);
+    total->out_chunks += g_atomic_int_get (&counters->out_chunks);
+    total->max_request = MAX (total->max_request, (uint32_t) g_atomic_int_get (&counters->max_request));
+    total->max_reply = MAX (total->max_reply, (uint32_t) g_atomic_int_get (&counters->max_reply));
 }
 
 /**
- * Remove specified netconf session from open_sessions_list. Can't guarantee
- * that the passed in session is the one on the list, hence the search by ID.
+ * Remove specified netconf session from the open sessions. Can't guarantee
+ * that the passed in session is the one in the table, hence the check.
  */
 static void
 remove_netconf_session (struct netconf_session *session)
 {
-    if (!session || !open_sessions_list)
+    struct netconf_session *nc_session;
+
+    if (!session || !open_sessions)
     {
         return;
     }
 
-    g_mutex_lock (&session_lock);
-    for (GList *iter = open_sessions_list; iter; iter = g_list_next (iter))
+    g_rw_lock_writer_lock (&session_lock);
+    nc_session = g_hash_table_lookup (open_sessions, GUINT_TO_POINTER (session->id));
+    if (nc_session == session)
     {
-        struct netconf_session *nc_session = iter->data;
-        if (nc_session && session->id == nc_session->id)
-        {
-            open_sessions_list = g_list_remove (open_sessions_list, nc_session);
-            netconf_num_sessions--;
-            break;
-        }
+        g_hash_table_remove (open_sessions, GUINT_TO_POINTER (session->id));
+        netconf_num_sessions--;
+        session_counters_add (&netconf_global_stats.session_totals, &nc_session->counters);
     }
-    g_mutex_unlock (&session_lock);
+    g_rw_lock_writer_unlock (&session_lock);
 }
 
 /* Find open netconf session details by ID */
@@ -353,19 +639,93 @@ static struct netconf_session *
 find_netconf_session_by_id (uint32_t session_id)
 {
     struct netconf_session *ret = NULL;
-    g_mutex_lock (&session_lock);
-    for (GList *iter = open_sessions_list; iter; iter = g_list_next (iter))
+
+    if (!open_sessions)
+        return NULL;
+
+    g_rw_lock_reader_lock (&session_lock);
+    ret = g_hash_table_lookup (open_sessions, GUINT_TO_POINTER (session_id));
+    g_rw_lock_reader_unlock (&session_lock);
+
+    return ret;
+}
+
+/**
+ * Add session data for this session based on the PID of the remote socat process.
+ */
+static void
+add_session_data (struct netconf_session *session)
+{
+    gchar *fname;
+    gchar *contents;
+    gchar *one_env;
+    gsize length;
+    gsize length_left;
+    gsize env_len;
+    gchar **env_split;
+    GDateTime *login = NULL;
+
+    if (!session->pid)
+        return;
+
+    /* Get initial environment of remote process. */
+    fname = g_strdup_printf ("/proc/%d/environ", session->pid);
+    if (!g_file_get_contents (fname, &contents, &length, NULL))
+    {
+        g_free (fname);
+        return;
+    }
+    g_free (fname);
+
+    /* Read each null-terminated string in contents */
+    one_env = contents;
+    length_left = length;
+    while (length_left > 0 && one_env[0] != '\0')
     {
-        struct netconf_session *nc_session = iter->data;
-        if (nc_session && session_id == nc_session->id)
+        if (g_str_has_prefix (one_env, "SSH_CLIENT"))
         {
-            ret = nc_session;
+            env_split = g_strsplit_set (one_env, "= ", 4);
+            if (env_split[0] == NULL || env_split[1] == NULL || env_split[2] == NULL ||
+                env_split[3] == NULL || env_split[4] != NULL)
+            {
+                g_strfreev (env_split);
+                goto cleanup;
+            }
+            session->rem_addr = g_strdup (env_split[1]);
+            session->rem_port = g_strdup (env_split[2]);
+            g_strfreev (env_split);
             break;
         }
+        env_len = strlen (one_env);
+        length_left -= env_len + 1;
+        one_env += env_len + 1;
     }
-    g_mutex_unlock (&session_lock);
 
-    return ret;
+    if (session->rem_addr)
+    {
+        /* Format the time the session was accepted */
+        login = g_date_time_new_from_unix_utc (session->connected / G_USEC_PER_SEC);
+        session->login_time = g_date_time_format (login, "%Y-%m-%dT%H:%M:%SZ%:z");
+        g_date_time_unref (login);
+    }
+    else
+        session->rem_addr = g_strdup ("unknown");
+
+cleanup:
+    g_free (contents);
+}
+
+/* Session data is read from the remote process by the session's own thread
+ * once the hello exchange is done, or earlier if it is needed first */
+static struct netconf_session *
+session_data (struct netconf_session *session)
+{
+    if (g_once_init_enter (&session->data_loaded))
+    {
+        add_session_data (session);
+        g_once_init_leave (&session->data_loaded, 1);
+    }
+    return session;
 }
 
 static xmlDoc*
@@ -384,22 +744,95 @@ create_rpc (xmlChar *type, xmlChar *msg_id)
     return doc;
 }
 
+/* Start tracing the next RPC of a session. Phases are only timed when slow
+ * RPCs are being logged. */
+static void
+rpc_trace_begin (struct netconf_session *session)
+{
+    struct rpc_trace *trace = &session->trace;
+
+    g_free (trace->filter);
+    memset (trace, 0, sizeof (*trace));
+    trace->enabled = (logging & LOG_SLOW_RPC);
+}
+
+/* The start time of a phase, or 0 if not tracing */
+static gint64
+rpc_trace_now (struct netconf_session *session)
+{
+    return session->trace.enabled ? g_get_monotonic_time () : 0;
+}
+
+static void
+rpc_trace_phase (struct netconf_session *session, enum rpc_phase phase, gint64 start)
+{
+    if (start)
+        session->trace.phases[phase] += g_get_monotonic_time () - start;
+}
+
+static gint64
+rpc_trace_total (struct netconf_session *session)
+{
+    gint64 total = 0;
+
+    for (unsigned int i = 0; i < RPC_PHASE_MAX; i++)
+        total += session->trace.phases[i];
+    return total;
+}
+
+/* Add the time since start that was not already counted against another phase */
+static void
+rpc_trace_remainder (struct netconf_session *session, enum rpc_phase phase, gint64 start,
+                     gint64 counted)
+{
+    if (start)
+        session->trace.phases[phase] += g_get_monotonic_time () - start -
+            (rpc_trace_total (session) - counted);
+}
+
+static void
+rpc_trace_filter (struct netconf_session *session, const char *filter)
+{
+    gchar *old = session->trace.filter;
+
+    if (!session->trace.enabled)
+        return;
+    session->trace.filter = old ? g_strdup_printf ("%s|%s", old, filter) : g_strdup (filter);
+    g_free (old);
+}
+
+/* Log the phase breakdown of an RPC that took longer than the threshold */
+static void
+rpc_trace_end (struct netconf_session *session, const char *rpc_name, uint32_t usec)
+{
+    struct rpc_trace *trace = &session->trace;
+    gint64 total;
+    GString *phases;
+
+    if (!trace->enabled)
+        return;
+    total = usec + trace->phases[RPC_PHASE_RECEIVE] + trace->phases[RPC_PHASE_PARSE];
+    if (total < (gint64) g_atomic_int_get (&netconf_slow_rpc) * 1000)
+        return;
+
+    phases = g_string_new (NULL);
+    for (unsigned int i = 0; i < RPC_PHASE_MAX; i++)
+        g_string_append_printf (phases, " %s:%" G_GINT64_FORMAT, rpc_phase_names[i], trace->phases[i]);
+    NOTICE ("SLOW-RPC: %s@%s id:%u %s %" G_GINT64_FORMAT "us in:%zu out:%zu%s filter:%.*s\n",
+            session->username, session_data (session)->rem_addr, session->id, rpc_name, total,
+            trace->in_bytes, trace->out_bytes, phases->str,
+            NETCONF_SLOW_RPC_FILTER_MAX, trace->filter ? trace->filter : "-");
+    g_string_free (phases, TRUE);
+}
+
+/* Send a message to the client using chunked framing */
 static bool
-send_rpc_ok (struct netconf_session *session, xmlNode * rpc, bool closing)
+send_message (struct netconf_session *session, const char *buf, int len, bool closing)
 {
-    xmlDoc *doc;
-    xmlChar *xmlbuff = NULL;
-    char *header = NULL;
-    int len;
+    char *header = g_strdup_printf ("\n#%d\n", len);
+    gint64 start = rpc_trace_now (session);
     bool ret = true;
 
-    /* Generate reply */
-    doc = create_rpc (BAD_CAST "rpc-reply", xmlGetProp (rpc, BAD_CAST "message-id"));
-    xmlNewChild (xmlDocGetRootElement (doc), NULL, BAD_CAST "ok", NULL);
-    xmlDocDumpMemoryEnc (doc, &xmlbuff, &len, "UTF-8");
-    header = g_strdup_printf ("\n#%d\n", len);
-
-    /* Send reply */
     if (write (session->fd, header, strlen (header)) != strlen (header))
     {
         if (!closing)
@@ -410,16 +843,16 @@ send_rpc_ok (struct netconf_session *session, xmlNode * rpc, bool closing)
         goto cleanup;
     }
     VERBOSE ("TX(%ld):\n%s", strlen (header), header);
-    if (write (session->fd, xmlbuff, len) != len)
+    if (write (session->fd, buf, len) != len)
     {
         if (!closing)
         {
-            ERROR ("TX failed: Sending %d bytes of hello\n", len);
+            ERROR ("TX failed: Sending %d bytes of message\n", len);
         }
         ret = false;
         goto cleanup;
     }
-    VERBOSE ("TX(%d):\n%.*s", len, len, (char *) xmlbuff);
+    VERBOSE ("TX(%d):\n%.*s", len, len, buf);
     if (write (session->fd, NETCONF_BASE_1_1_END, strlen (NETCONF_BASE_1_1_END)) !=
         strlen (NETCONF_BASE_1_1_END))
     {
@@ -432,9 +865,31 @@ send_rpc_ok (struct netconf_session *session, xmlNode * rpc, bool closing)
         goto cleanup;
     }
     VERBOSE ("TX(%ld):\n%s\n", strlen (NETCONF_BASE_1_1_END), NETCONF_BASE_1_1_END);
+    session->trace.out_bytes += strlen (header) + len + strlen (NETCONF_BASE_1_1_END);
+    session_count_message (session, false, len, 1);
 
   cleanup:
+    rpc_trace_phase (session, RPC_PHASE_SEND, start);
     g_free (header);
+    return ret;
+}
+
+static bool
+send_rpc_ok (struct netconf_session *session, xmlNode * rpc, bool closing)
+{
+    xmlDoc *doc;
+    xmlChar *xmlbuff = NULL;
+    int len;
+    bool ret;
+
+    /* Generate reply */
+    doc = create_rpc (BAD_CAST "rpc-reply", xmlGetProp (rpc, BAD_CAST "message-id"));
+    xmlNewChild (xmlDocGetRootElement (doc), NULL, BAD_CAST "ok", NULL);
+    xmlDocDumpMemoryEnc (doc, &xmlbuff, &len, "UTF-8");
+
+    /* Send reply */
+    ret = send_message (session, (const char *) xmlbuff, len, closing);
+
     xmlFree (xmlbuff);
     xmlFreeDoc (doc);
     return ret;
@@ -451,9 +906,8 @@ _send_rpc_error (struct netconf_session *session, xmlNode * rpc, nc_error_parms
     xmlNode *error_msg = NULL;
     xmlNode *error_info = NULL;
     xmlChar *xmlbuff = NULL;
-    char *header = NULL;
     int len;
-    bool ret = true;
+    bool ret;
 
     /* Generate reply */
     if (rpc)
@@ -484,41 +938,52 @@ _send_rpc_error (struct netconf_session *session, xmlNode * rpc, nc_error_parms
     }
 
     xmlDocDumpMemoryEnc (doc, &xmlbuff, &len, "UTF-8");
-    header = g_strdup_printf ("\n#%d\n", len);
 
     /* Send reply */
-    if (write (session->fd, header, strlen (header)) != strlen (header))
-    {
-        ERROR ("TX failed: Sending %ld bytes of header\n", strlen (header));
-        ret = false;
-        goto cleanup;
-    }
-    VERBOSE ("TX(%ld):\n%s", strlen (header), header);
-    if (write (session->fd, xmlbuff, len) != len)
-    {
-        ERROR ("TX failed: Sending %d bytes of hello\n", len);
-        ret = false;
-        goto cleanup;
-    }
-    VERBOSE ("TX(%d):\n%.*s", len, len, (char *) xmlbuff);
-    if (write (session->fd, NETCONF_BASE_1_1_END, strlen (NETCONF_BASE_1_1_END)) !=
-        strlen (NETCONF_BASE_1_1_END))
+    ret = send_message (session, (const char *) xmlbuff, len, false);
+    if (ret)
     {
-        ERROR ("TX failed: Sending %ld bytes of trailer\n", strlen (NETCONF_BASE_1_1_END));
-        ret = false;
-        goto cleanup;
+        g_atomic_int_inc (&session->counters.out_rpc_errors);
     }
-    VERBOSE ("TX(%ld):\n%s\n", strlen (NETCONF_BASE_1_1_END), NETCONF_BASE_1_1_END);
-    session->counters.out_rpc_errors++;
-    netconf_global_stats.session_totals.out_rpc_errors++;
 
-  cleanup:
-    g_free (header);
     xmlFree (xmlbuff);
     xmlFreeDoc (doc);
     return ret;
 }
 
+/* Whether a datastore is locked, and by which session. Lock state is only
+ * accessed with the datastore lock mutex held. */
+static bool
+lock_state (struct _ds_lock_t *ds_lock, uint32_t *holder)
+{
+    bool locked;
+
+    g_mutex_lock (&ds_lock_mutex);
+    locked = ds_lock->locked;
+    if (holder)
+        *holder = locked ? ds_lock->nc_sess.id : 0;
+    g_mutex_unlock (&ds_lock_mutex);
+    return locked;
+}
+
+/* True if a datastore is locked by a session other than the given one */
+static bool
+lock_held_by_other (struct _ds_lock_t *ds_lock, struct netconf_session *session)
+{
+    uint32_t holder;
+
+    return lock_state (ds_lock, &holder) && holder != session->id;
+}
+
+/* True if a datastore is locked by the given session */
+static bool
+lock_held_by (struct _ds_lock_t *ds_lock, struct netconf_session *session)
+{
+    uint32_t holder;
+
+    return lock_state (ds_lock, &holder) && holder == session->id;
+}
+
 /**
  * Fully parameterised send_rpc_error. This can be used to send a variety of RPC error types, depending
  * on what is passed in. Parameters session, rpc, err_tag, err_type and error_msg are mandatory, the rest are
@@ -539,7 +1004,10 @@ send_rpc_error_full (struct netconf_session *session, xmlNode *rpc, NC_ERR_TAG e
     error_parms.type = err_type;
     if (!bad_elem && !no_info)
     {
-        gchar *sess_id_str = g_strdup_printf ("%u", running_ds_lock.nc_sess.id);
+        uint32_t holder = 0;
+
+        lock_state (&running_ds_lock, &holder);
+        gchar *sess_id_str = g_strdup_printf ("%u", holder);
         g_hash_table_insert (error_parms.info, "session-id", sess_id_str);
         /* No need to free, hash table cleanup will do that */
     }
@@ -563,68 +1031,87 @@ send_rpc_error_full (struct netconf_session *session, xmlNode *rpc, NC_ERR_TAG e
     return ret;
 }
 
+/* Send a lock-denied or in-use error reporting the session holding the given datastore lock */
 static bool
-send_rpc_data (struct netconf_session *session, xmlNode * rpc, GList *xml_list)
+send_rpc_error_lock (struct netconf_session *session, xmlNode *rpc, NC_ERR_TAG err_tag, NC_ERR_TYPE err_type,
+                     gchar *error_msg, struct _ds_lock_t *ds_lock)
 {
-    xmlDoc *doc;
-    xmlNode * data;
-    xmlNode *child;
-    xmlChar *xmlbuff;
-    GList *list;
-    char *header = NULL;
-    int len;
-    bool ret = true;
+    nc_error_parms error_parms = NC_ERROR_PARMS_INIT;
+    uint32_t holder = 0;
+    bool ret = false;
 
-    /* Generate reply */
-    doc = create_rpc ( BAD_CAST "rpc-reply", xmlGetProp (rpc, BAD_CAST "message-id"));
-    child = xmlNewChild (xmlDocGetRootElement (doc), NULL, BAD_CAST "data", NULL);
-    if (!xml_list)
-    {
-        xmlAddChildList (child, NULL);
-    }
-    else
+    error_parms.tag = err_tag;
+    error_parms.type = err_type;
+    lock_state (ds_lock, &holder);
+    g_hash_table_insert (error_parms.info, "session-id", g_strdup_printf ("%u", holder));
+    if (error_msg)
     {
-        for (list = g_list_first (xml_list); list; list = g_list_next (list))
-        {
-            data = list->data;
-            xmlAddChildList (child, data);
-        }
+        g_string_printf (error_parms.msg, "%s", error_msg);
+        ERROR ("%s\n", error_msg);
     }
+    ret = _send_rpc_error (session, rpc, error_parms);
+    _free_error_parms (error_parms);
+    return ret;
+}
 
-    xmlDocDumpMemoryEnc (doc, &xmlbuff, &len, "UTF-8");
-    header = g_strdup_printf ("\n#%d\n", len);
+/* Serialise the <data> element of a reply containing the given results */
+static char *
+rpc_data_to_string (GList *xml_list)
+{
+    xmlDoc *doc;
+    xmlNode *data;
+    GList *list;
+    xmlBuffer *buffer;
+    xmlSaveCtxt *save;
+    char *body;
 
-    /* Send reply */
-    if (write (session->fd, header, strlen (header)) != strlen (header))
-    {
-        ERROR ("TX failed: Sending %ld bytes of header\n", strlen (header));
-        ret = false;
-        goto cleanup;
-    }
-    VERBOSE ("TX(%ld):\n%s", strlen (header), header);
-    if (write (session->fd, xmlbuff, len) != len)
-    {
-        ERROR ("TX failed: Sending %d bytes of hello\n", len);
-        ret = false;
-        goto cleanup;
-    }
-    VERBOSE ("TX(%d):\n%.*s", len, len, (char *) xmlbuff);
-    if (write (session->fd, NETCONF_BASE_1_1_END, strlen (NETCONF_BASE_1_1_END)) !=
-        strlen (NETCONF_BASE_1_1_END))
+    doc = create_rpc (BAD_CAST "rpc-reply", NULL);
+    data = xmlNewChild (xmlDocGetRootElement (doc), NULL, BAD_CAST "data", NULL);
+    for (list = g_list_first (xml_list); list; list = g_list_next (list))
     {
-        ERROR ("TX failed: Sending %ld bytes of trailer\n", strlen (NETCONF_BASE_1_1_END));
-        ret = false;
-        goto cleanup;
+        xmlAddChildList (data, list->data);
     }
-    VERBOSE ("TX(%ld):\n%s\n", strlen (NETCONF_BASE_1_1_END), NETCONF_BASE_1_1_END);
 
-  cleanup:
-    g_free (header);
-    xmlFree (xmlbuff);
+    buffer = xmlBufferCreate ();
+    save = xmlSaveToBuffer (buffer, "UTF-8", XML_SAVE_NO_DECL);
+    xmlSaveTree (save, data);
+    xmlSaveClose (save);
+    body = g_strdup ((const char *) xmlBufferContent (buffer));
+    xmlBufferFree (buffer);
     xmlFreeDoc (doc);
     if (xml_list)
         g_list_free (xml_list);
 
+    return body;
+}
+
+/* Send an rpc-reply wrapped around an already serialised <data> element */
+static bool
+send_rpc_data_string (struct netconf_session *session, xmlNode * rpc, const char *data)
+{
+    xmlChar *msg_id = xmlGetProp (rpc, BAD_CAST "message-id");
+    char *attr = msg_id ? g_markup_printf_escaped (" message-id=\"%s\"", (char *) msg_id) : NULL;
+    char *reply;
+    bool ret;
+
+    reply = g_strdup_printf ("<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n"
+                             "<nc:rpc-reply xmlns:nc=\"urn:ietf:params:xml:ns:netconf:base:1.0\"%s>"
+                             "%s</nc:rpc-reply>\n", attr ? attr : "", data);
+    ret = send_message (session, reply, strlen (reply), false);
+
+    g_free (reply);
+    g_free (attr);
+    xmlFree (msg_id);
+    return ret;
+}
+
+static bool
+send_rpc_data (struct netconf_session *session, xmlNode * rpc, GList *xml_list)
+{
+    char *data = rpc_data_to_string (xml_list);
+    bool ret = send_rpc_data_string (session, rpc, data);
+
+    g_free (data);
     return ret;
 }
 
@@ -840,6 +1327,16 @@ send_hello (struct netconf_session *session)
     xmlNodeSetContent (child,
                        BAD_CAST "urn:ietf:params:netconf:capability:writable-running:1.0");
     child = xmlNewChild (node, NULL, BAD_CAST "capability", NULL);
+    xmlNodeSetContent (child, BAD_CAST "urn:ietf:params:netconf:capability:candidate:1.0");
+    child = xmlNewChild (node, NULL, BAD_CAST "capability", NULL);
+    xmlNodeSetContent (child, BAD_CAST "urn:ietf:params:netconf:capability:confirmed-commit:1.1");
+    child = xmlNewChild (node, NULL, BAD_CAST "capability", NULL);
+    xmlNodeSetContent (child, BAD_CAST "urn:ietf:params:netconf:capability:validate:1.1");
+    child = xmlNewChild (node, NULL, BAD_CAST "capability", NULL);
+    xmlNodeSetContent (child, BAD_CAST "urn:ietf:params:netconf:capability:rollback-on-error:1.0");
+    child = xmlNewChild (node, NULL, BAD_CAST "capability", NULL);
+    xmlNodeSetContent (child, BAD_CAST "urn:ietf:params:netconf:capability:partial-lock:1.0");
+    child = xmlNewChild (node, NULL, BAD_CAST "capability", NULL);
     xmlNodeSetContent (child,
                        BAD_CAST "urn:ietf:params:netconf:capability:with-defaults:1.0?basic-mode=explicit&amp;also-supported=report-all,trim");
     /* Find all models in the entire tree */
@@ -1297,180 +1794,1696 @@ merge_gnode_trees (GNode *tree1, GNode *tree2)
     }
 }
 
-static bool
-get_query_to_xml (struct netconf_session *session, xmlNode *rpc, GNode *query,
-                  int rdepth, char *path, char **ns_href,
-                  char **ns_prefix, xpath_type x_type, int schflags,
-                  bool is_subtree, bool is_filter, GList **xml_list)
+/* Return the match value of a subtree content match node (a leaf with a single
+ * value and nothing below it), or NULL if the node is only a selection. */
+static const char *
+query_content_match_value (GNode *node)
 {
-    GNode *tree = NULL;
-    GNode *query_defaults = NULL;
-    xmlNode *xml = NULL;
+    GNode *value = node->children;
 
-    /* Query database */
-    DEBUG ("NETCONF: GET %s\n", query ? APTERYX_NAME (query) : "/");
-    if (((logging & LOG_GET) && !(schflags & SCH_F_CONFIG)) ||
-        ((logging & LOG_GET_CONFIG) && (schflags & SCH_F_CONFIG)))
+    if (node->data && value && !value->next && value->data && !value->children &&
+        g_strcmp0 (APTERYX_NAME (value), "*") != 0)
     {
-        GString *qpath = g_string_new ("./");
-        GList *paths = generate_apteryx_query_node_paths (query, qpath, NULL);
-        for (GList *iter = paths; iter; iter = iter->next)
-            NOTICE ("%s: %s@%s id:%u path:%s\n",
-                    (schflags & SCH_F_CONFIG) ? "GET-CONFIG" : "GET",
-                    session->username, session->rem_addr, session->id,
-                    (gchar*) iter->data);
-
-        g_list_free_full (paths, g_free);
-        g_string_free (qpath, TRUE);
+        return APTERYX_NAME (value);
     }
+    return NULL;
+}
 
-    if (query)
+static bool
+query_has_content_match (GNode *node)
+{
+    GNode *child;
+
+    for (child = node->children; child; child = child->next)
     {
-        if (is_subtree)
-            tree = apteryx_query_full (query);
-        else
-            tree = apteryx_query (query);
+        if (query_content_match_value (child))
+            return true;
     }
-    else if (!is_filter)
-        tree = get_full_tree ();
+    return false;
+}
 
-    if (schflags & SCH_F_ADD_DEFAULTS)
+/* Replace a wildcard list entry in a subtree query with a copy for each list
+ * entry whose leaves match all of the content match nodes of the wildcard. */
+static void
+query_select_matching_entries (GNode *list, GNode *wildcard, const char *path)
+{
+    char *search = g_strdup_printf ("%s/", path);
+    GList *entries = apteryx_search (search);
+    GList *iter;
+    GNode *child;
+    GNode *copy;
+    int total = 0;
+    int selected = 0;
+
+    for (iter = entries; iter; iter = iter->next)
     {
-        if (tree)
+        const char *entry = (const char *) iter->data;
+        const char *key = strrchr (entry, '/');
+        bool match = true;
+
+        if (!key || !*(key + 1))
+            continue;
+        key++;
+        total++;
+
+        for (child = wildcard->children; child && match; child = child->next)
         {
-            sch_traverse_tree (g_schema, NULL, tree, schflags | SCH_F_FILTER_RDEPTH, rdepth);
-            query_defaults = query;
-            g_node_traverse (query_defaults, G_IN_ORDER, G_TRAVERSE_LEAVES, -1, remove_null_data, NULL);
-            query = NULL;
-            sch_traverse_tree (g_schema, NULL, query_defaults, schflags | SCH_F_FILTER_RDEPTH, rdepth);
+            const char *value = query_content_match_value (child);
+            if (value)
+            {
+                char *leaf_path = g_strdup_printf ("%s/%s", entry, APTERYX_NAME (child));
+                char *current = apteryx_get (leaf_path);
+                match = (g_strcmp0 (current, value) == 0);
+                free (current);
+                g_free (leaf_path);
+            }
+        }
 
-            /* Merge the results of the search result tree with defaults and the query with defaults */
-            merge_gnode_trees (tree, query_defaults);
+        if (match)
+        {
+            copy = g_node_copy_deep (wildcard, copy_node_data, NULL);
+            g_free (copy->data);
+            copy->data = g_strdup (key);
+            g_node_insert_before (list, wildcard, copy);
+            selected++;
         }
-        else
+    }
+    DEBUG ("NETCONF: content match %s selected %d of %d entries\n", path, selected, total);
+
+    g_node_unlink (wildcard);
+    apteryx_free_tree (wildcard);
+    g_list_free_full (entries, free);
+    g_free (search);
+}
+
+/* Narrow any list wildcards in a subtree query that carry content match nodes
+ * down to the matching list entries, so the database is only asked for those. */
+static void
+query_prescan_content_match (GNode *node, const char *path)
+{
+    GNode *child;
+    GNode *next;
+
+    for (child = node->children; child; child = next)
+    {
+        next = child->next;
+        if (child->data && g_strcmp0 (APTERYX_NAME (child), "*") == 0 &&
+            query_has_content_match (child))
         {
-            /* Nothing in the database, but we may have defaults! */
-            tree = query;
-            g_node_traverse (tree, G_IN_ORDER, G_TRAVERSE_LEAVES, -1, remove_null_data, NULL);
-            query = NULL;
-            sch_traverse_tree (g_schema, NULL, tree, schflags | SCH_F_FILTER_RDEPTH, rdepth);
+            query_select_matching_entries (node, child, path);
         }
     }
 
-    if (tree && (schflags & SCH_F_TRIM_DEFAULTS))
-        sch_traverse_tree (g_schema, NULL, tree, schflags | SCH_F_FILTER_RDEPTH, rdepth);
+    for (child = node->children; child; child = child->next)
+    {
+        char *cpath;
 
-    apteryx_free_tree (query);
+        if (!child->data || !child->children)
+            continue;
+        if (g_str_has_suffix (path, "/"))
+            cpath = g_strdup_printf ("%s%s", path, APTERYX_NAME (child));
+        else
+            cpath = g_strdup_printf ("%s/%s", path, APTERYX_NAME (child));
+        query_prescan_content_match (child, cpath);
+        g_free (cpath);
+    }
+}
 
-    /* Convert result to XML */
-    xml = tree ? sch_gnode_to_xml (g_schema, NULL, tree, schflags) : NULL;
-    apteryx_free_tree (tree);
+struct proxy_fanout;
 
-    if (xml && x_type == XPATH_EVALUATE)
-        return xpath_evaluate (session, rpc, path, ns_href, ns_prefix, xml, schflags, xml_list);
-    else
-        *xml_list = g_list_append (*xml_list, xml);
-    return true;
+struct proxy_job
+{
+    char *target;
+    GNode *query;
+    GNode *result;
+    bool full;
+    bool read_only;
+    bool done;
+    bool timed_out;
+    char *cache_key;
+    struct proxy_fanout *fanout;
+};
+
+struct proxy_fanout
+{
+    gint refcount;
+    GMutex lock;
+    GCond cond;
+    int pending;
+    GList *jobs;
+};
+
+static void
+proxy_job_free (struct proxy_job *job)
+{
+    apteryx_free_tree (job->query);
+    apteryx_free_tree (job->result);
+    g_free (job->cache_key);
+    g_free (job->target);
+    g_free (job);
 }
 
-static bool
-get_query_schema (struct netconf_session *session, xmlNode *rpc, GNode *query,
-                  sch_node *qschema, char *path, char **ns_href, char **ns_prefix, xpath_type x_type,
-                  int schflags, bool is_filter, bool is_subtree, GList **xml_list)
+static void
+proxy_fanout_unref (struct proxy_fanout *fanout)
 {
-    GNode *qnode = NULL;
-    int qdepth = 0;
+    if (g_atomic_int_dec_and_test (&fanout->refcount))
+    {
+        g_list_free_full (fanout->jobs, (GDestroyNotify) proxy_job_free);
+        g_mutex_clear (&fanout->lock);
+        g_cond_clear (&fanout->cond);
+        g_free (fanout);
+    }
+}
 
-    /* Get the depth of the response which is the depth of the query
-        OR the up until the first path wildcard */
-    qdepth = g_node_max_height (query);
-    if (is_subtree && qdepth)
-        qdepth--;
+static struct proxy_stats *
+proxy_stats_get (const char *target)
+{
+    struct proxy_stats *stats = g_hash_table_lookup (proxy_stats_table, target);
 
-    qnode = query;
-    while (qnode &&
-            g_node_n_children (qnode) == 1 &&
-            g_strcmp0 (APTERYX_NAME (g_node_first_child (qnode)), "*") != 0)
+    if (!stats)
     {
-        qnode = g_node_first_child (qnode);
+        stats = g_malloc0 (sizeof (struct proxy_stats));
+        g_hash_table_insert (proxy_stats_table, g_strdup (target), stats);
     }
+    return stats;
+}
 
-    while (qnode && qnode->children && qnode->children->data)
-        qnode = qnode->children;
+static void
+proxy_stats_update (const char *target, uint64_t latency, bool timeout, bool cache_hit)
+{
+    struct proxy_stats *stats;
+
+    g_mutex_lock (&proxy_lock);
+    stats = proxy_stats_get (target);
+    stats->requests++;
+    if (timeout)
+        stats->timeouts++;
+    else if (cache_hit)
+        stats->cache_hits++;
+    else
+    {
+        stats->last_latency = latency;
+        stats->total_latency += latency;
+        if (latency > stats->max_latency)
+            stats->max_latency = latency;
+    }
+    g_mutex_unlock (&proxy_lock);
+}
 
-    if (qdepth && qnode && g_strcmp0 (APTERYX_NAME (qnode), "*") == 0)
-        qdepth--;
+static void
+proxy_cache_entry_free (struct proxy_cache_entry *entry)
+{
+    apteryx_free_tree (entry->tree);
+    g_free (entry);
+}
 
-    /* Without a query we may need to add a wildcard to get everything from here down */
-    if (is_filter && qnode && qdepth == g_node_max_height (query) &&
-        !(schflags & SCH_F_DEPTH_ONE))
+static gboolean
+proxy_cache_entry_expired (gpointer key, gpointer value, gpointer now)
+{
+    struct proxy_cache_entry *entry = value;
+
+    return entry->expires <= *(gint64 *) now;
+}
+
+static char *
+proxy_cache_key (struct proxy_job *job)
+{
+    GString *key = g_string_new (job->full ? "full:" : "query:");
+    GString *qpath = g_string_new ("");
+    GList *paths = generate_apteryx_query_node_paths (job->query, qpath, NULL);
+
+    for (GList *iter = paths; iter; iter = iter->next)
+        g_string_append_printf (key, "%s;", (char *) iter->data);
+    g_list_free_full (paths, g_free);
+    g_string_free (qpath, TRUE);
+    return g_string_free (key, FALSE);
+}
+
+static bool
+proxy_cache_lookup (const char *key, GNode **tree)
+{
+    struct proxy_cache_entry *entry;
+    bool found = false;
+
+    g_mutex_lock (&proxy_lock);
+    entry = proxy_cache ? g_hash_table_lookup (proxy_cache, key) : NULL;
+    if (entry && entry->expires > g_get_monotonic_time ())
     {
-        if (qschema && sch_node_child_first (qschema) && !(schflags & SCH_F_STRIP_DATA))
-        {
-            /* Get everything from here down if we do not already have a star */
-            if (!g_node_first_child (qnode) && g_strcmp0 (APTERYX_NAME (qnode), "*") != 0)
-            {
-                APTERYX_NODE (qnode, g_strdup ("*"));
-                DEBUG ("%*s%s\n", qdepth * 2, " ", "*");
-            }
-        }
+        *tree = entry->tree ? g_node_copy_deep (entry->tree, copy_node_data, NULL) : NULL;
+        found = true;
     }
+    g_mutex_unlock (&proxy_lock);
+    return found;
+}
 
-    return get_query_to_xml (session, rpc, query, qdepth, path, ns_href,
-                             ns_prefix, x_type, schflags, is_subtree, true, xml_list);
+static void
+proxy_cache_store (const char *key, GNode *tree)
+{
+    struct proxy_cache_entry *entry;
+    gint64 now = g_get_monotonic_time ();
+
+    g_mutex_lock (&proxy_lock);
+    if (proxy_cache && netconf_proxy_cache_ttl)
+    {
+        if (g_hash_table_size (proxy_cache) >= NETCONF_PROXY_CACHE_MAX)
+            g_hash_table_foreach_remove (proxy_cache, proxy_cache_entry_expired, &now);
+        if (g_hash_table_size (proxy_cache) >= NETCONF_PROXY_CACHE_MAX)
+            g_hash_table_remove_all (proxy_cache);
+        entry = g_malloc0 (sizeof (struct proxy_cache_entry));
+        entry->tree = tree ? g_node_copy_deep (tree, copy_node_data, NULL) : NULL;
+        entry->expires = now + (gint64) netconf_proxy_cache_ttl * 1000;
+        g_hash_table_replace (proxy_cache, g_strdup (key), entry);
+    }
+    g_mutex_unlock (&proxy_lock);
 }
 
 static void
-cleanup_on_xpath_error (struct netconf_session *session, char *attr, gchar **split,
-                        char *ns_href, char *ns_prefix, char *path)
+proxy_job_run (gpointer data, gpointer user_data)
 {
-    free (attr);
-    g_strfreev(split);
-    g_free (ns_href);
-    g_free (ns_prefix);
-    g_free (path);
-    session->counters.in_bad_rpcs++;
-    netconf_global_stats.session_totals.in_bad_rpcs++;
+    struct proxy_job *job = data;
+    struct proxy_fanout *fanout = job->fanout;
+    gint64 start = g_get_monotonic_time ();
+    GNode *result = NULL;
+    bool timed_out;
+
+    /* Nobody is waiting for a job that timed out while it was queued */
+    g_mutex_lock (&fanout->lock);
+    timed_out = job->timed_out;
+    g_mutex_unlock (&fanout->lock);
+    if (!timed_out)
+    {
+        result = job->full ? apteryx_query_full (job->query) : apteryx_query (job->query);
+        if (job->read_only)
+            proxy_cache_store (job->cache_key, result);
+    }
+
+    g_mutex_lock (&fanout->lock);
+    job->result = result;
+    job->done = true;
+    fanout->pending--;
+    timed_out = job->timed_out;
+    g_cond_signal (&fanout->cond);
+    g_mutex_unlock (&fanout->lock);
+
+    /* A timed out request has already been counted */
+    if (!timed_out)
+        proxy_stats_update (job->target, g_get_monotonic_time () - start, false, false);
+    proxy_fanout_unref (fanout);
 }
 
-static int
-get_process_action (struct netconf_session *session, xmlNode *rpc, xmlNode *node,
-                    int schflags, GList **xml_list, bool *filter_seen, bool *ret)
+/* Find the schema node for a query node name, which may carry a namespace prefix */
+static sch_node *
+query_schema_child (sch_node *schema, const char *name)
 {
-    char *attr;
-    xmlNode *tnode;
-    GNode *query = NULL;
-    gchar **split;
-    sch_xml_to_gnode_parms parms;
-    sch_node *qschema = NULL;
-    bool is_filter = false;
-    int i;
-    int count;
+    const char *colon;
+    sch_ns *ns = NULL;
 
-    /* Check the requested datastore */
-    if (g_strcmp0 ((char *) node->name, "source") == 0)
+    if (!schema)
     {
-        if (!xmlFirstElementChild (node) ||
-            g_strcmp0 ((char *) xmlFirstElementChild (node)->name, "running") != 0)
-        {
-            gchar *error_msg = g_strdup_printf ("Datastore \"%s\" not supported",
-                                                (char *) xmlFirstElementChild (node)->name);
-            VERBOSE ("%s\n", error_msg);
-            *ret = send_rpc_error_full (session, rpc, NC_ERR_TAG_OPR_NOT_SUPPORTED, NC_ERR_TYPE_PROTOCOL,
-                                        error_msg, NULL, NULL, true);
-            g_free (error_msg);
-            return -1;
-        }
+        schema = sch_get_root_schema (g_schema);
+        if (name[0] == '/')
+            name++;
     }
-    /* Parse any filters */
-    else if (g_strcmp0 ((char *) node->name, "filter") == 0)
+    else if (sch_is_list (schema))
+        return sch_node_child_first (schema);
+
+    colon = strchr (name, ':');
+    if (colon)
     {
-        *filter_seen = true;
-        attr = (char *) xmlGetProp (node, BAD_CAST "type");
+        char *prefix = g_strndup (name, colon - name);
+        ns = sch_lookup_ns (g_schema, schema, prefix, 0, false);
+        g_free (prefix);
+        if (ns)
+            name = colon + 1;
+    }
+    return sch_ns_node_child (ns, schema, name);
+}
 
-        /* Default type is "subtree" */
-        if (attr == NULL)
-        {
+/* Build a query tree for a path, returning the deepest node in leaf */
+static GNode *
+query_from_path (const char *path, GNode **leaf)
+{
+    gchar **parts = g_strsplit (path + 1, "/", -1);
+    GNode *root = NULL;
+    GNode *node = NULL;
+
+    for (int i = 0; parts[i]; i++)
+    {
+        if (!root)
+            root = node = APTERYX_NODE (NULL, g_strdup_printf ("/%s", parts[i]));
+        else
+            node = APTERYX_NODE (node, g_strdup (parts[i]));
+    }
+    g_strfreev (parts);
+    *leaf = node;
+    return root;
+}
+
+static void
+query_add_proxy_job (struct proxy_fanout *fanout, const char *target,
+                     GList *remote, bool full, bool read_only)
+{
+    struct proxy_job *job = g_malloc0 (sizeof (struct proxy_job));
+    GNode *leaf = NULL;
+
+    job->target = g_strdup (target);
+    job->query = query_from_path (target, &leaf);
+    for (GList *iter = remote; iter; iter = iter->next)
+        g_node_append (leaf, g_node_copy_deep (iter->data, copy_node_data, NULL));
+    job->full = full;
+    job->read_only = read_only;
+    job->fanout = fanout;
+    fanout->jobs = g_list_append (fanout->jobs, job);
+}
+
+/* Move the parts of a query that are served by proxied databases into a job
+ * per proxy target. Returns true if the node was emptied by doing so. */
+static bool
+query_split_proxies (struct proxy_fanout *fanout, GNode *node, sch_node *schema,
+                     const char *path, bool full)
+{
+    GList *remote = NULL;
+    GNode *child;
+    GNode *next;
+    bool had_children = node->children != NULL;
+
+    if (sch_is_proxy (schema))
+    {
+        /* Children that are not part of the proxy node itself are remote */
+        for (child = node->children; child; child = child->next)
+        {
+            if (child->data && !query_schema_child (schema, APTERYX_NAME (child)))
+                remote = g_list_append (remote, child);
+        }
+        if (!remote)
+            return false;
+
+        if (g_strcmp0 (APTERYX_NAME (node), "*") == 0)
+        {
+            char *search = g_strndup (path, strlen (path) - 1);
+            GList *entries = apteryx_search (search);
+
+            for (GList *iter = entries; iter; iter = iter->next)
+                query_add_proxy_job (fanout, (const char *) iter->data, remote, full,
+                                     sch_is_read_only_proxy (schema));
+            g_list_free_full (entries, free);
+            g_free (search);
+        }
+        else
+        {
+            query_add_proxy_job (fanout, path, remote, full, sch_is_read_only_proxy (schema));
+        }
+
+        for (GList *iter = remote; iter; iter = iter->next)
+        {
+            g_node_unlink (iter->data);
+            apteryx_free_tree (iter->data);
+        }
+        g_list_free (remote);
+        return node->children == NULL;
+    }
+
+    for (child = node->children; child; child = next)
+    {
+        sch_node *cschema;
+        char *cpath;
+
+        next = child->next;
+        if (!child->data || !child->children)
+            continue;
+        cschema = query_schema_child (schema, APTERYX_NAME (child));
+        if (!cschema || sch_is_leaf (cschema))
+            continue;
+
+        cpath = g_strdup_printf ("%s/%s", path, APTERYX_NAME (child));
+        if (query_split_proxies (fanout, child, cschema, cpath, full))
+        {
+            g_node_unlink (child);
+            apteryx_free_tree (child);
+        }
+        g_free (cpath);
+    }
+    return had_children && node->children == NULL;
+}
+
+/* Query the database, issuing the parts of the query that are served by
+ * proxied databases concurrently. Targets that do not answer within the proxy
+ * timeout are left out of the result. */
+static GNode *
+query_with_proxies (GNode *query, bool full)
+{
+    struct proxy_fanout *fanout;
+    GNode *local;
+    GNode *tree = NULL;
+    GNode *result;
+    sch_node *schema;
+    gint64 deadline;
+
+    schema = query_schema_child (NULL, APTERYX_NAME (query));
+    if (!schema || !proxy_workers)
+        return full ? apteryx_query_full (query) : apteryx_query (query);
+
+    fanout = g_malloc0 (sizeof (struct proxy_fanout));
+    fanout->refcount = 1;
+    g_mutex_init (&fanout->lock);
+    g_cond_init (&fanout->cond);
+
+    local = g_node_copy_deep (query, copy_node_data, NULL);
+    if (query_split_proxies (fanout, local, schema, APTERYX_NAME (local), full))
+    {
+        apteryx_free_tree (local);
+        local = NULL;
+    }
+
+    if (!fanout->jobs)
+    {
+        proxy_fanout_unref (fanout);
+        apteryx_free_tree (local);
+        return full ? apteryx_query_full (query) : apteryx_query (query);
+    }
+
+    /* Start the remote queries, answering read-only proxies from the cache where we can */
+    for (GList *iter = fanout->jobs; iter; iter = iter->next)
+    {
+        struct proxy_job *job = iter->data;
+
+        if (job->read_only)
+        {
+            job->cache_key = proxy_cache_key (job);
+            if (proxy_cache_lookup (job->cache_key, &job->result))
+            {
+                job->done = true;
+                proxy_stats_update (job->target, 0, false, true);
+                continue;
+            }
+        }
+        g_mutex_lock (&fanout->lock);
+        fanout->pending++;
+        g_mutex_unlock (&fanout->lock);
+        g_atomic_int_inc (&fanout->refcount);
+        g_thread_pool_push (proxy_workers, job, NULL);
+    }
+
+    /* Local query runs while we wait for the remote ones */
+    deadline = g_get_monotonic_time () + (gint64) netconf_proxy_timeout * 1000;
+    if (local)
+        tree = full ? apteryx_query_full (local) : apteryx_query (local);
+
+    g_mutex_lock (&fanout->lock);
+    while (fanout->pending)
+    {
+        if (!g_cond_wait_until (&fanout->cond, &fanout->lock, deadline))
+            break;
+    }
+    for (GList *iter = fanout->jobs; iter; iter = iter->next)
+    {
+        struct proxy_job *job = iter->data;
+
+        if (!job->done)
+        {
+            ERROR ("NETCONF: proxy query to %s timed out\n", job->target);
+            job->timed_out = true;
+            proxy_stats_update (job->target, 0, true, false);
+            continue;
+        }
+        result = job->result;
+        job->result = NULL;
+        if (!result)
+            continue;
+        if (!tree)
+            tree = result;
+        else
+            merge_gnode_trees (tree, result);
+    }
+    g_mutex_unlock (&fanout->lock);
+
+    proxy_fanout_unref (fanout);
+    apteryx_free_tree (local);
+    return tree;
+}
+
+/* True if nothing in a schema subtree is writable */
+static bool
+schema_is_state_only (sch_node *schema)
+{
+    if (sch_is_proxy (schema))
+        return false;
+    if (sch_is_leaf (schema))
+        return !sch_is_writable (schema);
+    for (sch_node *child = sch_node_child_first (schema); child; child = sch_node_next_sibling (child))
+    {
+        if (!schema_is_state_only (child))
+            return false;
+    }
+    return true;
+}
+
+/* Copy the parts of a data tree selected by a query tree */
+static GNode *
+query_tree_filter (GNode *query, GNode *data)
+{
+    GNode *copy;
+    GNode *qchild;
+    GNode *dchild;
+    GNode *result;
+
+    /* A query node with nothing below it selects everything from here down */
+    if (!query->children || !query->children->data)
+        return g_node_copy_deep (data, copy_node_data, NULL);
+
+    copy = APTERYX_NODE (NULL, g_strdup (APTERYX_NAME (data)));
+    for (dchild = data->children; dchild; dchild = dchild->next)
+    {
+        for (qchild = query->children; qchild; qchild = qchild->next)
+        {
+            if (qchild->data && (g_strcmp0 (APTERYX_NAME (qchild), "*") == 0 ||
+                                 g_strcmp0 (APTERYX_NAME (qchild), APTERYX_NAME (dchild)) == 0))
+            {
+                result = query_tree_filter (qchild, dchild);
+                if (result)
+                    g_node_append (copy, result);
+                break;
+            }
+        }
+    }
+    if (!copy->children)
+    {
+        apteryx_free_tree (copy);
+        return NULL;
+    }
+    return copy;
+}
+
+static bool
+query_has_content_match_below (GNode *node)
+{
+    if (query_content_match_value (node))
+        return true;
+    for (GNode *child = node->children; child; child = child->next)
+    {
+        if (query_has_content_match_below (child))
+            return true;
+    }
+    return false;
+}
+
+static void
+state_cache_entry_free (struct state_cache_entry *entry)
+{
+    apteryx_free_tree (entry->tree);
+    g_free (entry);
+}
+
+/* Return a copy of the operational subtree at path, sharing one database
+ * fetch between all requests made within the lifetime of the entry */
+static GNode *
+state_cache_get (const char *path, uint32_t ttl)
+{
+    struct state_cache_entry *entry;
+    GNode *tree;
+
+    g_mutex_lock (&state_cache_lock);
+    if (!state_cache)
+    {
+        g_mutex_unlock (&state_cache_lock);
+        return apteryx_get_tree (path);
+    }
+
+    /* Look the entry up again after waiting as it may have been dropped */
+    while (true)
+    {
+        entry = g_hash_table_lookup (state_cache, path);
+        if (!entry)
+        {
+            entry = g_malloc0 (sizeof (struct state_cache_entry));
+            g_hash_table_insert (state_cache, g_strdup (path), entry);
+        }
+        if (!entry->fetching)
+            break;
+        g_cond_wait (&state_cache_cond, &state_cache_lock);
+    }
+
+    if (entry->expires <= g_get_monotonic_time ())
+    {
+        entry->fetching = true;
+        g_mutex_unlock (&state_cache_lock);
+        tree = apteryx_get_tree (path);
+        g_mutex_lock (&state_cache_lock);
+        apteryx_free_tree (entry->tree);
+        entry->tree = tree;
+        entry->expires = g_get_monotonic_time () + (gint64) ttl * 1000;
+        entry->fetching = false;
+        g_cond_broadcast (&state_cache_cond);
+        DEBUG ("NETCONF: cache refreshed %s\n", path);
+    }
+    tree = entry->tree ? g_node_copy_deep (entry->tree, copy_node_data, NULL) : NULL;
+    g_mutex_unlock (&state_cache_lock);
+    return tree;
+}
+
+static uint32_t
+state_cache_ttl (const char *path)
+{
+    uint32_t ttl = 0;
+
+    g_mutex_lock (&state_cache_lock);
+    if (state_cache_ttls)
+        ttl = GPOINTER_TO_UINT (g_hash_table_lookup (state_cache_ttls, path));
+    g_mutex_unlock (&state_cache_lock);
+    return ttl;
+}
+
+/* Move the parts of a query that have a cache lifetime configured into the
+ * cached list. Returns true if the node was emptied by doing so. */
+static bool
+query_split_cached (GNode *node, sch_node *schema, const char *path, GList **cached)
+{
+    GNode *child;
+    GNode *next;
+    bool had_children = node->children != NULL;
+
+    for (child = node->children; child; child = next)
+    {
+        sch_node *cschema;
+        char *cpath;
+
+        next = child->next;
+        if (!child->data || g_strcmp0 (APTERYX_NAME (child), "*") == 0)
+            continue;
+        cschema = query_schema_child (schema, APTERYX_NAME (child));
+        if (!cschema)
+            continue;
+
+        cpath = g_strdup_printf ("%s/%s", path, APTERYX_NAME (child));
+        if (state_cache_ttl (cpath) && schema_is_state_only (cschema) &&
+            !query_has_content_match_below (child))
+        {
+            g_node_unlink (child);
+            g_free (child->data);
+            child->data = cpath;
+            *cached = g_list_append (*cached, child);
+            continue;
+        }
+        if (!sch_is_leaf (cschema) && !sch_is_proxy (cschema) &&
+            query_split_cached (child, cschema, cpath, cached))
+        {
+            g_node_unlink (child);
+            apteryx_free_tree (child);
+        }
+        g_free (cpath);
+    }
+    return had_children && node->children == NULL;
+}
+
+/* Query the database, serving operational subtrees with a configured cache
+ * lifetime from the cache */
+static GNode *
+query_with_cache (GNode *query, bool full)
+{
+    GNode *local;
+    GNode *tree = NULL;
+    GList *cached = NULL;
+    sch_node *schema;
+
+    g_mutex_lock (&state_cache_lock);
+    if (!state_cache_ttls || !g_hash_table_size (state_cache_ttls))
+    {
+        g_mutex_unlock (&state_cache_lock);
+        return query_with_proxies (query, full);
+    }
+    g_mutex_unlock (&state_cache_lock);
+
+    schema = query_schema_child (NULL, APTERYX_NAME (query));
+    if (!schema)
+        return query_with_proxies (query, full);
+
+    local = g_node_copy_deep (query, copy_node_data, NULL);
+    if (query_split_cached (local, schema, APTERYX_NAME (local), &cached))
+    {
+        apteryx_free_tree (local);
+        local = NULL;
+    }
+    if (!cached)
+    {
+        apteryx_free_tree (local);
+        return query_with_proxies (query, full);
+    }
+
+    if (local)
+        tree = query_with_proxies (local, full);
+
+    for (GList *iter = cached; iter; iter = iter->next)
+    {
+        GNode *qnode = iter->data;
+        const char *path = APTERYX_NAME (qnode);
+        GNode *data = state_cache_get (path, state_cache_ttl (path));
+        GNode *result = data ? query_tree_filter (qnode, data) : NULL;
+        GNode *leaf = NULL;
+        GNode *chain;
+
+        apteryx_free_tree (data);
+        if (!result)
+            continue;
+
+        /* Hang the cached data off its path in the result */
+        chain = query_from_path (path, &leaf);
+        while (result->children)
+        {
+            GNode *child = result->children;
+            g_node_unlink (child);
+            g_node_append (leaf, child);
+        }
+        apteryx_free_tree (result);
+        if (!tree)
+            tree = chain;
+        else
+            merge_gnode_trees (tree, chain);
+    }
+
+    g_list_free_full (cached, (GDestroyNotify) apteryx_free_tree);
+    apteryx_free_tree (local);
+    return tree;
+}
+
+/* A leaf-list is configuration if its values are writable. The access mode
+ * is held on the value node below the leaf-list. */
+static bool
+leaf_list_is_config (sch_node *schema)
+{
+    sch_node *value = sch_node_child_first (schema);
+
+    return sch_is_writable (value ? value : schema);
+}
+
+/* True if a schema subtree contains any configuration */
+static bool
+schema_has_config (sch_node *schema)
+{
+    sch_node *child = sch_node_child_first (schema);
+
+    if (!sch_is_readable (schema))
+        return false;
+    if (sch_is_proxy (schema))
+        return true;
+    if (sch_is_leaf_list (schema))
+        return leaf_list_is_config (schema);
+    if (sch_is_leaf (schema))
+        return sch_is_writable (schema);
+
+    /* Empty presence containers are configuration */
+    if (!child)
+        return true;
+    for (; child; child = sch_node_next_sibling (child))
+    {
+        if (schema_has_config (child))
+            return true;
+    }
+    return false;
+}
+
+/* True if a schema subtree contains any operational state */
+static bool
+schema_has_state (sch_node *schema)
+{
+    if (sch_is_proxy (schema))
+        return false;
+    if (sch_is_leaf_list (schema))
+        return !leaf_list_is_config (schema);
+    if (sch_is_leaf (schema))
+        return !sch_is_writable (schema) || !sch_is_readable (schema);
+    for (sch_node *child = sch_node_child_first (schema); child; child = sch_node_next_sibling (child))
+    {
+        if (schema_has_state (child))
+            return true;
+    }
+    return false;
+}
+
+/* Add a query for all of the configuration below a schema node. Subtree
+ * queries mark leaf selections with an empty child as the converter does. */
+static void
+query_add_config (GNode *node, sch_node *schema, bool full)
+{
+    for (sch_node *child = sch_node_child_first (schema); child; child = sch_node_next_sibling (child))
+    {
+        GNode *cnode;
+        GNode *entry;
+        char *name;
+
+        if (!schema_has_config (child))
+            continue;
+
+        name = sch_name (child);
+        cnode = APTERYX_NODE (node, name);
+        if (sch_is_proxy (child) || sch_is_leaf_list (child))
+        {
+            entry = APTERYX_NODE (cnode, g_strdup ("*"));
+            if (full)
+                g_node_prepend_data (entry, NULL);
+        }
+        else if (sch_is_list (child))
+        {
+            entry = APTERYX_NODE (cnode, g_strdup ("*"));
+            if (sch_is_proxy (sch_node_child_first (child)))
+            {
+                entry = APTERYX_NODE (entry, g_strdup ("*"));
+                if (full)
+                    g_node_prepend_data (entry, NULL);
+            }
+            else
+                query_add_config (entry, sch_node_child_first (child), full);
+        }
+        else if (!sch_is_leaf (child))
+            query_add_config (cnode, child, full);
+        else if (full)
+            g_node_prepend_data (cnode, NULL);
+    }
+}
+
+static void
+query_clear_children (GNode *node)
+{
+    while (node->children)
+    {
+        GNode *child = node->children;
+        g_node_unlink (child);
+        apteryx_free_tree (child);
+    }
+}
+
+/* A query node that selects everything below it */
+static bool
+query_selects_all (GNode *node)
+{
+    return !node->children || (!node->children->data && !node->children->next);
+}
+
+/* Remove the parts of a get-config query that can only return state, and
+ * expand wildcards that would otherwise fetch state along with configuration.
+ * Returns true if the node was emptied by doing so. */
+static bool
+query_prune_state (GNode *node, sch_node *schema, bool full)
+{
+    GNode *child;
+    GNode *next;
+    bool had_children = node->children != NULL;
+
+    for (child = node->children; child; child = next)
+    {
+        sch_node *cschema;
+
+        next = child->next;
+        if (!child->data)
+            continue;
+
+        if (g_strcmp0 (APTERYX_NAME (child), "*") == 0 && !sch_is_list (schema))
+        {
+            /* Everything from here down - name the configuration instead */
+            if (!sch_is_proxy (schema) && !sch_is_leaf_list (schema) &&
+                query_selects_all (child) && schema_has_state (schema))
+            {
+                g_node_unlink (child);
+                apteryx_free_tree (child);
+                query_add_config (node, schema, full);
+            }
+            continue;
+        }
+
+        cschema = query_schema_child (schema, APTERYX_NAME (child));
+        if (!cschema)
+            continue;
+        if (!schema_has_config (cschema))
+        {
+            g_node_unlink (child);
+            apteryx_free_tree (child);
+            continue;
+        }
+        if (sch_is_proxy (cschema) || sch_is_leaf_list (cschema) || sch_is_leaf (cschema))
+            continue;
+
+        /* A list entry with nothing below it wants the whole entry */
+        if (sch_is_list (schema) && query_selects_all (child))
+        {
+            if (schema_has_state (cschema))
+            {
+                query_clear_children (child);
+                query_add_config (child, cschema, full);
+            }
+            continue;
+        }
+
+        if (query_prune_state (child, cschema, full))
+        {
+            g_node_unlink (child);
+            apteryx_free_tree (child);
+        }
+    }
+    return had_children && node->children == NULL;
+}
+
+/* Query only the configuration selected by a query */
+static GNode *
+query_config (GNode *query, bool full)
+{
+    sch_node *schema = query_schema_child (NULL, APTERYX_NAME (query));
+    GNode *local;
+    GNode *tree = NULL;
+
+    if (!schema)
+        return query_with_proxies (query, full);
+    if (!schema_has_config (schema))
+        return NULL;
+
+    local = g_node_copy_deep (query, copy_node_data, NULL);
+    if (query_selects_all (local) && schema_has_state (schema))
+    {
+        query_clear_children (local);
+        query_add_config (local, schema, full);
+    }
+    else if (query_prune_state (local, schema, full))
+    {
+        apteryx_free_tree (local);
+        return NULL;
+    }
+    tree = query_with_proxies (local, full);
+    apteryx_free_tree (local);
+    return tree;
+}
+
+/* Get all configuration, without fetching any operational state */
+static GNode *
+get_full_config_tree ()
+{
+    sch_node *root = sch_get_root_schema (g_schema);
+    GNode *tree = APTERYX_NODE (NULL, g_strdup_printf ("/"));
+
+    for (sch_node *schema = sch_node_child_first (root); schema; schema = sch_node_next_sibling (schema))
+    {
+        sch_ns *ns = sch_node_ns (schema);
+        GNode *query;
+        GNode *subtree;
+        char *name;
+
+        if (!schema_has_config (schema))
+            continue;
+
+        /* Root nodes from other than the default namespace are prefixed */
+        name = sch_name (schema);
+        if (ns && sch_ns_prefix (g_schema, ns) && !sch_ns_native (g_schema, ns))
+            query = APTERYX_NODE (NULL, g_strdup_printf ("/%s:%s", sch_ns_prefix (g_schema, ns), name));
+        else
+            query = APTERYX_NODE (NULL, g_strdup_printf ("/%s", name));
+        g_free (name);
+
+        if (sch_is_leaf (schema))
+            subtree = apteryx_query (query);
+        else
+        {
+            if (sch_is_list (schema) || sch_is_leaf_list (schema) || sch_is_proxy (schema))
+                APTERYX_NODE (query, g_strdup ("*"));
+            if (sch_is_list (schema) && !sch_is_proxy (sch_node_child_first (schema)))
+                query_add_config (g_node_first_child (query), sch_node_child_first (schema), false);
+            else if (!sch_is_list (schema) && !sch_is_leaf_list (schema) && !sch_is_proxy (schema))
+                query_add_config (query, schema, false);
+            subtree = query->children ? query_with_proxies (query, false) : NULL;
+        }
+
+        if (subtree)
+        {
+            g_free (subtree->data);
+            subtree->data = g_strdup (APTERYX_NAME (query) + 1);
+            g_node_append (tree, subtree);
+        }
+        apteryx_free_tree (query);
+    }
+    return tree;
+}
+
+/* A node of an edit tree that holds a value */
+static bool
+edit_node_is_leaf (GNode *node)
+{
+    return node->children && !node->children->next && !node->children->children;
+}
+
+static GNode *
+edit_node_child (GNode *node, const char *name)
+{
+    GNode *child;
+
+    for (child = node ? node->children : NULL; child; child = child->next)
+    {
+        if (child->data && g_strcmp0 (APTERYX_NAME (child), name) == 0)
+            break;
+    }
+    return child;
+}
+
+/* Find the node of an edit tree at an absolute path */
+static GNode *
+edit_tree_find (GNode *tree, const char *path)
+{
+    const char *root = APTERYX_NAME (tree);
+    size_t len = g_strcmp0 (root, "/") == 0 ? 0 : strlen (root);
+    gchar **parts;
+    GNode *node = tree;
+
+    if (strncmp (path, root, len) != 0 || (path[len] != '/' && path[len] != '\0'))
+        return NULL;
+    if (path[len] == '\0')
+        return tree;
+
+    parts = g_strsplit (path + len + 1, "/", -1);
+    for (int i = 0; parts[i] && node; i++)
+        node = edit_node_child (node, parts[i]);
+    g_strfreev (parts);
+    return node;
+}
+
+/* True if path is at or below parent */
+static bool
+path_is_below (const char *path, const char *parent)
+{
+    size_t len = strlen (parent);
+
+    return strncmp (path, parent, len) == 0 && (path[len] == '\0' || path[len] == '/');
+}
+
+/* Remove the node at an absolute path from a tree, along with any parents it
+ * leaves empty. Returns the tree, or NULL if nothing is left of it. */
+static GNode *
+tree_prune_path (GNode *tree, const char *path)
+{
+    GNode *node = tree ? edit_tree_find (tree, path) : NULL;
+    GNode *parent;
+
+    while (node && node != tree)
+    {
+        parent = node->parent;
+        g_node_unlink (node);
+        apteryx_free_tree (node);
+        node = parent->children ? NULL : parent;
+    }
+    if (node)
+    {
+        apteryx_free_tree (tree);
+        return NULL;
+    }
+    return tree;
+}
+
+/* Merge a copy of tree2 into tree1, with the values in tree2 taking precedence */
+static void
+tree_overlay (GNode *tree1, GNode *tree2)
+{
+    for (GNode *child = tree2->children; child; child = child->next)
+    {
+        GNode *existing;
+
+        if (!child->data)
+            continue;
+        existing = edit_node_child (tree1, APTERYX_NAME (child));
+        if (existing && (!child->children || edit_node_is_leaf (child) ||
+                         edit_node_is_leaf (existing)))
+        {
+            g_node_unlink (existing);
+            apteryx_free_tree (existing);
+            existing = NULL;
+        }
+        if (existing)
+            tree_overlay (existing, child);
+        else
+            g_node_append (tree1, g_node_copy_deep (child, copy_node_data, NULL));
+    }
+}
+
+/* Whether data exists at a path in the candidate, given whether it does in
+ * running. Called with the candidate locked. */
+static bool
+candidate_exists (const char *path, bool running)
+{
+    if (candidate_sets && edit_tree_find (candidate_sets, path))
+        return true;
+    for (GList *iter = candidate_prunes; iter; iter = g_list_next (iter))
+    {
+        if (path_is_below (path, (const char *) iter->data))
+            return false;
+    }
+    return running;
+}
+
+static bool
+candidate_modified (void)
+{
+    bool modified;
+
+    g_mutex_lock (&candidate_lock);
+    modified = candidate_sets != NULL || candidate_prunes != NULL;
+    g_mutex_unlock (&candidate_lock);
+    return modified;
+}
+
+/* Record a prune in the candidate. Pending sets below the path are dropped
+ * and only the outermost of overlapping prunes is kept. */
+static void
+candidate_prune (const char *path)
+{
+    GList *iter;
+    GList *next;
+
+    candidate_sets = tree_prune_path (candidate_sets, path);
+    for (iter = candidate_prunes; iter; iter = g_list_next (iter))
+    {
+        if (path_is_below (path, (const char *) iter->data))
+            return;
+    }
+    for (iter = candidate_prunes; iter; iter = next)
+    {
+        next = g_list_next (iter);
+        if (path_is_below ((const char *) iter->data, path))
+        {
+            g_free (iter->data);
+            candidate_prunes = g_list_delete_link (candidate_prunes, iter);
+        }
+    }
+    candidate_prunes = g_list_append (candidate_prunes, g_strdup (path));
+}
+
+/* Merge an edit tree into the pending sets of the candidate */
+static void
+candidate_merge (GNode *tree)
+{
+    GNode *root = APTERYX_NODE (NULL, g_strdup ("/"));
+    GNode *node = root;
+    gchar **parts = g_strsplit (APTERYX_NAME (tree) + 1, "/", -1);
+
+    for (int i = 0; parts[i]; i++)
+        node = APTERYX_NODE (node, g_strdup (parts[i]));
+    g_strfreev (parts);
+    for (GNode *child = tree->children; child; child = child->next)
+        g_node_append (node, g_node_copy_deep (child, copy_node_data, NULL));
+
+    if (!candidate_sets)
+        candidate_sets = APTERYX_NODE (NULL, g_strdup ("/"));
+    tree_overlay (candidate_sets, root);
+    apteryx_free_tree (root);
+}
+
+static void
+candidate_clear (void)
+{
+    apteryx_free_tree (candidate_sets);
+    candidate_sets = NULL;
+    g_list_free_full (candidate_prunes, g_free);
+    candidate_prunes = NULL;
+}
+
+/* Merge an edit tree onto a copy of the data below its top level node, less
+ * the paths the edit prunes, taking ownership of the copy. The result is the
+ * data as the edit would leave it, for checking its conditions against. */
+static GNode *
+edit_view (GNode *view, GNode *tree, GList *prunes)
+{
+    if (!tree)
+        return view;
+    for (GList *iter = prunes; iter && view; iter = g_list_next (iter))
+        view = tree_prune_path (view, (const char *) iter->data);
+    if (!view)
+        return g_node_copy_deep (tree, copy_node_data, NULL);
+    tree_overlay (view, tree);
+    return view;
+}
+
+/* The candidate below the top level node of an edit tree as the edit would
+ * leave it. Called with the candidate locked. */
+static GNode *
+candidate_view (GNode *tree, GList *prunes)
+{
+    GNode *node = candidate_sets && tree ? edit_tree_find (candidate_sets, APTERYX_NAME (tree)) : NULL;
+    GNode *view = NULL;
+
+    if (node)
+    {
+        view = g_node_copy_deep (node, copy_node_data, NULL);
+        g_free (view->data);
+        view->data = g_strdup (APTERYX_NAME (tree));
+    }
+    return edit_view (view, tree, prunes);
+}
+
+/* Apply the candidate to running - all of the prunes, then one set of each
+ * top level node. Running is left partly changed on failure, so callers
+ * restore a snapshot taken beforehand. Called with the candidate locked. */
+static bool
+candidate_commit (void)
+{
+    GNode *child;
+    GNode *next;
+    bool ok = true;
+
+    for (GList *iter = candidate_prunes; iter; iter = g_list_next (iter))
+    {
+        apteryx_prune ((const char *) iter->data);
+    }
+    for (child = candidate_sets ? candidate_sets->children : NULL; child && ok; child = next)
+    {
+        char *name = child->data;
+
+        next = child->next;
+        g_node_unlink (child);
+        child->data = g_strdup_printf ("/%s", name);
+        ok = apteryx_set_tree (child);
+        g_free (child->data);
+        child->data = name;
+        g_node_insert_before (candidate_sets, next, child);
+    }
+    return ok;
+}
+
+/* Apply the candidate to the data read from running for a query */
+static GNode *
+candidate_apply (GNode *tree, GNode *query)
+{
+    GNode *overlay = NULL;
+    GNode *node;
+
+    g_mutex_lock (&candidate_lock);
+    for (GList *iter = candidate_prunes; iter; iter = g_list_next (iter))
+    {
+        tree = tree_prune_path (tree, (const char *) iter->data);
+    }
+    if (candidate_sets)
+    {
+        if (!query)
+            overlay = g_node_copy_deep (candidate_sets, copy_node_data, NULL);
+        else if ((node = edit_tree_find (candidate_sets, APTERYX_NAME (query))) &&
+                 (overlay = query_tree_filter (query, node)))
+        {
+            g_free (overlay->data);
+            overlay->data = g_strdup (APTERYX_NAME (query));
+        }
+    }
+    g_mutex_unlock (&candidate_lock);
+
+    if (overlay && tree)
+    {
+        tree_overlay (tree, overlay);
+        apteryx_free_tree (overlay);
+    }
+    else if (overlay)
+        tree = overlay;
+    return tree;
+}
+
+/* Add a path to a list of non-overlapping paths, keeping only the top-most */
+static void
+paths_add_minimal (GList **paths, const char *path)
+{
+    GList *iter;
+    GList *next;
+
+    for (iter = *paths; iter; iter = g_list_next (iter))
+    {
+        if (path_is_below (path, (const char *) iter->data))
+            return;
+    }
+    for (iter = *paths; iter; iter = next)
+    {
+        next = g_list_next (iter);
+        if (path_is_below ((const char *) iter->data, path))
+        {
+            g_free (iter->data);
+            *paths = g_list_delete_link (*paths, iter);
+        }
+    }
+    *paths = g_list_append (*paths, g_strdup (path));
+}
+
+/* Add the nodes of a set tree that hold the leaves it changes */
+static void
+snapshot_add_tree (GList **paths, GNode *node, const char *path)
+{
+    for (GNode *child = node->children; child; child = child->next)
+    {
+        char *cpath;
+
+        if (!child->data)
+            continue;
+        if (path[0] && (edit_node_is_leaf (child) || !child->children))
+        {
+            paths_add_minimal (paths, path);
+            return;
+        }
+        cpath = g_strdup_printf ("%s/%s", path, APTERYX_NAME (child));
+        if (edit_node_is_leaf (child) || !child->children)
+            paths_add_minimal (paths, cpath);
+        else
+            snapshot_add_tree (paths, child, cpath);
+        g_free (cpath);
+    }
+}
+
+/* Query only the configuration below an absolute path */
+static GNode *
+path_config (const char *path)
+{
+    gchar **parts = g_strsplit (path + 1, "/", -1);
+    GNode *query = APTERYX_NODE (NULL, g_strdup_printf ("/%s", parts[0]));
+    GNode *node = query;
+    GNode *tree;
+
+    for (int i = 1; parts[i]; i++)
+        node = APTERYX_NODE (node, g_strdup (parts[i]));
+    g_strfreev (parts);
+    tree = query_config (query, false);
+    apteryx_free_tree (query);
+    return tree;
+}
+
+/* Empty every value in a tree, so that setting it removes the leaves */
+static void
+tree_clear_values (GNode *node)
+{
+    if (edit_node_is_leaf (node))
+    {
+        g_free (node->children->data);
+        node->children->data = g_strdup ("");
+        return;
+    }
+    for (GNode *child = node->children; child; child = child->next)
+    {
+        if (child->data)
+            tree_clear_values (child);
+    }
+}
+
+/* Copy the configuration below each of a list of paths, taking ownership of
+ * the list. State below the paths belongs to its providers and is left out. */
+static struct snapshot *
+snapshot_take (GList *paths)
+{
+    struct snapshot *snapshot = g_malloc0 (sizeof (struct snapshot));
+
+    snapshot->paths = paths;
+    for (GList *iter = paths; iter; iter = g_list_next (iter))
+        snapshot->trees = g_list_append (snapshot->trees, path_config (iter->data));
+    return snapshot;
+}
+
+static void
+snapshot_free (struct snapshot *snapshot)
+{
+    g_list_free_full (snapshot->paths, g_free);
+    g_list_free_full (snapshot->trees, (GDestroyNotify) apteryx_free_tree);
+    g_free (snapshot);
+}
+
+/* Put back the configuration below each path of a snapshot and free it.
+ * Configuration added since is removed and state is left alone, with one
+ * tree set per path. */
+static bool
+snapshot_restore (struct snapshot *snapshot)
+{
+    GList *tree = snapshot->trees;
+    bool ok = true;
+
+    for (GList *iter = snapshot->paths; iter; iter = g_list_next (iter), tree = g_list_next (tree))
+    {
+        GNode *restore = path_config (iter->data);
+
+        if (restore)
+        {
+            tree_clear_values (restore);
+            if (tree->data)
+                tree_overlay (restore, tree->data);
+        }
+        else if (tree->data)
+            restore = g_node_copy_deep (tree->data, copy_node_data, NULL);
+        if (restore && !apteryx_set_tree (restore))
+            ok = false;
+        apteryx_free_tree (restore);
+    }
+    snapshot_free (snapshot);
+    return ok;
+}
+
+/* Snapshot the data a commit of the candidate will change. Called with the
+ * candidate locked. */
+static struct snapshot *
+candidate_snapshot (void)
+{
+    GList *paths = NULL;
+
+    for (GList *iter = candidate_prunes; iter; iter = g_list_next (iter))
+        paths_add_minimal (&paths, (const char *) iter->data);
+    if (candidate_sets)
+        snapshot_add_tree (&paths, candidate_sets, "");
+    return snapshot_take (paths);
+}
+
+/* Finish a confirmed commit, undoing it if restore is set. Called with the
+ * candidate locked. */
+static void
+confirmed_commit_end (bool restore)
+{
+    GList *iter;
+
+    if (restore)
+        NOTICE ("COMMIT: rolling back confirmed commit\n");
+    /* Later commits are undone first */
+    for (iter = confirmed_commit.snapshots; iter; iter = g_list_next (iter))
+    {
+        if (restore)
+            snapshot_restore (iter->data);
+        else
+            snapshot_free (iter->data);
+    }
+    g_list_free (confirmed_commit.snapshots);
+    confirmed_commit.snapshots = NULL;
+    if (confirmed_commit.timer)
+        g_source_remove (confirmed_commit.timer);
+    confirmed_commit.timer = 0;
+    confirmed_commit.session_id = 0;
+    g_free (confirmed_commit.persist);
+    confirmed_commit.persist = NULL;
+}
+
+static gboolean
+confirmed_commit_timeout (gpointer data)
+{
+    guint id = g_source_get_id (g_main_current_source ());
+
+    g_mutex_lock (&candidate_lock);
+    /* Ignore a timeout that raced with the commit being confirmed */
+    if (confirmed_commit.timer == id)
+    {
+        confirmed_commit.timer = 0;
+        confirmed_commit_end (true);
+    }
+    g_mutex_unlock (&candidate_lock);
+    return G_SOURCE_REMOVE;
+}
+
+static bool
+get_query_to_xml (struct netconf_session *session, xmlNode *rpc, GNode *query,
+                  int rdepth, char *path, char **ns_href,
+                  char **ns_prefix, xpath_type x_type, int schflags,
+                  bool is_subtree, bool is_filter, bool candidate, GList **xml_list)
+{
+    GNode *tree = NULL;
+    GNode *query_defaults = NULL;
+    xmlNode *xml = NULL;
+    gint64 start;
+
+    /* Query database */
+    DEBUG ("NETCONF: GET %s\n", query ? APTERYX_NAME (query) : "/");
+    if (((logging & LOG_GET) && !(schflags & SCH_F_CONFIG)) ||
+        ((logging & LOG_GET_CONFIG) && (schflags & SCH_F_CONFIG)))
+    {
+        GString *qpath = g_string_new ("./");
+        GList *paths = generate_apteryx_query_node_paths (query, qpath, NULL);
+        for (GList *iter = paths; iter; iter = iter->next)
+            NOTICE ("%s: %s@%s id:%u path:%s\n",
+                    (schflags & SCH_F_CONFIG) ? "GET-CONFIG" : "GET",
+                    session->username, session_data (session)->rem_addr, session->id,
+                    (gchar*) iter->data);
+
+        g_list_free_full (paths, g_free);
+        g_string_free (qpath, TRUE);
+    }
+
+    start = rpc_trace_now (session);
+    if (query)
+    {
+        if (is_subtree)
+        {
+            query_prescan_content_match (query, APTERYX_NAME (query));
+            if (schflags & SCH_F_CONFIG)
+                tree = query_config (query, true);
+            else
+                tree = query_with_cache (query, true);
+        }
+        else if (schflags & SCH_F_CONFIG)
+            tree = query_config (query, false);
+        else
+            tree = query_with_cache (query, false);
+    }
+    else if (!is_filter)
+        tree = (schflags & SCH_F_CONFIG) ? get_full_config_tree () : get_full_tree ();
+
+    if (candidate && (query || !is_filter))
+        tree = candidate_apply (tree, query);
+    rpc_trace_phase (session, RPC_PHASE_QUERY, start);
+
+    start = rpc_trace_now (session);
+    if (schflags & SCH_F_ADD_DEFAULTS)
+    {
+        if (tree)
+        {
+            sch_traverse_tree (g_schema, NULL, tree, schflags | SCH_F_FILTER_RDEPTH, rdepth);
+            query_defaults = query;
+            g_node_traverse (query_defaults, G_IN_ORDER, G_TRAVERSE_LEAVES, -1, remove_null_data, NULL);
+            query = NULL;
+            sch_traverse_tree (g_schema, NULL, query_defaults, schflags | SCH_F_FILTER_RDEPTH, rdepth);
+
+            /* Merge the results of the search result tree with defaults and the query with defaults */
+            merge_gnode_trees (tree, query_defaults);
+        }
+        else
+        {
+            /* Nothing in the database, but we may have defaults! */
+            tree = query;
+            g_node_traverse (tree, G_IN_ORDER, G_TRAVERSE_LEAVES, -1, remove_null_data, NULL);
+            query = NULL;
+            sch_traverse_tree (g_schema, NULL, tree, schflags | SCH_F_FILTER_RDEPTH, rdepth);
+        }
+    }
+
+    if (tree && (schflags & SCH_F_TRIM_DEFAULTS))
+        sch_traverse_tree (g_schema, NULL, tree, schflags | SCH_F_FILTER_RDEPTH, rdepth);
+    rpc_trace_phase (session, RPC_PHASE_DEFAULTS, start);
+
+    apteryx_free_tree (query);
+
+    /* Convert result to XML */
+    start = rpc_trace_now (session);
+    xml = tree ? sch_gnode_to_xml (g_schema, NULL, tree, schflags) : NULL;
+    apteryx_free_tree (tree);
+    rpc_trace_phase (session, RPC_PHASE_TO_XML, start);
+
+    if (xml && x_type == XPATH_EVALUATE)
+    {
+        bool ret;
+
+        start = rpc_trace_now (session);
+        ret = xpath_evaluate (session, rpc, path, ns_href, ns_prefix, xml, schflags, xml_list);
+        rpc_trace_phase (session, RPC_PHASE_XPATH, start);
+        return ret;
+    }
+    else
+        *xml_list = g_list_append (*xml_list, xml);
+    return true;
+}
+
+static bool
+get_query_schema (struct netconf_session *session, xmlNode *rpc, GNode *query,
+                  sch_node *qschema, char *path, char **ns_href, char **ns_prefix, xpath_type x_type,
+                  int schflags, bool is_filter, bool is_subtree, bool candidate,
+                  GList **xml_list)
+{
+    GNode *qnode = NULL;
+    int qdepth = 0;
+
+    /* Get the depth of the response which is the depth of the query
+        OR the up until the first path wildcard */
+    qdepth = g_node_max_height (query);
+    if (is_subtree && qdepth)
+        qdepth--;
+
+    qnode = query;
+    while (qnode &&
+            g_node_n_children (qnode) == 1 &&
+            g_strcmp0 (APTERYX_NAME (g_node_first_child (qnode)), "*") != 0)
+    {
+        qnode = g_node_first_child (qnode);
+    }
+
+    while (qnode && qnode->children && qnode->children->data)
+        qnode = qnode->children;
+
+    if (qdepth && qnode && g_strcmp0 (APTERYX_NAME (qnode), "*") == 0)
+        qdepth--;
+
+    /* Without a query we may need to add a wildcard to get everything from here down */
+    if (is_filter && qnode && qdepth == g_node_max_height (query) &&
+        !(schflags & SCH_F_DEPTH_ONE))
+    {
+        if (qschema && sch_node_child_first (qschema) && !(schflags & SCH_F_STRIP_DATA))
+        {
+            /* Get everything from here down if we do not already have a star */
+            if (!g_node_first_child (qnode) && g_strcmp0 (APTERYX_NAME (qnode), "*") != 0)
+            {
+                APTERYX_NODE (qnode, g_strdup ("*"));
+                DEBUG ("%*s%s\n", qdepth * 2, " ", "*");
+            }
+        }
+    }
+
+    return get_query_to_xml (session, rpc, query, qdepth, path, ns_href,
+                             ns_prefix, x_type, schflags, is_subtree, true, candidate, xml_list);
+}
+
+static void
+cleanup_on_xpath_error (struct netconf_session *session, char *attr, gchar **split,
+                        char *ns_href, char *ns_prefix, char *path)
+{
+    free (attr);
+    g_strfreev(split);
+    g_free (ns_href);
+    g_free (ns_prefix);
+    g_free (path);
+    g_atomic_int_inc (&session->counters.in_bad_rpcs);
+}
+
+static int
+get_process_action (struct netconf_session *session, xmlNode *rpc, xmlNode *node,
+                    int schflags, bool candidate, GList **xml_list, bool *filter_seen, bool *ret)
+{
+    char *attr;
+    xmlNode *tnode;
+    GNode *query = NULL;
+    gchar **split;
+    sch_xml_to_gnode_parms parms;
+    sch_node *qschema = NULL;
+    bool is_filter = false;
+    int i;
+    int count;
+
+    /* Check the requested datastore */
+    if (g_strcmp0 ((char *) node->name, "source") == 0)
+    {
+        if (!xmlFirstElementChild (node) ||
+            (g_strcmp0 ((char *) xmlFirstElementChild (node)->name, "running") != 0 &&
+             g_strcmp0 ((char *) xmlFirstElementChild (node)->name, "candidate") != 0))
+        {
+            gchar *error_msg = g_strdup_printf ("Datastore \"%s\" not supported",
+                                                (char *) xmlFirstElementChild (node)->name);
+            VERBOSE ("%s\n", error_msg);
+            *ret = send_rpc_error_full (session, rpc, NC_ERR_TAG_OPR_NOT_SUPPORTED, NC_ERR_TYPE_PROTOCOL,
+                                        error_msg, NULL, NULL, true);
+            g_free (error_msg);
+            return -1;
+        }
+    }
+    /* Parse any filters */
+    else if (g_strcmp0 ((char *) node->name, "filter") == 0)
+    {
+        *filter_seen = true;
+        attr = (char *) xmlGetProp (node, BAD_CAST "type");
+
+        /* Default type is "subtree" */
+        if (attr == NULL)
+        {
             attr = g_strdup ("subtree");    /* for the later free */
         }
         if (g_strcmp0 (attr, "xpath") == 0)
@@ -1490,6 +3503,7 @@ get_process_action (struct netconf_session *session, xmlNode *rpc, xmlNode *node
             }
 
             VERBOSE ("FILTER: XPATH: %s\n", attr);
+            rpc_trace_filter (session, attr);
             is_filter = true;
             split = g_strsplit (attr, "|", -1);
             count = g_strv_length (split);
@@ -1551,7 +3565,7 @@ get_process_action (struct netconf_session *session, xmlNode *rpc, xmlNode *node
                     }
 
                     if (!get_query_schema (session, rpc, query, qschema, path, &ns_href, &ns_prefix,
-                                           x_type, schflags, is_filter, false, xml_list))
+                                           x_type, schflags, is_filter, false, candidate, xml_list))
                     {
                         cleanup_on_xpath_error (session, attr, split, ns_href, ns_prefix, path);
                         return -1;
@@ -1560,7 +3574,8 @@ get_process_action (struct netconf_session *session, xmlNode *rpc, xmlNode *node
                 else if (!query && x_type == XPATH_EVALUATE)
                 {
                     if (!get_query_to_xml (session, rpc, query, 0, path, &ns_href,
-                                           &ns_prefix, x_type, schflags, false, true, xml_list))
+                                           &ns_prefix, x_type, schflags, false, true, candidate,
+                                           xml_list))
                     {
                         cleanup_on_xpath_error (session, attr, split, ns_href, ns_prefix, path);
                         return -1;
@@ -1590,6 +3605,14 @@ get_process_action (struct netconf_session *session, xmlNode *rpc, xmlNode *node
                 return 0;
             }
 
+            if (session->trace.enabled)
+            {
+                xmlBuffer *buffer = xmlBufferCreate ();
+
+                xmlNodeDump (buffer, node->doc, node, 0, 0);
+                rpc_trace_filter (session, (const char *) xmlBufferContent (buffer));
+                xmlBufferFree (buffer);
+            }
             for (tnode = xmlFirstElementChild (node); tnode; tnode = xmlNextElementSibling (tnode))
             {
                 qschema = NULL;
@@ -1604,8 +3627,7 @@ get_process_action (struct netconf_session *session, xmlNode *rpc, xmlNode *node
                     *ret = send_rpc_error_full (session, rpc, NC_ERR_TAG_MALFORMED_MSG, NC_ERR_TYPE_RPC,
                                                 "SUBTREE: malformed query", NULL, NULL, true);
                     free (attr);
-                    session->counters.in_bad_rpcs++;
-                    netconf_global_stats.session_totals.in_bad_rpcs++;
+                    g_atomic_int_inc (&session->counters.in_bad_rpcs);
                     return -1;
                 }
 
@@ -1623,11 +3645,10 @@ get_process_action (struct netconf_session *session, xmlNode *rpc, xmlNode *node
                         return -1;
                     }
                     if (!get_query_schema (session, rpc, query, qschema, NULL, NULL, NULL, XPATH_NONE,
-                                           schflags, is_filter, true, xml_list))
+                                           schflags, is_filter, true, candidate, xml_list))
                     {
                         free (attr);
-                        session->counters.in_bad_rpcs++;
-                        netconf_global_stats.session_totals.in_bad_rpcs++;
+                        g_atomic_int_inc (&session->counters.in_bad_rpcs);
                         return -1;
                     }
                 }
@@ -1649,33 +3670,29 @@ get_process_action (struct netconf_session *session, xmlNode *rpc, xmlNode *node
     return 0;
 }
 
-static bool
-handle_get (struct netconf_session *session, xmlNode * rpc, gboolean config_only)
+/* Run a get or get-config, returning the serialised <data> element of the
+ * reply. On failure any error has already been sent and ret is set. */
+static char *
+get_reply_data (struct netconf_session *session, xmlNode * rpc, int schflags, bool *ret)
 {
     xmlNode *action = xmlFirstElementChild (rpc);
     xmlNode *node;
     GList *xml_list = NULL;
     GList *list;
-    int schflags = 0;
     bool filter_seen = false;
-    bool ret = false;
-
-    if (apteryx_netconf_verbose)
-        schflags |= SCH_F_DEBUG;
-
-    if (config_only)
-    {
-        schflags |= SCH_F_CONFIG;
-    }
+    bool candidate = false;
+    gint64 start = rpc_trace_now (session);
+    gint64 counted = rpc_trace_total (session);
+    char *data;
 
-    /* Validate lock if configured on the running datastore */
-    if (running_ds_lock.locked == TRUE && (session->id != running_ds_lock.nc_sess.id))
+    /* Read from the candidate if it is the source */
+    for (node = xmlFirstElementChild (action); node; node = xmlNextElementSibling (node))
     {
-        /* A lock is already held by another NETCONF session, return lock-denied */
-        VERBOSE ("Lock failed, lock is already held\n");
-        ret = send_rpc_error_full (session, rpc, NC_ERR_TAG_IN_USE, NC_ERR_TYPE_APP,
-                                   "Lock is already held", NULL, NULL, false);
-        return ret;
+        if (g_strcmp0 ((char *) node->name, "source") == 0 && xmlFirstElementChild (node) &&
+            g_strcmp0 ((char *) xmlFirstElementChild (node)->name, "candidate") == 0)
+        {
+            candidate = true;
+        }
     }
 
     /* Parse options - first look for with-defaults option as this changes the way query lookup works */
@@ -1697,11 +3714,11 @@ handle_get (struct netconf_session *session, xmlNode * rpc, gboolean config_only
                 gchar *error_msg = g_strdup_printf ("WITH-DEFAULTS: No support for with-defaults query type \"%s\"",
                                                     defaults_type);
                 ERROR ("%s\n", error_msg);
-                ret = send_rpc_error_full (session, rpc, NC_ERR_TAG_OPR_NOT_SUPPORTED, NC_ERR_TYPE_PROTOCOL,
-                                           error_msg, NULL, NULL, true);
+                *ret = send_rpc_error_full (session, rpc, NC_ERR_TAG_OPR_NOT_SUPPORTED, NC_ERR_TYPE_PROTOCOL,
+                                            error_msg, NULL, NULL, true);
                 g_free (error_msg);
                 free (defaults_type);
-                return ret;
+                return NULL;
             }
             free (defaults_type);
             break;
@@ -1714,7 +3731,7 @@ handle_get (struct netconf_session *session, xmlNode * rpc, gboolean config_only
         if (g_strcmp0 ((char *) node->name, "with-defaults") == 0)
             continue;
 
-        if (get_process_action (session, rpc, node, schflags, &xml_list, &filter_seen, &ret) < 0)
+        if (get_process_action (session, rpc, node, schflags, candidate, &xml_list, &filter_seen, ret) < 0)
         {
             /* Cleanup any requests added to the xml_list before hitting an error */
             for (list = g_list_first (xml_list); list; list = g_list_next (list))
@@ -1723,7 +3740,7 @@ handle_get (struct netconf_session *session, xmlNode * rpc, gboolean config_only
             }
             g_list_free (xml_list);
 
-            return ret;
+            return NULL;
         }
     }
 
@@ -1731,18 +3748,137 @@ handle_get (struct netconf_session *session, xmlNode * rpc, gboolean config_only
     if (!filter_seen && !xml_list)
     {
         if (!get_query_to_xml (session, rpc, NULL, 0, NULL, NULL, NULL,
-                               XPATH_NONE, schflags, false, false, &xml_list))
+                               XPATH_NONE, schflags, false, false, candidate, &xml_list))
         {
-            session->counters.in_bad_rpcs++;
-            netconf_global_stats.session_totals.in_bad_rpcs++;
-            return false;
+            g_atomic_int_inc (&session->counters.in_bad_rpcs);
+            *ret = false;
+            return NULL;
         }
     }
 
+    /* Whatever is left over was spent processing the filters */
+    rpc_trace_remainder (session, RPC_PHASE_FILTER, start, counted);
+
+    start = rpc_trace_now (session);
+    data = rpc_data_to_string (xml_list);
+    rpc_trace_phase (session, RPC_PHASE_SERIALISE, start);
+    return data;
+}
+
+/* Key identical reads by the request element, the namespaces in scope for it
+ * (prefixes in filters may be declared on <rpc>) and the flags they run with */
+static char *
+get_flight_key (xmlNode * rpc, int schflags)
+{
+    xmlNode *action = xmlFirstElementChild (rpc);
+    xmlBuffer *buffer = xmlBufferCreate ();
+    GString *key = g_string_new (NULL);
+    xmlNs **ns_list;
+
+    g_string_append_printf (key, "%x:", schflags);
+    ns_list = xmlGetNsList (rpc->doc, action);
+    for (int i = 0; ns_list && ns_list[i]; i++)
+    {
+        g_string_append_printf (key, "%s=%s;", ns_list[i]->prefix ? (char *) ns_list[i]->prefix : "",
+                                (char *) ns_list[i]->href);
+    }
+    xmlFree (ns_list);
+    xmlNodeDump (buffer, rpc->doc, action, 0, 0);
+    g_string_append (key, (const char *) xmlBufferContent (buffer));
+    xmlBufferFree (buffer);
+    return g_string_free (key, FALSE);
+}
+
+static void
+get_flight_unref (struct get_flight *flight)
+{
+    if (--flight->refcount == 0)
+    {
+        g_free (flight->data);
+        g_free (flight);
+    }
+}
+
+static bool
+handle_get (struct netconf_session *session, xmlNode * rpc, gboolean config_only)
+{
+    struct get_flight *flight;
+    char *key;
+    char *data = NULL;
+    int schflags = 0;
+    bool ret = false;
+
+    if (apteryx_netconf_verbose)
+        schflags |= SCH_F_DEBUG;
+
+    if (config_only)
+    {
+        schflags |= SCH_F_CONFIG;
+    }
+
+    /* Reads go ahead while another session holds the running lock and while
+     * edits are being applied. An edit that deletes, removes or replaces data
+     * prunes it before setting the rest, so a read in between can see that
+     * data gone before the new values are written. */
+
+    /* Share the reply of an identical read that is already in progress, as
+     * long as it started after this request arrived so it sees every change
+     * made before then */
+    key = get_flight_key (rpc, schflags);
+    g_mutex_lock (&get_flight_lock);
+    flight = g_hash_table_lookup (get_flights, key);
+    if (flight && flight->started < session->rpc_arrived)
+    {
+        coalesce_stats.executed++;
+        g_mutex_unlock (&get_flight_lock);
+        g_free (key);
+        flight = NULL;
+    }
+    else if (flight)
+    {
+        flight->refcount++;
+        while (!flight->done)
+            g_cond_wait (&get_flight_cond, &get_flight_lock);
+        data = g_strdup (flight->data);
+        get_flight_unref (flight);
+        if (data)
+            coalesce_stats.coalesced++;
+        g_mutex_unlock (&get_flight_lock);
+        g_free (key);
+        flight = NULL;
+    }
+    else
+    {
+        flight = g_malloc0 (sizeof (struct get_flight));
+        flight->refcount = 1;
+        flight->started = g_get_monotonic_time ();
+        g_hash_table_insert (get_flights, key, flight);
+        coalesce_stats.executed++;
+        g_mutex_unlock (&get_flight_lock);
+    }
+
+    /* Run the request ourselves if we lead or the shared run failed */
+    if (!data)
+        data = get_reply_data (session, rpc, schflags, &ret);
+
+    if (flight)
+    {
+        g_mutex_lock (&get_flight_lock);
+        flight->data = g_strdup (data);
+        flight->done = true;
+        g_hash_table_remove (get_flights, key);
+        g_cond_broadcast (&get_flight_cond);
+        get_flight_unref (flight);
+        g_mutex_unlock (&get_flight_lock);
+    }
+
+    if (!data)
+        return ret;
+
     /* Send response */
-    send_rpc_data (session, rpc, xml_list);
-    session->counters.in_rpcs++;
-    netconf_global_stats.session_totals.in_rpcs++;
+    send_rpc_data_string (session, rpc, data);
+    g_free (data);
+    g_atomic_int_inc (&session->counters.in_rpcs);
 
     return true;
 }
@@ -1763,25 +3899,54 @@ xmlFindNodeByName (xmlNode * root, const xmlChar * name)
 }
 
 /**
- * Check for existence of data at a particular xpath or below. This is
- * required for NC_OP_CREATE and NC_OP_DELETE. Fill in the error_tag if we don't
- * get expected result, otherwise leave it alone (so we can accumulate errors).
+ * Check for existence of data at each of a list of xpaths or below. This is
+ * required for NC_OP_CREATE and NC_OP_DELETE. Data exists at a path if the
+ * path is returned by a search of its parent, so paths are answered with one
+ * search per parent, shared between calls through the searched table. Fill in
+ * the error_tag if we don't get expected result, otherwise leave it alone (so
+ * we can accumulate errors). Checks against the candidate are made with it locked.
  */
 static void
-_check_exist (const char *check_xpath, NC_ERR_TAG *err_tag, bool expected)
+_check_exist (GList *paths, GHashTable *searched, NC_ERR_TAG *err_tag, bool expected,
+              bool candidate)
 {
-    GNode *check_result;
-
-    check_result = apteryx_get_tree (check_xpath);
-    if (check_result && !expected)
-    {
-        *err_tag = NC_ERR_TAG_DATA_EXISTS;
-    }
-    else if (!check_result && expected)
+    for (GList *iter = paths; iter; iter = g_list_next (iter))
     {
-        *err_tag = NC_ERR_TAG_DATA_MISSING;
+        const char *check_xpath = (const char *) iter->data;
+        const char *slash = strrchr (check_xpath, '/');
+        GHashTable *children;
+        char *parent;
+        bool exists;
+
+        if (!slash)
+            continue;
+        parent = g_strndup (check_xpath, slash - check_xpath + 1);
+        children = g_hash_table_lookup (searched, parent);
+        if (!children)
+        {
+            GList *found = apteryx_search (parent);
+
+            children = g_hash_table_new_full (g_str_hash, g_str_equal, free, NULL);
+            for (GList *child = found; child; child = g_list_next (child))
+                g_hash_table_add (children, child->data);
+            g_list_free (found);
+            g_hash_table_insert (searched, parent, children);
+        }
+        else
+            g_free (parent);
+
+        exists = g_hash_table_contains (children, check_xpath);
+        if (candidate)
+            exists = candidate_exists (check_xpath, exists);
+        if (exists && !expected)
+        {
+            *err_tag = NC_ERR_TAG_DATA_EXISTS;
+        }
+        else if (!exists && expected)
+        {
+            *err_tag = NC_ERR_TAG_DATA_MISSING;
+        }
     }
-    apteryx_free_tree (check_result);
 }
 
 /**
@@ -1839,6 +4004,113 @@ _handle_default_operation (xmlNode *action, char **def_op_pt)
     return true;
 }
 
+/* Turn an edit tree into a query for the current values of its leaves */
+static void
+edit_tree_strip_values (GNode *node)
+{
+    if (edit_node_is_leaf (node))
+    {
+        GNode *value = node->children;
+        g_node_unlink (value);
+        apteryx_free_tree (value);
+        return;
+    }
+    for (GNode *child = node->children; child; child = child->next)
+        edit_tree_strip_values (child);
+}
+
+/* Collect the paths below a replaced node that the new data does not have */
+static void
+edit_diff_extras (GNode *current, GNode *new, const char *path, GList **prunes)
+{
+    if (!new)
+    {
+        *prunes = g_list_append (*prunes, g_strdup (path));
+        return;
+    }
+    if (edit_node_is_leaf (current))
+        return;
+
+    for (GNode *child = current->children; child; child = child->next)
+    {
+        char *cpath;
+
+        if (!child->data)
+            continue;
+        cpath = g_strdup_printf ("%s/%s", path, APTERYX_NAME (child));
+        edit_diff_extras (child, edit_node_child (new, APTERYX_NAME (child)), cpath, prunes);
+        g_free (cpath);
+    }
+}
+
+/* Drop the leaves of an edit tree that already hold the value being set.
+ * Returns true if the node was emptied by doing so. */
+static bool
+edit_diff_trim (GNode *node, GNode *current, int *written, int *skipped)
+{
+    GNode *child;
+    GNode *next;
+
+    for (child = node->children; child; child = next)
+    {
+        GNode *cur;
+
+        next = child->next;
+        if (!child->data)
+            continue;
+
+        cur = edit_node_child (current, APTERYX_NAME (child));
+        if (edit_node_is_leaf (child))
+        {
+            const char *now = cur && cur->children ? APTERYX_NAME (cur->children) : NULL;
+            if (g_strcmp0 (now ?: "", APTERYX_NAME (child->children)) == 0)
+            {
+                g_node_unlink (child);
+                apteryx_free_tree (child);
+                (*skipped)++;
+            }
+            else
+                (*written)++;
+        }
+        else if (edit_diff_trim (child, cur, written, skipped))
+        {
+            g_node_unlink (child);
+            apteryx_free_tree (child);
+        }
+    }
+    return node->children == NULL;
+}
+
+/* Work out the minimal changes for an edit. Replaced subtrees become prunes of
+ * the data the replacement does not have, and leaves that already hold their
+ * new value are dropped from the tree. Returns the current values of the
+ * leaves in the tree, to trim it with once the conditions are checked. */
+static GNode *
+edit_diff_prepare (GNode *tree, GList *replaces, GList **prunes)
+{
+    GNode *query;
+    GNode *current = NULL;
+
+    for (GList *iter = replaces; iter; iter = g_list_next (iter))
+    {
+        const char *path = (const char *) iter->data;
+        GNode *existing = apteryx_get_tree (path);
+
+        if (existing)
+            edit_diff_extras (existing, tree ? edit_tree_find (tree, path) : NULL, path, prunes);
+        apteryx_free_tree (existing);
+    }
+
+    if (tree)
+    {
+        query = g_node_copy_deep (tree, copy_node_data, NULL);
+        edit_tree_strip_values (query);
+        current = apteryx_query (query);
+        apteryx_free_tree (query);
+    }
+    return current;
+}
+
 static char *
 split_path_value (char *path)
 {
@@ -1850,80 +4122,532 @@ split_path_value (char *path)
     }
     if (!value || strlen (value) == 0)
     {
-        value = "";
+        value = "";
+    }
+    return value;
+}
+
+/* The lock of the datastore named by a target element, or NULL if the
+ * datastore is not supported */
+static struct _ds_lock_t *
+target_ds_lock (xmlNode *node)
+{
+    if (!node || !xmlFirstElementChild (node))
+        return NULL;
+    if (xmlStrcmp (xmlFirstElementChild (node)->name, BAD_CAST "running") == 0)
+        return &running_ds_lock;
+    if (xmlStrcmp (xmlFirstElementChild (node)->name, BAD_CAST "candidate") == 0)
+        return &candidate_ds_lock;
+    return NULL;
+}
+
+/* The value of a list key as written in an instance identifier */
+static void
+node_id_append_key (GString *node_id, const char *prefix, const char *key, const char *value)
+{
+    char quote = strchr (value, '\'') ? '"' : '\'';
+
+    g_string_append_printf (node_id, "[%s%s%s=%c%s%c]", prefix ? prefix : "", prefix ? ":" : "",
+                            key, quote, value, quote);
+}
+
+/* Resolve a partial-lock select expression to the path it locks and the
+ * instance identifier of the locked node. Only absolute location paths with
+ * key predicates are supported. */
+static bool
+partial_lock_resolve (const char *select, char **path, char **node_id)
+{
+    sch_node *root = sch_get_root_schema (g_schema);
+    xpath_type x_type = XPATH_SIMPLE;
+    sch_node *qschema = NULL;
+    GList *chain = NULL;
+    GList *iter;
+    GNode *query;
+    GNode *node;
+    GString *lpath;
+    GString *lid;
+
+    if (!select || select[0] != '/' || strstr (select, "//") || strchr (select, '|') ||
+        strchr (select, '*'))
+        return false;
+    query = sch_xpath_to_gnode (g_schema, NULL, select, SCH_F_XPATH, &qschema, &x_type, NULL);
+    if (!query || !qschema || x_type != XPATH_SIMPLE)
+    {
+        apteryx_free_tree (query);
+        return false;
+    }
+
+    /* Schema nodes from the top level down to the one selected */
+    for (sch_node *schema = qschema; schema && schema != root; schema = sch_node_parent (schema))
+        chain = g_list_prepend (chain, schema);
+
+    /* Follow the query down alongside them. The top level node keeps any
+     * prefix it is stored under. */
+    lpath = g_string_new (NULL);
+    lid = g_string_new (NULL);
+    node = query;
+    for (iter = chain; iter && node; iter = g_list_next (iter))
+    {
+        sch_node *schema = iter->data;
+        sch_node *parent = sch_node_parent (schema);
+        bool entry = parent && parent != root && sch_is_list (parent);
+        sch_ns *ns = sch_node_ns (schema);
+        const char *prefix = ns ? sch_ns_prefix (g_schema, ns) : NULL;
+        GNode *next = NULL;
+
+        if (node == query)
+            g_string_append (lpath, APTERYX_NAME (node));
+        else if (entry)
+        {
+            /* List keys are encoded as in the database */
+            g_string_append_c (lpath, '/');
+            for (const char *c = APTERYX_NAME (node); *c; c++)
+            {
+                if (*c == '/')
+                    g_string_append (lpath, "%2F");
+                else
+                    g_string_append_c (lpath, *c);
+            }
+        }
+        else
+            g_string_append_printf (lpath, "/%s", APTERYX_NAME (node));
+
+        if (entry)
+        {
+            char *key = sch_list_key (parent);
+
+            node_id_append_key (lid, prefix, key, APTERYX_NAME (node));
+            g_free (key);
+        }
+        else
+        {
+            char *name = sch_name (schema);
+            char *colon = strchr (name, ':');
+
+            g_string_append_printf (lid, "/%s%s%s", prefix ? prefix : "", prefix ? ":" : "",
+                                    colon ? colon + 1 : name);
+            g_free (name);
+        }
+
+        /* The query node for the next schema node down */
+        if (iter->next && sch_is_list (schema))
+            next = node->children;
+        else if (iter->next)
+        {
+            char *name = sch_name (iter->next->data);
+            char *colon = strchr (name, ':');
+
+            next = edit_node_child (node, colon ? colon + 1 : name);
+            g_free (name);
+        }
+        node = next;
+    }
+    g_list_free (chain);
+    apteryx_free_tree (query);
+
+    if (iter || !lpath->len)
+    {
+        g_string_free (lpath, true);
+        g_string_free (lid, true);
+        return false;
+    }
+    *path = g_string_free (lpath, false);
+    *node_id = g_string_free (lid, false);
+    return true;
+}
+
+static GNode *
+lock_scope_child (GNode *node, const char *name)
+{
+    for (GNode *child = node->children; child; child = child->next)
+    {
+        if (g_strcmp0 (((struct lock_scope *) child->data)->name, name) == 0)
+            return child;
+    }
+    return NULL;
+}
+
+/* True if a node is locked by a session other than the given one */
+static bool
+lock_scope_held (GNode *node, uint32_t session_id)
+{
+    struct lock_scope *scope = node->data;
+
+    for (GList *iter = scope->holders; iter; iter = g_list_next (iter))
+    {
+        if (((struct partial_lock *) iter->data)->session_id != session_id)
+            return true;
+    }
+    return false;
+}
+
+/* True if anything at or below a node is locked by another session */
+static bool
+lock_scope_held_below (GNode *node, uint32_t session_id)
+{
+    if (((struct lock_scope *) node->data)->locks == 0)
+        return false;
+    if (lock_scope_held (node, session_id))
+        return true;
+    for (GNode *child = node->children; child; child = child->next)
+    {
+        if (lock_scope_held_below (child, session_id))
+            return true;
+    }
+    return false;
+}
+
+/* True if another session holds a partial lock at, above or below a path.
+ * Called with the partial locks locked. */
+static bool
+lock_scope_conflict_path (uint32_t session_id, const char *path)
+{
+    gchar **parts = g_strsplit (path, "/", -1);
+    GNode *node = partial_lock_scopes;
+    bool conflict = false;
+
+    for (int i = 0; parts[i] && node; i++)
+    {
+        if (parts[i][0] == '\0')
+            continue;
+        node = lock_scope_child (node, parts[i]);
+        if (node && lock_scope_held (node, session_id))
+        {
+            conflict = true;
+            break;
+        }
+    }
+    if (!conflict && node)
+        conflict = lock_scope_held_below (node, session_id);
+    g_strfreev (parts);
+    return conflict;
+}
+
+/* True if a set tree touches a node locked by another session */
+static bool
+lock_scope_conflict_tree (GNode *scope, GNode *node, uint32_t session_id)
+{
+    for (GNode *child = node->children; child; child = child->next)
+    {
+        GNode *match;
+
+        if (!child->data)
+            continue;
+        match = lock_scope_child (scope, APTERYX_NAME (child));
+        if (match && (lock_scope_held (match, session_id) ||
+                      (((struct lock_scope *) match->data)->locks &&
+                       lock_scope_conflict_tree (match, child, session_id))))
+            return true;
+    }
+    return false;
+}
+
+/* True if a change to running by a session touches a partial lock held by
+ * another session. The tree may be rooted at "/" or at its top node. */
+static bool
+partial_lock_denied (uint32_t session_id, GList *paths, GNode *tree)
+{
+    bool conflict = false;
+
+    g_mutex_lock (&partial_lock_mutex);
+    if (partial_lock_scopes)
+    {
+        for (GList *iter = paths; iter && !conflict; iter = g_list_next (iter))
+            conflict = lock_scope_conflict_path (session_id, (const char *) iter->data);
+        if (!conflict && tree && g_strcmp0 (APTERYX_NAME (tree), "/") == 0)
+        {
+            conflict = lock_scope_conflict_tree (partial_lock_scopes, tree, session_id);
+        }
+        else if (!conflict && tree)
+        {
+            GNode *match = lock_scope_child (partial_lock_scopes, APTERYX_NAME (tree) + 1);
+
+            conflict = match && (lock_scope_held (match, session_id) ||
+                                 lock_scope_conflict_tree (match, tree, session_id));
+        }
+    }
+    g_mutex_unlock (&partial_lock_mutex);
+    return conflict;
+}
+
+/* Add a path to the partial lock index. Called with the partial locks locked. */
+static void
+lock_scope_add (struct partial_lock *lock, const char *path)
+{
+    gchar **parts = g_strsplit (path, "/", -1);
+    GNode *node;
+
+    if (!partial_lock_scopes)
+        partial_lock_scopes = g_node_new (g_malloc0 (sizeof (struct lock_scope)));
+    node = partial_lock_scopes;
+    ((struct lock_scope *) node->data)->locks++;
+    for (int i = 0; parts[i]; i++)
+    {
+        GNode *child;
+
+        if (parts[i][0] == '\0')
+            continue;
+        child = lock_scope_child (node, parts[i]);
+        if (!child)
+        {
+            struct lock_scope *scope = g_malloc0 (sizeof (struct lock_scope));
+
+            scope->name = g_strdup (parts[i]);
+            child = g_node_append_data (node, scope);
+        }
+        node = child;
+        ((struct lock_scope *) node->data)->locks++;
+    }
+    ((struct lock_scope *) node->data)->holders =
+        g_list_append (((struct lock_scope *) node->data)->holders, lock);
+    g_strfreev (parts);
+}
+
+/* Remove a path from the partial lock index, dropping nodes that no longer
+ * lead to a lock. Called with the partial locks locked. */
+static void
+lock_scope_remove (struct partial_lock *lock, const char *path)
+{
+    gchar **parts = g_strsplit (path, "/", -1);
+    GNode *node = partial_lock_scopes;
+    struct lock_scope *scope = node->data;
+
+    scope->locks--;
+    for (int i = 0; parts[i]; i++)
+    {
+        if (parts[i][0] == '\0')
+            continue;
+        node = lock_scope_child (node, parts[i]);
+        scope = node->data;
+        scope->locks--;
+    }
+    scope->holders = g_list_remove (scope->holders, lock);
+    g_strfreev (parts);
+
+    while (node && ((struct lock_scope *) node->data)->locks == 0)
+    {
+        GNode *parent = node->parent;
+
+        scope = node->data;
+        g_free (scope->name);
+        g_free (scope);
+        g_node_destroy (node);
+        node = parent;
+    }
+    if (!node)
+        partial_lock_scopes = NULL;
+}
+
+/* Release a partial lock. Called with the partial locks locked. */
+static void
+partial_lock_release (struct partial_lock *lock)
+{
+    for (GList *iter = lock->paths; iter; iter = g_list_next (iter))
+        lock_scope_remove (lock, (const char *) iter->data);
+    partial_locks = g_list_remove (partial_locks, lock);
+    g_list_free_full (lock->nodes, g_free);
+    g_list_free_full (lock->paths, g_free);
+    g_free (lock);
+}
+
+/* Release all the partial locks of a session, or of every session if 0 */
+static void
+partial_lock_release_session (uint32_t session_id)
+{
+    GList *next;
+
+    g_mutex_lock (&partial_lock_mutex);
+    for (GList *iter = partial_locks; iter; iter = next)
+    {
+        struct partial_lock *lock = iter->data;
+
+        next = g_list_next (iter);
+        if (session_id == 0 || lock->session_id == session_id)
+            partial_lock_release (lock);
+    }
+    g_mutex_unlock (&partial_lock_mutex);
+}
+
+/* True if a session other than the given one holds a partial lock */
+static bool
+partial_lock_held_by_other (uint32_t session_id)
+{
+    bool held = false;
+
+    g_mutex_lock (&partial_lock_mutex);
+    for (GList *iter = partial_locks; iter && !held; iter = g_list_next (iter))
+        held = ((struct partial_lock *) iter->data)->session_id != session_id;
+    g_mutex_unlock (&partial_lock_mutex);
+    return held;
+}
+
+/* Prune the delete, remove and replace paths of an edit from running or the
+ * candidate. Paths at or below another are covered by it and skipped. */
+static bool
+edit_prune (GList *deletes, GList *removes, GList *replaces, bool candidate)
+{
+    GList *lists[] = { deletes, removes, replaces };
+    GList *paths = NULL;
+    uint32_t total = 0;
+    uint32_t count;
+    bool ret = true;
+
+    for (unsigned int i = 0; i < G_N_ELEMENTS (lists); i++)
+    {
+        for (GList *iter = lists[i]; iter; iter = g_list_next (iter))
+        {
+            paths_add_minimal (&paths, (const char *) iter->data);
+            total++;
+        }
+    }
+    count = g_list_length (paths);
+
+    for (GList *iter = paths; iter; iter = g_list_next (iter))
+    {
+        if (candidate)
+            candidate_prune (iter->data);
+        else if (!apteryx_prune (iter->data))
+        {
+            ret = false;
+            break;
+        }
+    }
+    g_list_free_full (paths, g_free);
+
+    g_mutex_lock (&edit_prune_lock);
+    edit_prune_stats.executed += count;
+    edit_prune_stats.saved += total - count;
+    g_mutex_unlock (&edit_prune_lock);
+    return ret;
+}
+
+/* Check the conditions of an edit, evaluating each path and condition once */
+static bool
+edit_conditions (sch_xml_to_gnode_parms parms, GNode *tree)
+{
+    GHashTable *memo = g_hash_table_new_full (g_str_hash, g_str_equal, g_free, NULL);
+    bool ret = true;
+
+    for (GList *iter = sch_parm_conditions (parms); iter; iter = g_list_next (iter))
+    {
+        GList *next = g_list_next (iter);
+
+        if (next && !sch_condition_evaluate (g_schema, tree, (char *) iter->data,
+                                             (char *) next->data, memo))
+        {
+            ret = false;
+            break;
+        }
+        iter = next;
+    }
+    g_hash_table_destroy (memo);
+    return ret;
+}
+
+/* Snapshot the data an edit prunes or sets */
+static struct snapshot *
+edit_snapshot (sch_xml_to_gnode_parms parms, GNode *tree)
+{
+    GList *paths = NULL;
+    GList *iter;
+
+    for (iter = sch_parm_deletes (parms); iter; iter = g_list_next (iter))
+        paths_add_minimal (&paths, (const char *) iter->data);
+    for (iter = sch_parm_removes (parms); iter; iter = g_list_next (iter))
+        paths_add_minimal (&paths, (const char *) iter->data);
+    for (iter = sch_parm_replaces (parms); iter; iter = g_list_next (iter))
+        paths_add_minimal (&paths, (const char *) iter->data);
+    if (tree)
+        snapshot_add_tree (&paths, tree, APTERYX_NAME (tree));
+    return snapshot_take (paths);
+}
+
+/* Copy the running data below the parts of running an edit sets, under the
+ * top level node of the edit. Data below the paths it prunes is left out. */
+static GNode *
+edit_running (GNode *tree, GList *prunes)
+{
+    const char *root = APTERYX_NAME (tree);
+    GNode *view = APTERYX_NODE (NULL, g_strdup (root));
+    GList *paths = NULL;
+
+    snapshot_add_tree (&paths, tree, root);
+    for (GList *iter = paths; iter; iter = g_list_next (iter))
+    {
+        const char *path = (const char *) iter->data;
+        const char *rest = path + strlen (root);
+        GNode *node = view;
+        GNode *data;
+        GList *prune;
+        gchar **parts;
+
+        for (prune = prunes; prune; prune = g_list_next (prune))
+        {
+            if (path_is_below (path, (const char *) prune->data))
+                break;
+        }
+        if (prune || !(data = apteryx_get_tree (path)))
+            continue;
+
+        parts = g_strsplit (rest[0] == '/' ? rest + 1 : rest, "/", -1);
+        for (int i = 0; parts[i] && parts[i][0]; i++)
+        {
+            GNode *child = edit_node_child (node, parts[i]);
+
+            node = child ? child : APTERYX_NODE (node, g_strdup (parts[i]));
+        }
+        g_strfreev (parts);
+        while (data->children)
+        {
+            GNode *child = data->children;
+
+            g_node_unlink (child);
+            g_node_append (node, child);
+        }
+        apteryx_free_tree (data);
     }
-    return value;
+    g_list_free_full (paths, g_free);
+    return view;
 }
 
+/* Validate the contents of a config element and, unless only testing, apply
+ * them to running or hold them in the candidate. Running can be put back as
+ * it was if applying fails. The contents may already have been converted, in
+ * which case parms and edit_op are taken over. */
 static bool
-handle_edit (struct netconf_session *session, xmlNode * rpc)
+_edit_config (struct netconf_session *session, xmlNode *rpc, xmlNode *node,
+              sch_xml_to_gnode_parms parms, char *edit_op, char *def_op,
+              bool candidate, bool test_only, bool rollback)
 {
-    xmlNode *action = xmlFirstElementChild (rpc);
-    xmlNode *node;
     GNode *tree = NULL;
-    sch_xml_to_gnode_parms parms;
     sch_node *qschema = NULL;
     int schflags = 0;
     GList *iter;
-    char *exists;
     bool ret = false;
-    char *def_op = NULL;
-    char *new_op = NULL;
+    char *new_op = edit_op;
+    /* Edits to the candidate are held until they are committed */
+    bool diff = netconf_edit_diff && !candidate && !test_only;
+    GNode *current = NULL;
+    GList *extras = NULL;
+    struct snapshot *snapshot = NULL;
+    GList *paths;
+    bool ok;
 
     if (apteryx_netconf_verbose)
         schflags |= SCH_F_DEBUG;
 
-    /* Check the target */
-    node = xmlFindNodeByName (action, BAD_CAST "target");
-    if (!node || !xmlFirstElementChild (node) ||
-        xmlStrcmp (xmlFirstElementChild (node)->name, BAD_CAST "running"))
-    {
-        gchar *error_msg = g_strdup_printf ("Datastore \"%s\" not supported",
-                                            (char *) xmlFirstElementChild (node)->name);
-        VERBOSE ("%s\n", error_msg);
-        ret = send_rpc_error_full (session, rpc, NC_ERR_TAG_OPR_NOT_SUPPORTED, NC_ERR_TYPE_PROTOCOL,
-                                   error_msg, NULL, NULL, true);
-        g_free (error_msg);
-        return ret;
-    }
-
-    /* Check and record default-operation */
-    if (!_handle_default_operation (action, &def_op))
-    {
-        return send_rpc_error_full (session, rpc, NC_ERR_TAG_INVALID_VAL, NC_ERR_TYPE_PROTOCOL,
-                                    "Invalid value for default-operation parameter", NULL, NULL, true);
-    }
-
-    //TODO Check test-option
-    //TODO Check error-option
-
-    /* Validate lock if configured on the running datastore */
-    if (running_ds_lock.locked == TRUE && (session->id != running_ds_lock.nc_sess.id))
-    {
-        /* A lock is already held by another NETCONF session, return in-use */
-        VERBOSE ("Lock failed, lock is already held\n");
-        ret = send_rpc_error_full (session, rpc, NC_ERR_TAG_IN_USE, NC_ERR_TYPE_APP,
-                                   "Lock is already held", NULL, NULL, false);
-        return ret;
-    }
-
-    /* Find the config */
-    node = xmlFindNodeByName (action, BAD_CAST "config");
-    if (!node)
-    {
-        VERBOSE ("Missing \"config\" element\n");
-        ret = send_rpc_error_full (session, rpc, NC_ERR_TAG_MISSING_ELEM, NC_ERR_TYPE_PROTOCOL,
-                                   "Missing config element", "config", NULL, false);
-        return ret;
-    }
-
-    /* Convert to gnode */
-    parms =
-        sch_xml_to_gnode (g_schema, NULL, xmlFirstElementChild (node), schflags, def_op,
-                          true, &qschema, &new_op);
+    /* Convert to gnode, unless that was done as the message was parsed */
+    if (!parms)
+        parms =
+            sch_xml_to_gnode (g_schema, NULL, xmlFirstElementChild (node), schflags, def_op,
+                              true, &qschema, &new_op);
 
     tree = sch_parm_tree (parms);
 
+    /* Only the rpc element is needed for the reply */
+    xmlUnlinkNode (node);
+    xmlFreeNode (node);
+
     nc_error_parms error_parms = sch_parm_error (parms);
 
     if (error_parms.tag != 0)
@@ -1931,8 +4655,7 @@ handle_edit (struct netconf_session *session, xmlNode * rpc)
         VERBOSE ("error parsing XML\n");
         if (error_parms.type == NC_ERR_TYPE_RPC)
         {
-            session->counters.in_bad_rpcs++;
-            netconf_global_stats.session_totals.in_bad_rpcs++;
+            g_atomic_int_inc (&session->counters.in_bad_rpcs);
         }
         ret = _send_rpc_error (session, rpc, error_parms);
         sch_parm_free (parms);
@@ -1942,16 +4665,17 @@ handle_edit (struct netconf_session *session, xmlNode * rpc)
 
     /* Check delete and create paths */
     NC_ERR_TAG err_tag = NC_ERR_TAG_UNKNOWN;
-    for (iter = sch_parm_deletes (parms); iter; iter = g_list_next (iter))
-    {
-        _check_exist ((char *) iter->data, &err_tag, true);
-    }
-    for (iter = sch_parm_creates (parms); iter; iter = g_list_next (iter))
-    {
-        _check_exist ((char *) iter->data, &err_tag, false);
-    }
+    GHashTable *searched = g_hash_table_new_full (g_str_hash, g_str_equal, g_free,
+                                                  (GDestroyNotify) g_hash_table_destroy);
+    if (candidate)
+        g_mutex_lock (&candidate_lock);
+    _check_exist (sch_parm_deletes (parms), searched, &err_tag, true, candidate);
+    _check_exist (sch_parm_creates (parms), searched, &err_tag, false, candidate);
+    g_hash_table_destroy (searched);
     if (err_tag != NC_ERR_TAG_UNKNOWN)
     {
+        if (candidate)
+            g_mutex_unlock (&candidate_lock);
         VERBOSE ("error in delete or create paths\n");
         ret = send_rpc_error_full (session, rpc, err_tag, NC_ERR_TYPE_APP, NULL, NULL, NULL, true);
         sch_parm_free (parms);
@@ -1959,60 +4683,141 @@ handle_edit (struct netconf_session *session, xmlNode * rpc)
         return ret;
     }
 
-    /* Delete delete, remove and replace paths */
-    for (iter = sch_parm_deletes (parms); iter; iter = g_list_next (iter))
+    /* Parts of running may be partially locked by other sessions */
+    if (!candidate)
     {
-        apteryx_prune (iter->data);
+        bool denied;
+
+        paths = g_list_concat (g_list_copy (sch_parm_deletes (parms)),
+                               g_list_concat (g_list_copy (sch_parm_removes (parms)),
+                                              g_list_copy (sch_parm_replaces (parms))));
+        denied = partial_lock_denied (session->id, paths, tree);
+        g_list_free (paths);
+        if (denied)
+        {
+            VERBOSE ("Edit failed, partial lock is held\n");
+            ret = send_rpc_error_full (session, rpc, NC_ERR_TAG_IN_USE, NC_ERR_TYPE_APP,
+                                       "Partial lock is already held", NULL, NULL, true);
+            sch_parm_free (parms);
+            apteryx_free_tree (tree);
+            return ret;
+        }
     }
-    for (iter = sch_parm_removes (parms); iter; iter = g_list_next (iter))
+
+    //TODO - permissions
+    //TODO - patterns
+
+    /* Check the conditions before changing anything, against the data as
+     * the edit would leave it */
+    paths = g_list_concat (g_list_copy (sch_parm_deletes (parms)),
+                           g_list_concat (g_list_copy (sch_parm_removes (parms)),
+                                          g_list_copy (sch_parm_replaces (parms))));
+    if (!sch_parm_conditions (parms))
+        ok = true;
+    else if (candidate)
+    {
+        /* Edits to the candidate see its pending changes as well as their own */
+        GNode *view = candidate_view (tree, paths);
+
+        ok = edit_conditions (parms, view);
+        apteryx_free_tree (view);
+    }
+    else if (paths && tree)
     {
-        apteryx_prune (iter->data);
+        GNode *view = edit_view (edit_running (tree, paths), tree, paths);
+
+        ok = edit_conditions (parms, view);
+        apteryx_free_tree (view);
     }
-    for (iter = sch_parm_replaces (parms); iter; iter = g_list_next (iter))
+    else
     {
-        apteryx_prune (iter->data);
+        ok = edit_conditions (parms, tree);
+    }
+    g_list_free (paths);
+    if (!ok)
+    {
+        if (candidate)
+            g_mutex_unlock (&candidate_lock);
+        ret = send_rpc_error_full (session, rpc, NC_ERR_TAG_INVALID_VAL, NC_ERR_TYPE_PROTOCOL, NULL, NULL, NULL, true);
+        sch_parm_free (parms);
+        apteryx_free_tree (tree);
+        return ret;
     }
 
-    //TODO - permissions
-    //TODO - patterns
-
-    /* For a create make sure the data does not already exist */
-    for (iter = sch_parm_creates (parms); iter; iter = g_list_next (iter))
+    /* Nothing more to do if only validating */
+    if (test_only)
     {
-        exists = apteryx_get ((char *) iter->data);
-        if (exists)
-        {
-            g_free (exists);
-            ret = send_rpc_error_full (session, rpc, NC_ERR_TAG_DATA_EXISTS, NC_ERR_TYPE_APP, NULL, NULL, NULL, true);
-            apteryx_free_tree (tree);
-            sch_parm_free (parms);
-            return ret;
-        }
+        if (candidate)
+            g_mutex_unlock (&candidate_lock);
+        sch_parm_free (parms);
+        apteryx_free_tree (tree);
+        g_atomic_int_inc (&session->counters.in_rpcs);
+        return send_rpc_ok (session, rpc, false);
     }
 
-    for (iter = sch_parm_conditions (parms); iter; iter = g_list_next (iter))
+    /* Only write what changes if configured to */
+    if (diff)
+        current = edit_diff_prepare (tree, sch_parm_replaces (parms), &extras);
+
+    /* Capture everything the edit can change to put back if it fails */
+    if (rollback && !candidate)
+        snapshot = edit_snapshot (parms, tree);
+
+    /* Delete delete, remove and replace paths */
+    ok = edit_prune (sch_parm_deletes (parms), sch_parm_removes (parms),
+                     diff ? extras : sch_parm_replaces (parms), candidate);
+
+    if (diff)
     {
-        GList *next = g_list_next (iter);
+        int written = 0;
+        int skipped = 0;
 
-        if (next && !sch_process_condition (g_schema, tree, (char *) iter->data, (char *) next->data))
+        if (tree && edit_diff_trim (tree, current, &written, &skipped))
         {
-            ret = send_rpc_error_full (session, rpc, NC_ERR_TAG_INVALID_VAL, NC_ERR_TYPE_PROTOCOL, NULL, NULL, NULL, true);
-            sch_parm_free (parms);
             apteryx_free_tree (tree);
-            return ret;
+            tree = NULL;
         }
-        iter = next;
+        DEBUG ("NETCONF: EDIT diff wrote %d skipped %d pruned %d\n", written, skipped,
+               g_list_length (extras));
+        g_mutex_lock (&edit_diff_lock);
+        edit_diff_stats.edits++;
+        edit_diff_stats.written += written;
+        edit_diff_stats.skipped += skipped;
+        edit_diff_stats.pruned += g_list_length (extras);
+        g_mutex_unlock (&edit_diff_lock);
+        apteryx_free_tree (current);
+        g_list_free_full (extras, g_free);
+    }
+
+    /* Edit database. Anything pruned above is already gone from running, so
+     * readers can see the edit half applied until this set is done. */
+    DEBUG ("NETCONF: SET %s need_set %d%s\n", tree ? APTERYX_NAME (tree) : "NULL",
+           sch_parm_need_tree_set (parms), candidate ? " (candidate)" : "");
+    if (candidate)
+    {
+        if (tree && sch_parm_need_tree_set (parms))
+            candidate_merge (tree);
+        g_mutex_unlock (&candidate_lock);
+    }
+    else if (ok && tree && sch_parm_need_tree_set (parms))
+    {
+        ok = apteryx_set_tree (tree);
     }
 
-    /* Edit database */
-    DEBUG ("NETCONF: SET %s need_set %d\n", tree ? APTERYX_NAME (tree) : "NULL", sch_parm_need_tree_set (parms));
-    if (tree && sch_parm_need_tree_set (parms) && !apteryx_set_tree (tree))
+    if (!ok)
     {
+        if (snapshot)
+        {
+            VERBOSE ("EDIT-CONFIG: rolling back\n");
+            snapshot_restore (snapshot);
+        }
         ret = send_rpc_error_full (session, rpc, NC_ERR_TAG_OPR_FAILED, NC_ERR_TYPE_APP, NULL, NULL, NULL, true);
         apteryx_free_tree (tree);
         sch_parm_free (parms);
         return ret;
     }
+    if (snapshot)
+        snapshot_free (snapshot);
 
     if ((logging & LOG_EDIT_CONFIG))
     {
@@ -2021,45 +4826,384 @@ handle_edit (struct netconf_session *session, xmlNode * rpc)
         for (iter = sch_parm_deletes (parms); iter; iter = g_list_next (iter))
         {
             NOTICE ("EDIT-CONFIG: %s@%s id:%d delete:%s\n",
-                    session->username, session->rem_addr, session->id, (char *) iter->data);
+                    session->username, session_data (session)->rem_addr, session->id,
+                    (char *) iter->data);
         }
         for (iter = sch_parm_removes (parms); iter; iter = g_list_next (iter))
         {
             NOTICE ("EDIT-CONFIG: %s@%s id:%d remove:%s\n",
-                    session->username, session->rem_addr, session->id, (char *) iter->data);
+                    session->username, session_data (session)->rem_addr, session->id,
+                    (char *) iter->data);
         }
         /* Note replace is covered by an equivalent merge */
         for (iter = sch_parm_creates (parms); iter; iter = g_list_next (iter))
         {
             value = split_path_value ((char *) iter->data);
             NOTICE ("EDIT-CONFIG: %s@%s id:%d create:%s=%s\n",
-                    session->username, session->rem_addr, session->id,
+                    session->username, session_data (session)->rem_addr, session->id,
                     (char *) iter->data, value);
         }
         for (iter = sch_parm_merges (parms); iter; iter = g_list_next (iter))
         {
             value = split_path_value ((char *) iter->data);
             NOTICE ("EDIT-CONFIG: %s@%s id:%d %s:%s=%s\n",
-                    session->username, session->rem_addr, session->id,
+                    session->username, session_data (session)->rem_addr, session->id,
                     new_op ?: "merge", (char *) iter->data, value);
         }
     }
 
-    sch_parm_free (parms);
-    apteryx_free_tree (tree);
+    sch_parm_free (parms);
+    apteryx_free_tree (tree);
+
+    /* Success */
+    g_atomic_int_inc (&session->counters.in_rpcs);
+    return send_rpc_ok (session, rpc, false);
+}
+
+/* Free the converted configuration of an edit that is not going ahead */
+static void
+edit_parms_free (sch_xml_to_gnode_parms parms)
+{
+    if (parms)
+    {
+        apteryx_free_tree (sch_parm_tree (parms));
+        sch_parm_free (parms);
+    }
+}
+
+/* Move a reader on to the next element at a depth, stopping at the end of
+ * the element holding it */
+static xmlNode *
+reader_element (xmlTextReaderPtr reader, int depth, int rc)
+{
+    while (rc == 1 && xmlTextReaderDepth (reader) >= depth)
+    {
+        if (xmlTextReaderDepth (reader) == depth &&
+            xmlTextReaderNodeType (reader) == XML_READER_TYPE_ELEMENT)
+            return xmlTextReaderCurrentNode (reader);
+        rc = xmlTextReaderNext (reader);
+    }
+    return NULL;
+}
+
+/* Parse an edit-config, converting its configuration while it is read so
+ * that the whole of a large edit is never held as a document. The document
+ * returned holds the rpc and edit-config elements with the other parameters
+ * and an empty config element, to be handled as usual. Other RPCs, messages
+ * that do not parse and a default-operation after the config are left to the
+ * document parser, with NULL returned. */
+static xmlDoc *
+edit_stream_parse (const char *message, int len, sch_xml_to_gnode_parms *parms,
+                   char **edit_op)
+{
+    xmlTextReaderPtr reader = xmlReaderForMemory (message, len, NULL, NULL, 0);
+    int schflags = apteryx_netconf_verbose ? SCH_F_DEBUG : 0;
+    xmlDoc *doc = NULL;
+    xmlNode *action;
+    xmlNode *node;
+    char *def_op;
+    bool ok = true;
+    int rc;
+
+    *parms = NULL;
+    if (!reader)
+        return NULL;
+
+    node = reader_element (reader, 0, xmlTextReaderRead (reader));
+    if (!node || g_strcmp0 ((char *) node->name, "rpc") != 0)
+    {
+        xmlFreeTextReader (reader);
+        return NULL;
+    }
+    doc = xmlNewDoc (BAD_CAST "1.0");
+    xmlDocSetRootElement (doc, xmlDocCopyNode (node, doc, 2));
+    node = reader_element (reader, 1, xmlTextReaderRead (reader));
+    if (!node || g_strcmp0 ((char *) node->name, "edit-config") != 0)
+    {
+        xmlFreeDoc (doc);
+        xmlFreeTextReader (reader);
+        return NULL;
+    }
+    action = xmlDocCopyNode (node, doc, 2);
+    xmlAddChild (xmlDocGetRootElement (doc), action);
+
+    for (node = reader_element (reader, 2, xmlTextReaderRead (reader)); node && ok;
+         node = reader_element (reader, 2, xmlTextReaderNext (reader)))
+    {
+        if (g_strcmp0 ((char *) node->name, "config") == 0)
+        {
+            if (*parms)
+                continue;
+            xmlAddChild (action, xmlDocCopyNode (node, doc, 2));
+            if (!_handle_default_operation (action, &def_op))
+            {
+                ok = false;
+                break;
+            }
+            /* Only the first top level element is converted */
+            if (xmlTextReaderIsEmptyElement (reader) == 0 &&
+                reader_element (reader, 3, xmlTextReaderRead (reader)))
+            {
+                *parms = sch_reader_to_gnode (g_schema, reader, schflags, def_op, true,
+                                              NULL, edit_op);
+                rc = xmlTextReaderNext (reader);
+                while (rc == 1 && xmlTextReaderDepth (reader) > 2)
+                    rc = xmlTextReaderNext (reader);
+            }
+            else
+                *parms = sch_xml_to_gnode (g_schema, NULL, NULL, schflags, def_op, true,
+                                           NULL, edit_op);
+        }
+        else if (*parms && g_strcmp0 ((char *) node->name, "default-operation") == 0)
+            ok = false;
+        else if (xmlTextReaderExpand (reader))
+            xmlAddChild (action, xmlDocCopyNode (node, doc, 1));
+    }
+
+    /* The rest of the message must still parse */
+    while ((rc = xmlTextReaderRead (reader)) == 1)
+        ;
+    xmlFreeTextReader (reader);
+    if (!ok || rc < 0)
+    {
+        edit_parms_free (*parms);
+        *parms = NULL;
+        xmlFreeDoc (doc);
+        return NULL;
+    }
+    return doc;
+}
+
+/* Handle an edit-config, taking over its configuration if that was converted
+ * as the message was parsed */
+static bool
+handle_edit (struct netconf_session *session, xmlNode * rpc, sch_xml_to_gnode_parms parms,
+             char *edit_op)
+{
+    xmlNode *action = xmlFirstElementChild (rpc);
+    xmlNode *node;
+    bool ret = false;
+    char *def_op = NULL;
+    struct _ds_lock_t *ds_lock;
+    bool test_only = false;
+    bool rollback = false;
+
+    /* Check the target */
+    node = xmlFindNodeByName (action, BAD_CAST "target");
+    ds_lock = target_ds_lock (node);
+    if (!ds_lock)
+    {
+        gchar *error_msg = g_strdup_printf ("Datastore \"%s\" not supported",
+                                            (char *) xmlFirstElementChild (node)->name);
+        VERBOSE ("%s\n", error_msg);
+        ret = send_rpc_error_full (session, rpc, NC_ERR_TAG_OPR_NOT_SUPPORTED, NC_ERR_TYPE_PROTOCOL,
+                                   error_msg, NULL, NULL, true);
+        g_free (error_msg);
+        edit_parms_free (parms);
+        return ret;
+    }
+
+    /* Check and record default-operation */
+    if (!_handle_default_operation (action, &def_op))
+    {
+        edit_parms_free (parms);
+        return send_rpc_error_full (session, rpc, NC_ERR_TAG_INVALID_VAL, NC_ERR_TYPE_PROTOCOL,
+                                    "Invalid value for default-operation parameter", NULL, NULL, true);
+    }
+
+    /* Check test-option */
+    node = xmlFindNodeByName (action, BAD_CAST "test-option");
+    if (node)
+    {
+        char *test_option = (char *) xmlNodeGetContent (node);
+
+        if (g_strcmp0 (test_option, "test-only") == 0)
+        {
+            test_only = true;
+        }
+        else if (g_strcmp0 (test_option, "test-then-set") != 0 &&
+                 g_strcmp0 (test_option, "set") != 0)
+        {
+            free (test_option);
+            edit_parms_free (parms);
+            return send_rpc_error_full (session, rpc, NC_ERR_TAG_INVALID_VAL, NC_ERR_TYPE_PROTOCOL,
+                                        "Invalid value for test-option parameter", NULL, NULL, true);
+        }
+        free (test_option);
+    }
+
+    /* Check error-option. An edit is applied with one set so there is
+     * nothing to continue with after an error. */
+    node = xmlFindNodeByName (action, BAD_CAST "error-option");
+    if (node)
+    {
+        char *error_option = (char *) xmlNodeGetContent (node);
+
+        if (g_strcmp0 (error_option, "rollback-on-error") == 0)
+        {
+            rollback = true;
+        }
+        else if (g_strcmp0 (error_option, "stop-on-error") != 0 &&
+                 g_strcmp0 (error_option, "continue-on-error") != 0)
+        {
+            free (error_option);
+            edit_parms_free (parms);
+            return send_rpc_error_full (session, rpc, NC_ERR_TAG_INVALID_VAL, NC_ERR_TYPE_PROTOCOL,
+                                        "Invalid value for error-option parameter", NULL, NULL, true);
+        }
+        free (error_option);
+    }
+
+    /* Validate lock if configured on the target datastore */
+    if (lock_held_by_other (ds_lock, session))
+    {
+        /* A lock is already held by another NETCONF session, return in-use */
+        VERBOSE ("Lock failed, lock is already held\n");
+        ret = send_rpc_error_lock (session, rpc, NC_ERR_TAG_IN_USE, NC_ERR_TYPE_APP,
+                                   "Lock is already held", ds_lock);
+        edit_parms_free (parms);
+        return ret;
+    }
+
+    /* Find the config */
+    node = xmlFindNodeByName (action, BAD_CAST "config");
+    if (!node)
+    {
+        VERBOSE ("Missing \"config\" element\n");
+        ret = send_rpc_error_full (session, rpc, NC_ERR_TAG_MISSING_ELEM, NC_ERR_TYPE_PROTOCOL,
+                                   "Missing config element", "config", NULL, false);
+        return ret;
+    }
+
+    return _edit_config (session, rpc, node, parms, edit_op, def_op,
+                         ds_lock == &candidate_ds_lock, test_only, rollback);
+}
+
+static bool
+handle_validate (struct netconf_session *session, xmlNode * rpc)
+{
+    xmlNode *action = xmlFirstElementChild (rpc);
+    xmlNode *node = xmlFindNodeByName (action, BAD_CAST "source");
+    xmlNode *source = node ? xmlFirstElementChild (node) : NULL;
+    bool ret;
+
+    /* Inline configuration is checked in the same way as a test-only edit */
+    if (source && xmlStrcmp (source->name, BAD_CAST "config") == 0)
+        return _edit_config (session, rpc, source, NULL, NULL, "merge", false, true, false);
+
+    /* Datastores only hold configuration that has already been validated */
+    if (!target_ds_lock (node))
+    {
+        gchar *error_msg = g_strdup_printf ("Datastore \"%s\" not supported",
+                                            source ? (char *) source->name : "");
+        VERBOSE ("%s\n", error_msg);
+        ret = send_rpc_error_full (session, rpc, NC_ERR_TAG_OPR_NOT_SUPPORTED, NC_ERR_TYPE_PROTOCOL,
+                                   error_msg, NULL, NULL, true);
+        g_free (error_msg);
+        return ret;
+    }
+
+    /* Success */
+    g_atomic_int_inc (&session->counters.in_rpcs);
+    return send_rpc_ok (session, rpc, false);
+}
+
+/* Called with the datastore lock mutex held */
+static void
+set_lock (struct _ds_lock_t *ds_lock, struct netconf_session *session)
+{
+    ds_lock->locked = TRUE;
+    ds_lock->nc_sess.id = session->id;
+    ds_lock->nc_sess.fd = session->fd;
+}
+
+/* Release a datastore lock, waking anyone waiting for it */
+static void
+reset_lock (struct _ds_lock_t *ds_lock)
+{
+    g_mutex_lock (&ds_lock_mutex);
+    ds_lock->locked = FALSE;
+    ds_lock->nc_sess.id = 0;
+    ds_lock->nc_sess.fd = -1;
+    g_cond_broadcast (&ds_lock_cond);
+    g_mutex_unlock (&ds_lock_mutex);
+}
+
+/* Release a datastore lock if the given session holds it */
+static bool
+release_lock (struct _ds_lock_t *ds_lock, struct netconf_session *session)
+{
+    bool released = false;
 
-    /* Success */
-    session->counters.in_rpcs++;
-    netconf_global_stats.session_totals.in_rpcs++;
-    return send_rpc_ok (session, rpc, false);
+    g_mutex_lock (&ds_lock_mutex);
+    if (ds_lock->locked == TRUE && ds_lock->nc_sess.id == session->id)
+    {
+        ds_lock->locked = FALSE;
+        ds_lock->nc_sess.id = 0;
+        ds_lock->nc_sess.fd = -1;
+        g_cond_broadcast (&ds_lock_cond);
+        released = true;
+    }
+    g_mutex_unlock (&ds_lock_mutex);
+    return released;
 }
 
-static void
-set_lock (struct netconf_session *session)
+/* The first waiter in the queue for a datastore lock */
+static struct lock_waiter *
+lock_waiter_next (struct _ds_lock_t *ds_lock)
+{
+    for (GList *iter = lock_waiters.head; iter; iter = g_list_next (iter))
+    {
+        if (((struct lock_waiter *) iter->data)->ds_lock == ds_lock)
+            return iter->data;
+    }
+    return NULL;
+}
+
+/* Take a datastore lock for a session. If another session holds it, wait
+ * for up to lock-wait milliseconds behind any earlier waiters. */
+static bool
+acquire_lock (struct _ds_lock_t *ds_lock, struct netconf_session *session)
 {
-    running_ds_lock.locked = TRUE;
-    running_ds_lock.nc_sess.id = session->id;
-    running_ds_lock.nc_sess.fd = session->fd;
+    struct lock_waiter waiter = { ds_lock };
+    gint64 start;
+    gint64 deadline;
+    bool ok = true;
+
+    g_mutex_lock (&ds_lock_mutex);
+    if (ds_lock->locked == FALSE && !lock_waiter_next (ds_lock))
+    {
+        set_lock (ds_lock, session);
+        g_mutex_unlock (&ds_lock_mutex);
+        return true;
+    }
+    if (netconf_lock_wait == 0 || (ds_lock->locked == TRUE && ds_lock->nc_sess.id == session->id))
+    {
+        g_mutex_unlock (&ds_lock_mutex);
+        return false;
+    }
+
+    start = g_get_monotonic_time ();
+    deadline = start + netconf_lock_wait * G_TIME_SPAN_MILLISECOND;
+    g_queue_push_tail (&lock_waiters, &waiter);
+    while (ok && (ds_lock->locked == TRUE || lock_waiter_next (ds_lock) != &waiter))
+    {
+        if (!g_cond_wait_until (&ds_lock_cond, &ds_lock_mutex, deadline))
+            ok = ds_lock->locked == FALSE && lock_waiter_next (ds_lock) == &waiter;
+    }
+    g_queue_remove (&lock_waiters, &waiter);
+    if (ok)
+        set_lock (ds_lock, session);
+    else
+        lock_wait_stats.timeouts++;
+
+    /* Whoever is next in the queue may be able to go now */
+    g_cond_broadcast (&ds_lock_cond);
+    lock_wait_stats.wait_times[lock_wait_stats.samples++ % NETCONF_LOCK_WAIT_SAMPLES] =
+        (g_get_monotonic_time () - start) / G_TIME_SPAN_MILLISECOND;
+    lock_wait_stats.waits++;
+    g_mutex_unlock (&ds_lock_mutex);
+    return ok;
 }
 
 static bool
@@ -2067,12 +5211,13 @@ handle_lock (struct netconf_session *session, xmlNode * rpc)
 {
     xmlNode *action = xmlFirstElementChild (rpc);
     xmlNode *node;
+    struct _ds_lock_t *ds_lock;
     bool ret = true;
 
     /* Check the target */
     node = xmlFindNodeByName (action, BAD_CAST "target");
-    if (!node || !xmlFirstElementChild (node) ||
-        xmlStrcmp (xmlFirstElementChild (node)->name, BAD_CAST "running"))
+    ds_lock = target_ds_lock (node);
+    if (!ds_lock)
     {
         gchar *error_msg = g_strdup_printf ("Datastore \"%s\" not supported",
                                             (char *) xmlFirstElementChild (node)->name);
@@ -2083,51 +5228,69 @@ handle_lock (struct netconf_session *session, xmlNode * rpc)
         return ret;
     }
 
+    /* Running cannot be locked while other sessions hold partial locks */
+    if (ds_lock == &running_ds_lock && !lock_state (ds_lock, NULL) &&
+        partial_lock_held_by_other (session->id))
+    {
+        VERBOSE ("Lock failed, partial lock is already held\n");
+        return send_rpc_error_full (session, rpc, NC_ERR_TAG_LOCK_DENIED, NC_ERR_TYPE_PROTOCOL,
+                                    "Partial lock is already held", NULL, NULL, true);
+    }
+
     /* Attempt to acquire lock */
-    if (running_ds_lock.locked == FALSE)
+    if (acquire_lock (ds_lock, session))
     {
-        /* Acquire lock on the running datastore */
-        set_lock (session);
+        /* The candidate cannot be locked while it holds uncommitted changes */
+        if (ds_lock == &candidate_ds_lock && candidate_modified ())
+        {
+            reset_lock (ds_lock);
+            VERBOSE ("Lock failed, candidate has uncommitted changes\n");
+            return send_rpc_error_full (session, rpc, NC_ERR_TAG_LOCK_DENIED, NC_ERR_TYPE_PROTOCOL,
+                                        "Candidate has uncommitted changes", NULL, NULL, true);
+        }
+        /* Partial locks may have been taken while this request waited */
+        if (ds_lock == &running_ds_lock && partial_lock_held_by_other (session->id))
+        {
+            release_lock (ds_lock, session);
+            VERBOSE ("Lock failed, partial lock is already held\n");
+            return send_rpc_error_full (session, rpc, NC_ERR_TAG_LOCK_DENIED, NC_ERR_TYPE_PROTOCOL,
+                                        "Partial lock is already held", NULL, NULL, true);
+        }
     }
     else
     {
+        uint32_t holder = 0;
+
         /* Return lock-denied */
-        gchar *error_msg = g_strdup_printf ("Lock is already held by session id %d",
-                                            running_ds_lock.nc_sess.id);
+        lock_state (ds_lock, &holder);
+        gchar *error_msg = g_strdup_printf ("Lock is already held by session id %d", holder);
         VERBOSE ("%s\n", error_msg);
-        ret =  send_rpc_error_full (session, rpc, NC_ERR_TAG_LOCK_DENIED, NC_ERR_TYPE_PROTOCOL,
-                                    error_msg, NULL, NULL, false);
+        ret =  send_rpc_error_lock (session, rpc, NC_ERR_TAG_LOCK_DENIED, NC_ERR_TYPE_PROTOCOL,
+                                    error_msg, ds_lock);
         g_free (error_msg);
         return ret;
     }
     if ((logging & LOG_LOCK))
-        NOTICE ("LOCK: %s@%s id:%d\n", session->username, session->rem_addr, session->id);
+        NOTICE ("LOCK: %s@%s id:%d %s\n", session->username, session_data (session)->rem_addr,
+                session->id, (char *) xmlFirstElementChild (node)->name);
 
     /* Success */
-    session->counters.in_rpcs++;
-    netconf_global_stats.session_totals.in_rpcs++;
+    g_atomic_int_inc (&session->counters.in_rpcs);
     return send_rpc_ok (session, rpc, false);
 }
 
-static void
-reset_lock (void)
-{
-    running_ds_lock.locked = FALSE;
-    running_ds_lock.nc_sess.id = 0;
-    running_ds_lock.nc_sess.fd = -1;
-}
-
 static bool
 handle_unlock (struct netconf_session *session, xmlNode * rpc)
 {
     xmlNode *action = xmlFirstElementChild (rpc);
     xmlNode *node;
+    struct _ds_lock_t *ds_lock;
     bool ret = false;
 
     /* Check the target */
     node = xmlFindNodeByName (action, BAD_CAST "target");
-    if (!node || !xmlFirstElementChild (node) ||
-        xmlStrcmp (xmlFirstElementChild (node)->name, BAD_CAST "running"))
+    ds_lock = target_ds_lock (node);
+    if (!ds_lock)
     {
         gchar *error_msg = g_strdup_printf ("Datastore \"%s\" not supported",
                                             (char *) xmlFirstElementChild (node)->name);
@@ -2139,7 +5302,7 @@ handle_unlock (struct netconf_session *session, xmlNode * rpc)
     }
 
     /* Check unlock operation validity */
-    if (!running_ds_lock.locked)
+    if (!lock_state (ds_lock, NULL))
     {
         gchar *error_msg = g_strdup_printf ("Unlock failed, no lock configured on the \"%s\" datastore",
                                             (char *) xmlFirstElementChild (node)->name);
@@ -2149,26 +5312,389 @@ handle_unlock (struct netconf_session *session, xmlNode * rpc)
         g_free (error_msg);
         return ret;
     }
-    else if ((running_ds_lock.locked == TRUE) && (session->id != running_ds_lock.nc_sess.id))
+    else if (lock_held_by_other (ds_lock, session))
     {
         /* Lock held by another session */
         gchar *error_msg = g_strdup_printf ("Unlock failed, session %u does not own the lock", session->id);
         VERBOSE ("%s\n", error_msg);
-        ret = send_rpc_error_full (session, rpc, NC_ERR_TAG_LOCK_DENIED, NC_ERR_TYPE_PROTOCOL,
-                                   error_msg, NULL, NULL, false);
+        ret = send_rpc_error_lock (session, rpc, NC_ERR_TAG_LOCK_DENIED, NC_ERR_TYPE_PROTOCOL,
+                                   error_msg, ds_lock);
+        g_free (error_msg);
+        return ret;
+    }
+
+    /* Unlock the target datastore */
+    release_lock (ds_lock, session);
+
+    if ((logging & LOG_UNLOCK))
+        NOTICE ("UNLOCK: %s@%s id:%d %s\n", session->username, session_data (session)->rem_addr,
+                session->id, (char *) xmlFirstElementChild (node)->name);
+
+    /* Success */
+    g_atomic_int_inc (&session->counters.in_rpcs);
+    return send_rpc_ok (session, rpc, false);
+}
+
+static bool
+send_rpc_partial_lock (struct netconf_session *session, xmlNode * rpc, struct partial_lock *lock)
+{
+    xmlDoc *doc;
+    xmlNode *root;
+    xmlNs *ns;
+    xmlChar *xmlbuff = NULL;
+    char *lock_id;
+    int len;
+    bool ret;
+
+    /* Generate reply */
+    doc = create_rpc (BAD_CAST "rpc-reply", xmlGetProp (rpc, BAD_CAST "message-id"));
+    root = xmlDocGetRootElement (doc);
+    ns = xmlNewNs (root, BAD_CAST NETCONF_PARTIAL_LOCK_NS, BAD_CAST "pl");
+    lock_id = g_strdup_printf ("%u", lock->id);
+    xmlNewChild (root, ns, BAD_CAST "lock-id", BAD_CAST lock_id);
+    g_free (lock_id);
+    for (GList *iter = lock->nodes; iter; iter = g_list_next (iter))
+        xmlNewTextChild (root, ns, BAD_CAST "locked-node", BAD_CAST iter->data);
+    xmlDocDumpMemoryEnc (doc, &xmlbuff, &len, "UTF-8");
+
+    /* Send reply */
+    ret = send_message (session, (const char *) xmlbuff, len, false);
+
+    xmlFree (xmlbuff);
+    xmlFreeDoc (doc);
+    return ret;
+}
+
+static bool
+handle_partial_lock (struct netconf_session *session, xmlNode * rpc)
+{
+    xmlNode *action = xmlFirstElementChild (rpc);
+    struct partial_lock *lock;
+    GList *nodes = NULL;
+    GList *paths = NULL;
+    uint32_t holder;
+    bool conflict = false;
+    bool ret;
+
+    /* Find the path each select expression locks */
+    for (xmlNode *node = xmlFirstElementChild (action); node; node = xmlNextElementSibling (node))
+    {
+        char *select;
+        char *path;
+        char *node_id;
+
+        if (g_strcmp0 ((char *) node->name, "select") != 0)
+            continue;
+        select = (char *) xmlNodeGetContent (node);
+        if (!partial_lock_resolve (select, &path, &node_id))
+        {
+            gchar *error_msg = g_strdup_printf ("Unsupported select expression \"%s\"",
+                                                select ? select : "");
+            VERBOSE ("%s\n", error_msg);
+            ret = send_rpc_error_full (session, rpc, NC_ERR_TAG_INVALID_VAL, NC_ERR_TYPE_PROTOCOL,
+                                       error_msg, NULL, NULL, true);
+            g_free (error_msg);
+            free (select);
+            g_list_free_full (nodes, g_free);
+            g_list_free_full (paths, g_free);
+            return ret;
+        }
+        nodes = g_list_append (nodes, node_id);
+        paths = g_list_append (paths, path);
+        free (select);
+    }
+    if (!paths)
+    {
+        VERBOSE ("Missing \"select\" element\n");
+        return send_rpc_error_full (session, rpc, NC_ERR_TAG_MISSING_ELEM, NC_ERR_TYPE_PROTOCOL,
+                                    "Missing select element", "select", NULL, false);
+    }
+
+    /* Another session's global or partial lock on any part of the scope
+     * denies it. The global lock is checked with the partial locks held, as
+     * a lock request checks the partial locks once it has the global lock. */
+    g_mutex_lock (&partial_lock_mutex);
+    if (lock_state (&running_ds_lock, &holder) && holder != session->id)
+    {
+        gchar *error_msg = g_strdup_printf ("Lock is already held by session id %d", holder);
+
+        g_mutex_unlock (&partial_lock_mutex);
+        VERBOSE ("%s\n", error_msg);
+        ret = send_rpc_error_lock (session, rpc, NC_ERR_TAG_LOCK_DENIED, NC_ERR_TYPE_PROTOCOL,
+                                   error_msg, &running_ds_lock);
         g_free (error_msg);
+        g_list_free_full (nodes, g_free);
+        g_list_free_full (paths, g_free);
         return ret;
     }
+    for (GList *iter = paths; iter && !conflict && partial_lock_scopes; iter = g_list_next (iter))
+        conflict = lock_scope_conflict_path (session->id, (const char *) iter->data);
+    if (conflict)
+    {
+        g_mutex_unlock (&partial_lock_mutex);
+        VERBOSE ("Partial lock failed, partial lock is already held\n");
+        g_list_free_full (nodes, g_free);
+        g_list_free_full (paths, g_free);
+        return send_rpc_error_full (session, rpc, NC_ERR_TAG_LOCK_DENIED, NC_ERR_TYPE_PROTOCOL,
+                                    "Partial lock is already held", NULL, NULL, true);
+    }
+    lock = g_malloc0 (sizeof (struct partial_lock));
+    lock->id = partial_lock_id++;
+    lock->session_id = session->id;
+    lock->nodes = nodes;
+    lock->paths = paths;
+    for (GList *iter = paths; iter; iter = g_list_next (iter))
+        lock_scope_add (lock, (const char *) iter->data);
+    partial_locks = g_list_append (partial_locks, lock);
+    if ((logging & LOG_LOCK))
+        NOTICE ("PARTIAL-LOCK: %s@%s id:%d lock-id:%u\n", session->username,
+                session_data (session)->rem_addr, session->id, lock->id);
+
+    /* Success */
+    g_atomic_int_inc (&session->counters.in_rpcs);
+    ret = send_rpc_partial_lock (session, rpc, lock);
+    g_mutex_unlock (&partial_lock_mutex);
+    return ret;
+}
+
+static bool
+handle_partial_unlock (struct netconf_session *session, xmlNode * rpc)
+{
+    xmlNode *action = xmlFirstElementChild (rpc);
+    xmlNode *node = xmlFindNodeByName (action, BAD_CAST "lock-id");
+    struct partial_lock *lock = NULL;
+    char *value;
+    char *end = NULL;
+    unsigned long lock_id = 0;
 
-    /* Unlock running datastore */
-    reset_lock ();
+    if (!node)
+    {
+        VERBOSE ("Missing \"lock-id\" element\n");
+        return send_rpc_error_full (session, rpc, NC_ERR_TAG_MISSING_ELEM, NC_ERR_TYPE_PROTOCOL,
+                                    "Missing lock-id element", "lock-id", NULL, false);
+    }
+    value = (char *) xmlNodeGetContent (node);
+    if (value)
+        lock_id = strtoul (value, &end, 10);
+    if (!value || end == value || *end != '\0')
+        lock_id = 0;
+    free (value);
+
+    /* Only the session holding a partial lock can release it */
+    g_mutex_lock (&partial_lock_mutex);
+    for (GList *iter = partial_locks; iter && lock_id; iter = g_list_next (iter))
+    {
+        if (((struct partial_lock *) iter->data)->id == lock_id)
+        {
+            lock = iter->data;
+            break;
+        }
+    }
+    if (!lock || lock->session_id != session->id)
+    {
+        g_mutex_unlock (&partial_lock_mutex);
+        VERBOSE ("Partial unlock failed, lock-id %lu not held by session %u\n", lock_id,
+                 session->id);
+        return send_rpc_error_full (session, rpc, NC_ERR_TAG_INVALID_VAL, NC_ERR_TYPE_PROTOCOL,
+                                    "Invalid lock-id", NULL, NULL, true);
+    }
+    partial_lock_release (lock);
+    g_mutex_unlock (&partial_lock_mutex);
 
     if ((logging & LOG_UNLOCK))
-        NOTICE ("UNLOCK: %s@%s id:%d\n", session->username, session->rem_addr, session->id);
+        NOTICE ("PARTIAL-UNLOCK: %s@%s id:%d lock-id:%lu\n", session->username,
+                session_data (session)->rem_addr, session->id, lock_id);
+
+    /* Success */
+    g_atomic_int_inc (&session->counters.in_rpcs);
+    return send_rpc_ok (session, rpc, false);
+}
+
+/* Whether a session may confirm or cancel the pending confirmed commit.
+ * Called with the candidate locked. */
+static bool
+confirmed_commit_owner (struct netconf_session *session, const char *persist_id)
+{
+    if (confirmed_commit.persist)
+        return g_strcmp0 (persist_id, confirmed_commit.persist) == 0;
+    return !persist_id && session->id == confirmed_commit.session_id;
+}
+
+static bool
+handle_commit (struct netconf_session *session, xmlNode * rpc)
+{
+    xmlNode *action = xmlFirstElementChild (rpc);
+    xmlNode *node;
+    struct snapshot *snapshot = NULL;
+    bool confirmed = false;
+    guint timeout = NETCONF_CONFIRM_TIMEOUT_DEF;
+    char *persist = NULL;
+    char *persist_id = NULL;
+    bool ok;
+
+    /* Parse the confirmed commit options */
+    for (node = xmlFirstElementChild (action); node; node = xmlNextElementSibling (node))
+    {
+        if (g_strcmp0 ((char *) node->name, "confirmed") == 0)
+        {
+            confirmed = true;
+        }
+        else if (g_strcmp0 ((char *) node->name, "confirm-timeout") == 0)
+        {
+            char *value = (char *) xmlNodeGetContent (node);
+            char *end = NULL;
+            unsigned long seconds = value ? strtoul (value, &end, 10) : 0;
+
+            if (!value || end == value || *end != '\0' || seconds == 0 || seconds > G_MAXUINT32)
+            {
+                free (value);
+                free (persist);
+                free (persist_id);
+                return send_rpc_error_full (session, rpc, NC_ERR_TAG_INVALID_VAL, NC_ERR_TYPE_PROTOCOL,
+                                            "Invalid value for confirm-timeout parameter",
+                                            NULL, NULL, true);
+            }
+            timeout = seconds;
+            free (value);
+        }
+        else if (g_strcmp0 ((char *) node->name, "persist") == 0 && !persist)
+        {
+            persist = (char *) xmlNodeGetContent (node);
+        }
+        else if (g_strcmp0 ((char *) node->name, "persist-id") == 0 && !persist_id)
+        {
+            persist_id = (char *) xmlNodeGetContent (node);
+        }
+    }
+
+    /* Both datastores must be free of locks held by other sessions */
+    if (lock_held_by_other (&running_ds_lock, session) ||
+        lock_held_by_other (&candidate_ds_lock, session))
+    {
+        VERBOSE ("Commit failed, lock is already held\n");
+        free (persist);
+        free (persist_id);
+        return send_rpc_error_full (session, rpc, NC_ERR_TAG_IN_USE, NC_ERR_TYPE_APP,
+                                    "Lock is already held", NULL, NULL, true);
+    }
+
+    g_mutex_lock (&candidate_lock);
+
+    /* Only the owner of a pending confirmed commit can follow it up */
+    if (confirmed_commit.snapshots && !confirmed_commit_owner (session, persist_id))
+    {
+        g_mutex_unlock (&candidate_lock);
+        VERBOSE ("Commit failed, confirmed commit pending\n");
+        free (persist);
+        free (persist_id);
+        return send_rpc_error_full (session, rpc, NC_ERR_TAG_INVALID_VAL, NC_ERR_TYPE_PROTOCOL,
+                                    "Confirmed commit pending", NULL, NULL, true);
+    }
+
+    /* Nor may it change anything another session has partially locked */
+    if (partial_lock_denied (session->id, candidate_prunes, candidate_sets))
+    {
+        g_mutex_unlock (&candidate_lock);
+        VERBOSE ("Commit failed, partial lock is held\n");
+        free (persist);
+        free (persist_id);
+        return send_rpc_error_full (session, rpc, NC_ERR_TAG_IN_USE, NC_ERR_TYPE_APP,
+                                    "Partial lock is already held", NULL, NULL, true);
+    }
+
+    DEBUG ("NETCONF: COMMIT prunes %d%s\n", g_list_length (candidate_prunes),
+           confirmed ? " (confirmed)" : "");
+    /* Snapshot what is about to change so a failed commit leaves running as it was */
+    snapshot = candidate_snapshot ();
+    ok = candidate_commit ();
+    if (ok)
+    {
+        candidate_clear ();
+        if (confirmed)
+        {
+            /* Roll back unless confirmed before the timeout */
+            confirmed_commit.snapshots = g_list_prepend (confirmed_commit.snapshots, snapshot);
+            confirmed_commit.session_id = session->id;
+            g_free (confirmed_commit.persist);
+            confirmed_commit.persist = g_strdup (persist);
+            if (confirmed_commit.timer)
+                g_source_remove (confirmed_commit.timer);
+            confirmed_commit.timer = g_timeout_add_seconds (timeout, confirmed_commit_timeout, NULL);
+        }
+        else
+        {
+            snapshot_free (snapshot);
+            if (confirmed_commit.snapshots)
+                confirmed_commit_end (false);
+        }
+    }
+    else
+    {
+        snapshot_restore (snapshot);
+    }
+    g_mutex_unlock (&candidate_lock);
+    free (persist);
+    free (persist_id);
+    if (!ok)
+    {
+        return send_rpc_error_full (session, rpc, NC_ERR_TAG_OPR_FAILED, NC_ERR_TYPE_APP,
+                                    NULL, NULL, NULL, true);
+    }
+
+    if ((logging & LOG_EDIT_CONFIG))
+        NOTICE ("COMMIT: %s@%s id:%d%s\n", session->username, session_data (session)->rem_addr,
+                session->id, confirmed ? " confirmed" : "");
+
+    /* Success */
+    g_atomic_int_inc (&session->counters.in_rpcs);
+    return send_rpc_ok (session, rpc, false);
+}
+
+static bool
+handle_cancel_commit (struct netconf_session *session, xmlNode * rpc)
+{
+    xmlNode *node = xmlFindNodeByName (xmlFirstElementChild (rpc), BAD_CAST "persist-id");
+    char *persist_id = node ? (char *) xmlNodeGetContent (node) : NULL;
+
+    g_mutex_lock (&candidate_lock);
+    if (!confirmed_commit.snapshots || !confirmed_commit_owner (session, persist_id))
+    {
+        g_mutex_unlock (&candidate_lock);
+        free (persist_id);
+        VERBOSE ("Cancel failed, no confirmed commit pending\n");
+        return send_rpc_error_full (session, rpc, NC_ERR_TAG_INVALID_VAL, NC_ERR_TYPE_PROTOCOL,
+                                    "No confirmed commit pending", NULL, NULL, true);
+    }
+    confirmed_commit_end (true);
+    g_mutex_unlock (&candidate_lock);
+    free (persist_id);
+
+    if ((logging & LOG_EDIT_CONFIG))
+        NOTICE ("CANCEL-COMMIT: %s@%s id:%d\n", session->username,
+                session_data (session)->rem_addr, session->id);
+
+    /* Success */
+    g_atomic_int_inc (&session->counters.in_rpcs);
+    return send_rpc_ok (session, rpc, false);
+}
+
+static bool
+handle_discard_changes (struct netconf_session *session, xmlNode * rpc)
+{
+    /* A locked candidate can only be reverted by its owner */
+    if (lock_held_by_other (&candidate_ds_lock, session))
+    {
+        VERBOSE ("Discard failed, lock is already held\n");
+        return send_rpc_error_full (session, rpc, NC_ERR_TAG_IN_USE, NC_ERR_TYPE_APP,
+                                    "Lock is already held", NULL, NULL, true);
+    }
+
+    g_mutex_lock (&candidate_lock);
+    candidate_clear ();
+    g_mutex_unlock (&candidate_lock);
 
     /* Success */
-    session->counters.in_rpcs++;
-    netconf_global_stats.session_totals.in_rpcs++;
+    g_atomic_int_inc (&session->counters.in_rpcs);
     return send_rpc_ok (session, rpc, false);
 }
 
@@ -2228,8 +5754,8 @@ handle_kill_session (struct netconf_session *session, xmlNode * rpc)
     VERBOSE ("NETCONF: session killed\n");
     if ((logging & LOG_KILL_SESSION))
         NOTICE ("KILL-SESSION: %s@%s id:%d  killed session %s@%s id:%d\n",
-                session->username, session->rem_addr, session->id,
-                kill_session->username, kill_session->rem_addr, kill_session->id);
+                session->username, session_data (session)->rem_addr, session->id,
+                kill_session->username, session_data (kill_session)->rem_addr, kill_session->id);
 
     shutdown (kill_session->fd, SHUT_RDWR);
 
@@ -2238,71 +5764,279 @@ handle_kill_session (struct netconf_session *session, xmlNode * rpc)
      **/
 
     /* Success */
-    session->counters.in_rpcs++;
-    netconf_global_stats.session_totals.in_rpcs++;
+    g_atomic_int_inc (&session->counters.in_rpcs);
     return send_rpc_ok (session, rpc, false);
 }
 
-/**
- * Add session data for this session based on the PID of the remote socat process.
- */
+/* Usernames of connecting user IDs. Name service lookups can be slow so
+ * results are kept for a while. */
+struct username_entry
+{
+    gchar *name;
+    gint64 expires;
+};
+
+static GHashTable *username_cache = NULL;
+static GMutex username_lock;
+
 static void
-add_session_data (struct netconf_session *session, uint32_t pid)
+username_entry_free (struct username_entry *entry)
 {
-    gchar *fname;
-    gchar *contents;
-    gchar *one_env;
-    gsize length;
-    gsize length_left;
-    gsize env_len;
-    gchar **env_split;
-    GDateTime *now = NULL;
+    g_free (entry->name);
+    g_free (entry);
+}
+
+static gchar *
+username_lookup (uid_t uid)
+{
+    struct username_entry *entry;
+    struct passwd pwd;
+    struct passwd *result = NULL;
+    gint64 now = g_get_monotonic_time ();
+    gchar *name = NULL;
+    size_t size = 1024;
+    char *buf;
+    int rc;
+
+    g_mutex_lock (&username_lock);
+    if (!username_cache)
+        username_cache = g_hash_table_new_full (g_direct_hash, g_direct_equal, NULL,
+                                                (GDestroyNotify) username_entry_free);
+    entry = g_hash_table_lookup (username_cache, GUINT_TO_POINTER (uid));
+    if (entry && entry->expires > now)
+    {
+        name = g_strdup (entry->name);
+        g_mutex_unlock (&username_lock);
+        return name;
+    }
+    g_mutex_unlock (&username_lock);
+
+    /* Look up without holding the lock so other sessions are not held up */
+    buf = g_malloc (size);
+    while ((rc = getpwuid_r (uid, &pwd, buf, size, &result)) == ERANGE && size < 1024 * 1024)
+    {
+        size *= 2;
+        buf = g_realloc (buf, size);
+    }
+    if (rc == 0 && result)
+        name = g_strdup (pwd.pw_name);
+    g_free (buf);
+
+    /* Remember unknown users too, but not failed lookups */
+    if (rc == 0)
+    {
+        entry = g_malloc0 (sizeof (struct username_entry));
+        entry->name = g_strdup (name);
+        entry->expires = now + NETCONF_USERNAME_CACHE_TTL * G_USEC_PER_SEC;
+        g_mutex_lock (&username_lock);
+        g_hash_table_insert (username_cache, GUINT_TO_POINTER (uid), entry);
+        g_mutex_unlock (&username_lock);
+    }
+    return name;
+}
+
+/* Latency of each supported RPC across all sessions */
+static struct rpc_latency
+{
+    const char *name;
+    struct latency_hist hist;
+} rpc_latency[] = {
+    { "get" }, { "get-config" }, { "edit-config" }, { "validate" },
+    { "lock" }, { "unlock" }, { "partial-lock" }, { "partial-unlock" },
+    { "commit" }, { "cancel-commit" }, { "discard-changes" },
+    { "kill-session" }, { "close-session" },
+};
+
+/* Time from a connection being accepted until our hello has been sent, and
+ * until the session is ready for RPCs */
+static struct latency_hist hello_latency;
+static struct latency_hist setup_latency;
+
+/* Summary of a latency histogram taken when it is read */
+struct latency_summary
+{
+    uint32_t count;
+    uint32_t p50;
+    uint32_t p90;
+    uint32_t p99;
+    uint32_t max;
+};
+
+static struct rpc_latency *
+rpc_latency_find (const char *name)
+{
+    for (unsigned int i = 0; i < G_N_ELEMENTS (rpc_latency); i++)
+    {
+        if (g_strcmp0 (rpc_latency[i].name, name) == 0)
+            return &rpc_latency[i];
+    }
+    return NULL;
+}
+
+/* Number of RPCs received with each element name. The number of names is
+ * limited so that a client cannot grow the table without bound. */
+#define RPC_COUNT_NAMES_MAX 64
+static GHashTable *rpc_counts = NULL;
+static GMutex rpc_count_lock;
+
+static void
+rpc_count (const char *name)
+{
+    uint32_t *count;
+
+    g_mutex_lock (&rpc_count_lock);
+    if (!rpc_counts)
+        rpc_counts = g_hash_table_new_full (g_str_hash, g_str_equal, g_free, g_free);
+    count = g_hash_table_lookup (rpc_counts, name);
+    if (!count && g_hash_table_size (rpc_counts) < RPC_COUNT_NAMES_MAX)
+    {
+        count = g_malloc0 (sizeof (uint32_t));
+        g_hash_table_insert (rpc_counts, g_strdup (name), count);
+    }
+    if (count)
+        (*count)++;
+    g_mutex_unlock (&rpc_count_lock);
+}
+
+/* Lock free so that RPCs from different sessions do not wait on each other */
+static void
+latency_hist_add (struct latency_hist *hist, uint32_t usec)
+{
+    unsigned int bucket = usec ? g_bit_storage (usec) : 0;
+    uint32_t max;
+
+    if (bucket >= LATENCY_BUCKETS)
+        bucket = LATENCY_BUCKETS - 1;
+    g_atomic_int_inc (&hist->buckets[bucket]);
+    max = g_atomic_int_get (&hist->max);
+    while (usec > max && !g_atomic_int_compare_and_exchange (&hist->max, max, usec))
+        max = g_atomic_int_get (&hist->max);
+}
+
+/* Record the time since start, returning it in microseconds */
+static uint32_t
+latency_hist_since (struct latency_hist *hist, gint64 start)
+{
+    gint64 elapsed = g_get_monotonic_time () - start;
+    uint32_t usec = elapsed > G_MAXUINT32 ? G_MAXUINT32 : (uint32_t) elapsed;
+
+    latency_hist_add (hist, usec);
+    return usec;
+}
+
+/* Record the time taken by an RPC since start against the RPC and session,
+ * returning it in microseconds */
+static uint32_t
+rpc_latency_record (struct netconf_session *session, struct rpc_latency *latency, gint64 start)
+{
+    uint32_t usec = latency_hist_since (&session->latency, start);
+
+    if (latency)
+        latency_hist_add (&latency->hist, usec);
+    return usec;
+}
+
+/* Percentiles are the top of the bucket they fall in, but never above the
+ * largest latency seen */
+static uint32_t
+latency_percentile (uint32_t *buckets, uint32_t count, uint32_t max, unsigned int percent)
+{
+    uint64_t target = ((uint64_t) count * percent + 99) / 100;
+    uint64_t seen = 0;
+
+    for (unsigned int i = 0; i < LATENCY_BUCKETS; i++)
+    {
+        seen += buckets[i];
+        if (seen >= target)
+            return MIN (i ? (uint32_t) ((1ULL << i) - 1) : 0, max);
+    }
+    return max;
+}
+
+static void
+latency_summarise (struct latency_hist *hist, struct latency_summary *summary)
+{
+    uint32_t buckets[LATENCY_BUCKETS];
 
-    /* Get initial environment of remote process. */
-    fname = g_strdup_printf ("/proc/%d/environ", pid);
-    if (!g_file_get_contents (fname, &contents, &length, NULL))
+    summary->count = 0;
+    for (unsigned int i = 0; i < LATENCY_BUCKETS; i++)
     {
-        g_free (fname);
-        return;
+        buckets[i] = g_atomic_int_get (&hist->buckets[i]);
+        summary->count += buckets[i];
     }
-    g_free (fname);
+    summary->max = g_atomic_int_get (&hist->max);
+    summary->p50 = latency_percentile (buckets, summary->count, summary->max, 50);
+    summary->p90 = latency_percentile (buckets, summary->count, summary->max, 90);
+    summary->p99 = latency_percentile (buckets, summary->count, summary->max, 99);
+}
 
-    /* Read each null-terminated string in contents */
-    one_env = contents;
-    length_left = length;
-    while (length_left > 0 && one_env[0] != '\0')
+/* Values last published to /netconf-state, so that a refresh only writes the
+ * leaves that have changed. Sessions are keyed by ID, each with a table of
+ * leaf values. */
+static GHashTable *published_sessions = NULL;
+static GHashTable *published_statistics = NULL;
+static GMutex published_lock;
+static uint32_t netconf_state_refresh = NETCONF_STATE_REFRESH_DEF;
+
+/* Add a leaf to the tree if its value differs from the published one. The
+ * published value is stored against key. Takes ownership of value. */
+static void
+state_leaf_publish_key (GHashTable *published, GNode *parent, const char *key,
+                        const char *name, gchar *value)
+{
+    if (g_strcmp0 (g_hash_table_lookup (published, key), value) == 0)
     {
-        if (g_str_has_prefix (one_env, "SSH_CLIENT"))
-        {
-            env_split = g_strsplit_set (one_env, "= ", 4);
-            if (env_split[0] == NULL || env_split[1] == NULL || env_split[2] == NULL ||
-                env_split[3] == NULL || env_split[4] != NULL)
-            {
-                g_strfreev (env_split);
-                goto cleanup;
-            }
-            session->rem_addr = g_strdup (env_split[1]);
-            session->rem_port = g_strdup (env_split[2]);
-            g_strfreev (env_split);
-            break;
-        }
-        env_len = strlen (one_env);
-        length_left -= env_len + 1;
-        one_env += env_len + 1;
+        g_free (value);
+        return;
     }
+    APTERYX_LEAF (parent, g_strdup (name), g_strdup (value));
+    g_hash_table_insert (published, g_strdup (key), value);
+}
 
-    if (session->rem_addr)
+static void
+state_leaf_publish (GHashTable *published, GNode *parent, const char *name, gchar *value)
+{
+    state_leaf_publish_key (published, parent, name, name, value);
+}
+
+/* Publish the changed parts of a latency summary under parent/branch, once
+ * there is something to report */
+static void
+state_latency_publish (GHashTable *published, GNode *parent, const char *branch,
+                       struct latency_hist *hist)
+{
+    struct latency_summary summary;
+    GNode *node;
+    const char *names[] = { "count", "p50", "p90", "p99", "max" };
+    uint32_t values[G_N_ELEMENTS (names)];
+
+    latency_summarise (hist, &summary);
+    if (summary.count == 0)
+        return;
+    node = APTERYX_NODE (NULL, g_strdup (branch));
+    values[0] = summary.count;
+    values[1] = summary.p50;
+    values[2] = summary.p90;
+    values[3] = summary.p99;
+    values[4] = summary.max;
+    for (unsigned int i = 0; i < G_N_ELEMENTS (names); i++)
     {
-        /* Get local time */
-        now = g_date_time_new_now_utc ();
-        session->login_time = g_date_time_format (now, "%Y-%m-%dT%H:%M:%SZ%:z");
-        g_date_time_unref (now);
+        gchar *key = g_strdup_printf ("%s/%s", branch, names[i]);
+
+        state_leaf_publish_key (published, node, key, names[i],
+                                g_strdup_printf ("%u", values[i]));
+        g_free (key);
     }
+    if (node->children)
+        g_node_append (parent, node);
     else
-        session->rem_addr = g_strdup ("unknown");
+        apteryx_free_tree (node);
+}
 
-cleanup:
-    g_free (contents);
+static GHashTable *
+state_leaves_new (void)
+{
+    return g_hash_table_new_full (g_str_hash, g_str_equal, g_free, g_free);
 }
 
 /**
@@ -2313,56 +6047,109 @@ _netconf_sessions_refresh (const char *path)
 {
     GNode *root;
     GNode *sess;
-    gboolean done_one = false;
+    GHashTable *leaves;
+    GHashTable *open;
     gchar *sess_id;
+    GHashTableIter iter;
+    gpointer id;
     struct netconf_session *nc_session;
+    uint32_t running_holder;
+    uint32_t candidate_holder;
     gboolean has_lock;
     gchar *lock_str;
 
+    /* Read the lock holders once rather than for every session */
+    lock_state (&running_ds_lock, &running_holder);
+    lock_state (&candidate_ds_lock, &candidate_holder);
+
+    g_mutex_lock (&published_lock);
+    if (!published_sessions)
+        published_sessions = g_hash_table_new_full (g_direct_hash, g_direct_equal, NULL,
+                                                    (GDestroyNotify) g_hash_table_destroy);
+    open = g_hash_table_new (g_direct_hash, g_direct_equal);
     root = APTERYX_NODE (NULL, g_strdup (NETCONF_STATE_SESSIONS_PATH));
-    g_mutex_lock (&session_lock);
-    for (GList *iter = open_sessions_list; iter; iter = g_list_next (iter))
+    g_rw_lock_reader_lock (&session_lock);
+    g_hash_table_iter_init (&iter, open_sessions);
+    while (g_hash_table_iter_next (&iter, &id, (gpointer *) &nc_session))
     {
-        nc_session = iter->data;
-        if (!nc_session)
+        g_hash_table_add (open, id);
+        leaves = g_hash_table_lookup (published_sessions, id);
+        if (!leaves)
         {
-            continue;
+            leaves = state_leaves_new ();
+            g_hash_table_insert (published_sessions, id, leaves);
         }
 
         /* Get lock value for session */
-        has_lock = running_ds_lock.locked && nc_session->id == running_ds_lock.nc_sess.id;
-        lock_str = has_lock ? "R" : "-";
+        has_lock = running_holder == nc_session->id;
+        if (candidate_holder == nc_session->id)
+            lock_str = has_lock ? "RC" : "C";
+        else
+            lock_str = has_lock ? "R" : "-";
 
-        /* Create Apteryx sub-tree */
+        /* Create Apteryx sub-tree of what has changed */
         sess_id = g_strdup_printf ("%d", nc_session->id);
-        sess = APTERYX_NODE (root, g_strdup (sess_id));
-        APTERYX_LEAF (sess, g_strdup ("session-id"), g_strdup (sess_id));
-        APTERYX_LEAF (sess, g_strdup ("transport"), g_strdup ("netconf-ssh"));
-        APTERYX_LEAF (sess, g_strdup ("username"), g_strdup (nc_session->username));
-        APTERYX_LEAF (sess, g_strdup ("login-time"), g_strdup (nc_session->login_time));
-        APTERYX_LEAF (sess, g_strdup ("source-host"), g_strdup (nc_session->rem_addr));
-        APTERYX_LEAF (sess, g_strdup ("source-port"), g_strdup (nc_session->rem_port));
-        APTERYX_LEAF (sess, g_strdup ("lock"), g_strdup (lock_str));
-        APTERYX_LEAF (sess, g_strdup ("status"), g_strdup ("active"));
-        APTERYX_LEAF (sess, g_strdup ("in-rpcs"),
-                      g_strdup_printf ("%d", nc_session->counters.in_rpcs));
-        APTERYX_LEAF (sess, g_strdup ("in-bad-rpcs"),
-                      g_strdup_printf ("%d", nc_session->counters.in_bad_rpcs));
-        APTERYX_LEAF (sess, g_strdup ("out-rpc-errors"),
-                      g_strdup_printf ("%d", nc_session->counters.out_rpc_errors));
-        APTERYX_LEAF (sess, g_strdup ("out-notifications"),
-                      g_strdup_printf ("%d", nc_session->counters.out_notifications));
+        sess = APTERYX_NODE (NULL, g_strdup (sess_id));
+        state_leaf_publish (leaves, sess, "session-id", g_strdup (sess_id));
+        state_leaf_publish (leaves, sess, "transport", g_strdup ("netconf-ssh"));
+        state_leaf_publish (leaves, sess, "username", g_strdup (nc_session->username));
+        if (__atomic_load_n (&nc_session->data_loaded, __ATOMIC_ACQUIRE))
+        {
+            state_leaf_publish (leaves, sess, "login-time", g_strdup (nc_session->login_time));
+            state_leaf_publish (leaves, sess, "source-host", g_strdup (nc_session->rem_addr));
+            state_leaf_publish (leaves, sess, "source-port", g_strdup (nc_session->rem_port));
+        }
+        state_leaf_publish (leaves, sess, "lock", g_strdup (lock_str));
+        state_leaf_publish (leaves, sess, "status", g_strdup ("active"));
+        state_leaf_publish (leaves, sess, "in-rpcs",
+                            g_strdup_printf ("%u", g_atomic_int_get (&nc_session->counters.in_rpcs)));
+        state_leaf_publish (leaves, sess, "in-bad-rpcs",
+                            g_strdup_printf ("%u", g_atomic_int_get (&nc_session->counters.in_bad_rpcs)));
+        state_leaf_publish (leaves, sess, "out-rpc-errors",
+                            g_strdup_printf ("%u", g_atomic_int_get (&nc_session->counters.out_rpc_errors)));
+        state_leaf_publish (leaves, sess, "out-notifications",
+                            g_strdup_printf ("%u", g_atomic_int_get (&nc_session->counters.out_notifications)));
+        state_leaf_publish (leaves, sess, "in-bytes",
+                            g_strdup_printf ("%" G_GUINT64_FORMAT, counter64_get (&nc_session->counters.in_bytes)));
+        state_leaf_publish (leaves, sess, "out-bytes",
+                            g_strdup_printf ("%" G_GUINT64_FORMAT, counter64_get (&nc_session->counters.out_bytes)));
+        state_leaf_publish (leaves, sess, "in-chunks",
+                            g_strdup_printf ("%u", g_atomic_int_get (&nc_session->counters.in_chunks)));
+        state_leaf_publish (leaves, sess, "out-chunks",
+                            g_strdup_printf ("%u", g_atomic_int_get (&nc_session->counters.out_chunks)));
+        state_leaf_publish (leaves, sess, "max-request",
+                            g_strdup_printf ("%u", g_atomic_int_get (&nc_session->counters.max_request)));
+        state_leaf_publish (leaves, sess, "max-reply",
+                            g_strdup_printf ("%u", g_atomic_int_get (&nc_session->counters.max_reply)));
+        state_latency_publish (leaves, sess, "latency", &nc_session->latency);
+        if (sess->children)
+            g_node_append (root, sess);
+        else
+            apteryx_free_tree (sess);
         g_free (sess_id);
-        done_one = true;
     }
-    g_mutex_unlock (&session_lock);
-    apteryx_prune (NETCONF_STATE_SESSIONS_PATH);
-    if (done_one)
+    g_rw_lock_reader_unlock (&session_lock);
+
+    /* Closed sessions are removed as a whole */
+    g_hash_table_iter_init (&iter, published_sessions);
+    while (g_hash_table_iter_next (&iter, &id, NULL))
+    {
+        if (!g_hash_table_contains (open, id))
+        {
+            sess_id = g_strdup_printf ("%s/%u", NETCONF_STATE_SESSIONS_PATH, GPOINTER_TO_UINT (id));
+            apteryx_prune (sess_id);
+            g_free (sess_id);
+            g_hash_table_iter_remove (&iter);
+        }
+    }
+    g_hash_table_destroy (open);
+    if (root->children)
     {
         apteryx_set_tree (root);
     }
     apteryx_free_tree (root);
-    return 1000 * 1000;
+    g_mutex_unlock (&published_lock);
+    return (uint64_t) g_atomic_int_get (&netconf_state_refresh) * 1000;
 }
 
 /**
@@ -2372,31 +6159,380 @@ static uint64_t
 _netconf_statistics_refresh (const char *path)
 {
     GNode *root;
+    GNode *latency;
+    GNode *rpcs;
+    session_counters_t totals;
+    GHashTableIter iter;
+    struct netconf_session *nc_session;
 
+    /* Add up the counts of every session */
+    g_rw_lock_reader_lock (&session_lock);
+    totals = netconf_global_stats.session_totals;
+    g_hash_table_iter_init (&iter, open_sessions);
+    while (g_hash_table_iter_next (&iter, NULL, (gpointer *) &nc_session))
+        session_counters_add (&totals, &nc_session->counters);
+    g_rw_lock_reader_unlock (&session_lock);
+
+    g_mutex_lock (&published_lock);
+    if (!published_statistics)
+        published_statistics = state_leaves_new ();
     root = APTERYX_NODE (NULL, g_strdup (NETCONF_STATE_STATISTICS_PATH));
-    APTERYX_LEAF (root, g_strdup ("netconf-start-time"),
-                  g_strdup (netconf_global_stats.netconf_start_time));
-    APTERYX_LEAF (root, g_strdup ("in-bad-hellos"),
-                  g_strdup_printf ("%d", netconf_global_stats.in_bad_hellos));
-    APTERYX_LEAF (root, g_strdup ("in-sessions"),
-                  g_strdup_printf ("%d", netconf_global_stats.in_sessions));
-    APTERYX_LEAF (root, g_strdup ("dropped-sessions"),
-                  g_strdup_printf ("%d", netconf_global_stats.dropped_sessions));
-    APTERYX_LEAF (root, g_strdup ("in-rpcs"),
-                  g_strdup_printf ("%d", netconf_global_stats.session_totals.in_rpcs));
-    APTERYX_LEAF (root, g_strdup ("in-bad-rpcs"),
-                  g_strdup_printf ("%d", netconf_global_stats.session_totals.in_bad_rpcs));
-    APTERYX_LEAF (root, g_strdup ("out-rpc-errors"),
-                  g_strdup_printf ("%d", netconf_global_stats.session_totals.out_rpc_errors));
-    APTERYX_LEAF (root, g_strdup ("out-notifications"),
-                  g_strdup_printf ("%d", netconf_global_stats.session_totals.out_notifications));
+    state_leaf_publish (published_statistics, root, "netconf-start-time",
+                        g_strdup (netconf_global_stats.netconf_start_time));
+    state_leaf_publish (published_statistics, root, "in-bad-hellos",
+                        g_strdup_printf ("%u", g_atomic_int_get (&netconf_global_stats.in_bad_hellos)));
+    state_leaf_publish (published_statistics, root, "in-sessions",
+                        g_strdup_printf ("%u", g_atomic_int_get (&netconf_global_stats.in_sessions)));
+    state_leaf_publish (published_statistics, root, "dropped-sessions",
+                        g_strdup_printf ("%u", g_atomic_int_get (&netconf_global_stats.dropped_sessions)));
+    state_leaf_publish (published_statistics, root, "in-rpcs",
+                        g_strdup_printf ("%u", totals.in_rpcs));
+    state_leaf_publish (published_statistics, root, "in-bad-rpcs",
+                        g_strdup_printf ("%u", totals.in_bad_rpcs));
+    state_leaf_publish (published_statistics, root, "out-rpc-errors",
+                        g_strdup_printf ("%u", totals.out_rpc_errors));
+    state_leaf_publish (published_statistics, root, "out-notifications",
+                        g_strdup_printf ("%u", totals.out_notifications));
+    state_leaf_publish (published_statistics, root, "in-bytes",
+                        g_strdup_printf ("%" G_GUINT64_FORMAT, totals.in_bytes));
+    state_leaf_publish (published_statistics, root, "out-bytes",
+                        g_strdup_printf ("%" G_GUINT64_FORMAT, totals.out_bytes));
+    state_leaf_publish (published_statistics, root, "in-chunks",
+                        g_strdup_printf ("%u", totals.in_chunks));
+    state_leaf_publish (published_statistics, root, "out-chunks",
+                        g_strdup_printf ("%u", totals.out_chunks));
+    state_leaf_publish (published_statistics, root, "max-request",
+                        g_strdup_printf ("%u", totals.max_request));
+    state_leaf_publish (published_statistics, root, "max-reply",
+                        g_strdup_printf ("%u", totals.max_reply));
+
+    /* Number of each RPC received */
+    rpcs = APTERYX_NODE (NULL, g_strdup ("rpcs"));
+    g_mutex_lock (&rpc_count_lock);
+    if (rpc_counts)
+    {
+        GHashTableIter counts;
+        const char *name;
+        uint32_t *count;
+
+        g_hash_table_iter_init (&counts, rpc_counts);
+        while (g_hash_table_iter_next (&counts, (gpointer *) &name, (gpointer *) &count))
+        {
+            gchar *key = g_strdup_printf ("rpcs/%s", name);
+
+            state_leaf_publish_key (published_statistics, rpcs, key, name,
+                                    g_strdup_printf ("%u", *count));
+            g_free (key);
+        }
+    }
+    g_mutex_unlock (&rpc_count_lock);
+    if (rpcs->children)
+        g_node_append (root, rpcs);
+    else
+        apteryx_free_tree (rpcs);
+
+    /* Latency of each RPC in microseconds, for those that have been used */
+    latency = APTERYX_NODE (NULL, g_strdup ("latency"));
+    for (unsigned int i = 0; i < G_N_ELEMENTS (rpc_latency); i++)
+        state_latency_publish (published_statistics, latency, rpc_latency[i].name,
+                               &rpc_latency[i].hist);
+    state_latency_publish (published_statistics, latency, "hello", &hello_latency);
+    state_latency_publish (published_statistics, latency, "session-setup", &setup_latency);
+    if (latency->children)
+        g_node_append (root, latency);
+    else
+        apteryx_free_tree (latency);
+    if (root->children)
+        apteryx_set_tree (root);
+    apteryx_free_tree (root);
+    g_mutex_unlock (&published_lock);
+    return (uint64_t) g_atomic_int_get (&netconf_state_refresh) * 1000;
+}
+
+static bool
+_netconf_slow_rpc (const char *path, const char *value)
+{
+    uint32_t slow_rpc = NETCONF_SLOW_RPC_DEF;
+
+    if (value && strlen (value) > 0)
+        slow_rpc = g_ascii_strtoull (value, NULL, 10);
+    g_atomic_int_set (&netconf_slow_rpc, slow_rpc);
+    apteryx_set_int (NETCONF_STATE, "slow-rpc", slow_rpc);
+    return true;
+}
+
+static bool
+_netconf_state_refresh (const char *path, const char *value)
+{
+    uint32_t refresh = NETCONF_STATE_REFRESH_DEF;
+
+    if (value && strlen (value) > 0)
+    {
+        refresh = g_ascii_strtoull (value, NULL, 10);
+        if (refresh < NETCONF_STATE_REFRESH_MIN)
+            refresh = NETCONF_STATE_REFRESH_MIN;
+    }
+    g_atomic_int_set (&netconf_state_refresh, refresh);
+    apteryx_set_int (NETCONF_STATE, "state-refresh", refresh);
+    return true;
+}
+
+static int
+lock_wait_compare (gconstpointer a, gconstpointer b)
+{
+    uint64_t x = *(const uint64_t *) a;
+    uint64_t y = *(const uint64_t *) b;
+
+    return x < y ? -1 : x > y;
+}
+
+/**
+ * Refresh function for /netconf-state/lock-wait/<*>
+ */
+static uint64_t
+_netconf_lock_wait_refresh (const char *path)
+{
+    uint64_t wait_times[NETCONF_LOCK_WAIT_SAMPLES];
+    uint32_t count;
+    GNode *root;
+
+    root = APTERYX_NODE (NULL, g_strdup (NETCONF_STATE_LOCK_WAIT_PATH));
+    g_mutex_lock (&ds_lock_mutex);
+    count = MIN (lock_wait_stats.samples, NETCONF_LOCK_WAIT_SAMPLES);
+    memcpy (wait_times, lock_wait_stats.wait_times, count * sizeof (uint64_t));
+    APTERYX_LEAF (root, g_strdup ("queued"), g_strdup_printf ("%u", g_queue_get_length (&lock_waiters)));
+    APTERYX_LEAF (root, g_strdup ("waits"), g_strdup_printf ("%u", lock_wait_stats.waits));
+    APTERYX_LEAF (root, g_strdup ("timeouts"), g_strdup_printf ("%u", lock_wait_stats.timeouts));
+    g_mutex_unlock (&ds_lock_mutex);
+
+    /* Percentiles of the most recent wait times in milliseconds */
+    qsort (wait_times, count, sizeof (uint64_t), lock_wait_compare);
+    APTERYX_LEAF (root, g_strdup ("p50"), g_strdup_printf ("%" G_GUINT64_FORMAT,
+                                                           count ? wait_times[count * 50 / 100] : 0));
+    APTERYX_LEAF (root, g_strdup ("p90"), g_strdup_printf ("%" G_GUINT64_FORMAT,
+                                                           count ? wait_times[count * 90 / 100] : 0));
+    APTERYX_LEAF (root, g_strdup ("p99"), g_strdup_printf ("%" G_GUINT64_FORMAT,
+                                                           count ? wait_times[count * 99 / 100] : 0));
+
+    apteryx_set_tree (root);
+    apteryx_free_tree (root);
+    return 1000 * 1000;
+}
+
+static bool
+_netconf_lock_wait (const char *path, const char *value)
+{
+    g_mutex_lock (&ds_lock_mutex);
+    if (!value || strlen (value) == 0)
+        netconf_lock_wait = NETCONF_LOCK_WAIT_DEF;
+    else
+        netconf_lock_wait = g_ascii_strtoull (value, NULL, 10);
+    g_mutex_unlock (&ds_lock_mutex);
+    apteryx_set_int (NETCONF_STATE, "lock-wait", netconf_lock_wait);
+    return true;
+}
+
+/**
+ * Refresh function for /netconf-state/proxies/proxy/<*>
+ */
+static uint64_t
+_netconf_proxies_refresh (const char *path)
+{
+    GNode *root;
+    GNode *proxy;
+    GHashTableIter iter;
+    gpointer key;
+    gpointer value;
+    gboolean done_one = false;
+
+    root = APTERYX_NODE (NULL, g_strdup (NETCONF_STATE_PROXIES_PATH));
+    g_mutex_lock (&proxy_lock);
+    g_hash_table_iter_init (&iter, proxy_stats_table);
+    while (g_hash_table_iter_next (&iter, &key, &value))
+    {
+        struct proxy_stats *stats = value;
+        uint32_t fetched = stats->requests - stats->timeouts - stats->cache_hits;
+
+        proxy = APTERYX_NODE (root, g_uri_escape_string (key, NULL, FALSE));
+        APTERYX_LEAF (proxy, g_strdup ("target"), g_strdup (key));
+        APTERYX_LEAF (proxy, g_strdup ("requests"), g_strdup_printf ("%u", stats->requests));
+        APTERYX_LEAF (proxy, g_strdup ("timeouts"), g_strdup_printf ("%u", stats->timeouts));
+        APTERYX_LEAF (proxy, g_strdup ("cache-hits"), g_strdup_printf ("%u", stats->cache_hits));
+        APTERYX_LEAF (proxy, g_strdup ("last-latency"),
+                      g_strdup_printf ("%" G_GUINT64_FORMAT, stats->last_latency));
+        APTERYX_LEAF (proxy, g_strdup ("max-latency"),
+                      g_strdup_printf ("%" G_GUINT64_FORMAT, stats->max_latency));
+        APTERYX_LEAF (proxy, g_strdup ("average-latency"),
+                      g_strdup_printf ("%" G_GUINT64_FORMAT, fetched ? stats->total_latency / fetched : 0));
+        done_one = true;
+    }
+    g_mutex_unlock (&proxy_lock);
+    apteryx_prune (NETCONF_STATE_PROXIES_PATH);
+    if (done_one)
+    {
+        apteryx_set_tree (root);
+    }
+    apteryx_free_tree (root);
+    return 1000 * 1000;
+}
+
+static bool
+_netconf_proxy_timeout (const char *path, const char *value)
+{
+    if (!value || strlen (value) == 0)
+        netconf_proxy_timeout = NETCONF_PROXY_TIMEOUT_DEF;
+    else
+        netconf_proxy_timeout = g_ascii_strtoull (value, NULL, 10);
+    apteryx_set_int (NETCONF_STATE, "proxy-timeout", netconf_proxy_timeout);
+    return true;
+}
+
+static bool
+_netconf_proxy_cache_ttl (const char *path, const char *value)
+{
+    if (!value || strlen (value) == 0)
+        netconf_proxy_cache_ttl = NETCONF_PROXY_CACHE_TTL_DEF;
+    else
+        netconf_proxy_cache_ttl = g_ascii_strtoull (value, NULL, 10);
+
+    /* Drop anything cached with the old lifetime */
+    g_mutex_lock (&proxy_lock);
+    if (proxy_cache)
+        g_hash_table_remove_all (proxy_cache);
+    g_mutex_unlock (&proxy_lock);
+    apteryx_set_int (NETCONF_STATE, "proxy-cache-ttl", netconf_proxy_cache_ttl);
+    return true;
+}
+
+/**
+ * Refresh function for /netconf/state/coalescing/<*>
+ */
+static uint64_t
+_netconf_coalescing_refresh (const char *path)
+{
+    GNode *root;
+
+    root = APTERYX_NODE (NULL, g_strdup (NETCONF_STATE_COALESCING_PATH));
+    g_mutex_lock (&get_flight_lock);
+    APTERYX_LEAF (root, g_strdup ("executed"), g_strdup_printf ("%u", coalesce_stats.executed));
+    APTERYX_LEAF (root, g_strdup ("coalesced"), g_strdup_printf ("%u", coalesce_stats.coalesced));
+    g_mutex_unlock (&get_flight_lock);
+
+    apteryx_set_tree (root);
+    apteryx_free_tree (root);
+    return 1000 * 1000;
+}
+
+/**
+ * Refresh function for /netconf/state/edit-prune/<*>
+ */
+static uint64_t
+_netconf_edit_prune_refresh (const char *path)
+{
+    GNode *root;
+
+    root = APTERYX_NODE (NULL, g_strdup (NETCONF_STATE_EDIT_PRUNE_PATH));
+    g_mutex_lock (&edit_prune_lock);
+    APTERYX_LEAF (root, g_strdup ("executed"), g_strdup_printf ("%u", edit_prune_stats.executed));
+    APTERYX_LEAF (root, g_strdup ("saved"), g_strdup_printf ("%u", edit_prune_stats.saved));
+    g_mutex_unlock (&edit_prune_lock);
+
+    apteryx_set_tree (root);
+    apteryx_free_tree (root);
+    return 1000 * 1000;
+}
+
+/**
+ * Refresh function for /netconf/state/conditions/<*>
+ */
+static uint64_t
+_netconf_conditions_refresh (const char *path)
+{
+    GNode *root;
+    uint32_t evaluated;
+    uint32_t cached;
+    uint64_t time_us;
+
+    sch_condition_stats (&evaluated, &cached, &time_us);
+    root = APTERYX_NODE (NULL, g_strdup (NETCONF_STATE_CONDITIONS_PATH));
+    APTERYX_LEAF (root, g_strdup ("evaluated"), g_strdup_printf ("%u", evaluated));
+    APTERYX_LEAF (root, g_strdup ("cached"), g_strdup_printf ("%u", cached));
+    APTERYX_LEAF (root, g_strdup ("time"), g_strdup_printf ("%" G_GUINT64_FORMAT, time_us));
+
+    apteryx_set_tree (root);
+    apteryx_free_tree (root);
+    return 1000 * 1000;
+}
+
+/**
+ * Refresh function for /netconf/state/edit-diff/<*>
+ */
+static uint64_t
+_netconf_edit_diff_refresh (const char *path)
+{
+    GNode *root;
+
+    root = APTERYX_NODE (NULL, g_strdup (NETCONF_STATE_EDIT_DIFF_PATH));
+    g_mutex_lock (&edit_diff_lock);
+    APTERYX_LEAF (root, g_strdup ("enabled"), g_strdup (netconf_edit_diff ? "true" : "false"));
+    APTERYX_LEAF (root, g_strdup ("edits"), g_strdup_printf ("%u", edit_diff_stats.edits));
+    APTERYX_LEAF (root, g_strdup ("written"), g_strdup_printf ("%u", edit_diff_stats.written));
+    APTERYX_LEAF (root, g_strdup ("skipped"), g_strdup_printf ("%u", edit_diff_stats.skipped));
+    APTERYX_LEAF (root, g_strdup ("pruned"), g_strdup_printf ("%u", edit_diff_stats.pruned));
+    g_mutex_unlock (&edit_diff_lock);
 
-    apteryx_prune (NETCONF_STATE_STATISTICS_PATH);
     apteryx_set_tree (root);
     apteryx_free_tree (root);
     return 1000 * 1000;
 }
 
+static bool
+_netconf_edit_diff (const char *path, const char *value)
+{
+    netconf_edit_diff = (g_strcmp0 (value, "true") == 0 || g_strcmp0 (value, "1") == 0);
+    return true;
+}
+
+static bool
+_netconf_cache_ttl (const char *path, const char *value)
+{
+    struct state_cache_entry *entry;
+    const char *key = path + strlen (NETCONF_CONFIG_CACHE_TTL "/");
+    char *cpath = g_uri_unescape_string (key, NULL);
+    uint32_t ttl = value ? g_ascii_strtoull (value, NULL, 10) : 0;
+
+    if (!cpath || cpath[0] != '/')
+    {
+        ERROR ("NETCONF: invalid cache path \"%s\"\n", key);
+        g_free (cpath);
+        return true;
+    }
+
+    g_mutex_lock (&state_cache_lock);
+    if (!state_cache || !state_cache_ttls)
+    {
+        g_mutex_unlock (&state_cache_lock);
+        g_free (cpath);
+        return true;
+    }
+    if (ttl)
+        g_hash_table_replace (state_cache_ttls, g_strdup (cpath), GUINT_TO_POINTER (ttl));
+    else
+        g_hash_table_remove (state_cache_ttls, cpath);
+
+    /* Anything cached with the old lifetime is refetched on next use, and
+     * dropped if the path is no longer cached. An entry being fetched is
+     * still in use so is only expired. */
+    entry = g_hash_table_lookup (state_cache, cpath);
+    if (entry && !ttl && !entry->fetching)
+        g_hash_table_remove (state_cache, cpath);
+    else if (entry)
+        entry->expires = 0;
+    g_mutex_unlock (&state_cache_lock);
+    g_free (cpath);
+    return true;
+}
+
 static bool
 _netconf_clear_session (const char *path, const char *value)
 {
@@ -2461,20 +6597,22 @@ create_session (int fd)
     session->fd = fd;
     session->running = g_main_loop_is_running (g_loop);
 
-    g_mutex_lock (&session_lock);
+    g_rw_lock_writer_lock (&session_lock);
     session->id = netconf_session_id++;
 
-    /* If the counter rounds, then the value 0 is not allowed */
-    if (!session->id)
+    /* If the counter rounds, then the value 0 is not allowed, nor is an ID
+     * still in use by a long lived session */
+    while (!session->id ||
+           g_hash_table_contains (open_sessions, GUINT_TO_POINTER (session->id)))
     {
         session->id = netconf_session_id++;
     }
 
-    /* Append to open sessions list */
-    open_sessions_list = g_list_append (open_sessions_list, session);
+    /* Add to open sessions */
+    g_hash_table_insert (open_sessions, GUINT_TO_POINTER (session->id), session);
     netconf_num_sessions++;
-    netconf_global_stats.in_sessions++;
-    g_mutex_unlock (&session_lock);
+    g_atomic_int_inc (&netconf_global_stats.in_sessions);
+    g_rw_lock_writer_unlock (&session_lock);
 
     return session;
 }
@@ -2488,10 +6626,27 @@ destroy_session (struct netconf_session *session)
         session->fd = -1;
     }
 
-    if (session->id == running_ds_lock.nc_sess.id)
+    release_lock (&running_ds_lock, session);
+
+    /* Changes to a locked candidate are discarded with the session holding the lock */
+    if (lock_held_by (&candidate_ds_lock, session))
+    {
+        g_mutex_lock (&candidate_lock);
+        candidate_clear ();
+        g_mutex_unlock (&candidate_lock);
+        release_lock (&candidate_ds_lock, session);
+    }
+
+    partial_lock_release_session (session->id);
+
+    /* A confirmed commit without a persist token is undone if its session ends */
+    g_mutex_lock (&candidate_lock);
+    if (confirmed_commit.snapshots && !confirmed_commit.persist &&
+        confirmed_commit.session_id == session->id)
     {
-        reset_lock ();
+        confirmed_commit_end (true);
     }
+    g_mutex_unlock (&candidate_lock);
 
     remove_netconf_session (session);
 
@@ -2499,6 +6654,7 @@ destroy_session (struct netconf_session *session)
     g_free (session->rem_addr);
     g_free (session->rem_port);
     g_free (session->login_time);
+    g_free (session->trace.filter);
 
     g_free (session);
 }
@@ -2545,6 +6701,8 @@ static char *
 receive_message (struct netconf_session *session, int *rlen)
 {
     char *message = NULL;
+    gint64 start = 0;
+    uint32_t chunks = 0;
     int len = 0;
 
     /* Read chunks until we get the end of message marker */
@@ -2562,6 +6720,12 @@ receive_message (struct netconf_session *session, int *rlen)
             break;
         }
 
+        /* Framing is timed from the first chunk, not while idle */
+        if (!message)
+            session->rpc_arrived = g_get_monotonic_time ();
+        if (!start)
+            start = rpc_trace_now (session);
+
         if (!chunk_len)
         {
             /* End of message */
@@ -2595,8 +6759,14 @@ receive_message (struct netconf_session *session, int *rlen)
         }
         VERBOSE ("RX(%d):\n%.*s\n", chunk_len, chunk_len, message + len);
         len += chunk_len;
+        chunks++;
     }
 
+    if (message)
+        session_count_message (session, true, len, chunks);
+
+    rpc_trace_phase (session, RPC_PHASE_RECEIVE, start);
+    session->trace.in_bytes = len;
     *rlen = len;
     return message;
 }
@@ -2604,13 +6774,16 @@ receive_message (struct netconf_session *session, int *rlen)
 void *
 netconf_handle_session (int fd)
 {
+    gint64 accepted = g_get_monotonic_time ();
     struct netconf_session *session = create_session (fd);
     struct ucred ucred;
     socklen_t len = sizeof (struct ucred);
 
+    session->connected = g_get_real_time ();
+
     if (!session->running || netconf_num_sessions > netconf_max_sessions)
     {
-        netconf_global_stats.dropped_sessions++;
+        g_atomic_int_inc (&netconf_global_stats.dropped_sessions);
         destroy_session (session);
         return NULL;
     }
@@ -2621,72 +6794,88 @@ netconf_handle_session (int fd)
     timeout.tv_usec = 0;
     if (setsockopt (fd, SOL_SOCKET, SO_RCVTIMEO, &timeout, sizeof (timeout)) < 0)
     {
-        netconf_global_stats.dropped_sessions++;
+        g_atomic_int_inc (&netconf_global_stats.dropped_sessions);
         destroy_session (session);
         return NULL;
     }
 
-    /* Get user information from the calling process */
-    if (getsockopt (fd, SOL_SOCKET, SO_PEERCRED, &ucred, &len) >= 0)
-    {
-        struct passwd *pw = getpwuid(ucred.uid);
-        if (pw)
-        {
-            session->username = g_strdup(pw->pw_name);
-        }
-        add_session_data (session, ucred.pid);
-    }
-
-    /* Send our hello - RFC 6241 section 8.1 last paragraph */
+    /* Send our hello - RFC 6241 section 8.1 last paragraph. Nothing slow is
+     * done before this so the client can carry on with its side. */
     session->running = g_main_loop_is_running (g_loop);
     if (!session->running || !send_hello (session))
     {
-        netconf_global_stats.dropped_sessions++;
+        g_atomic_int_inc (&netconf_global_stats.dropped_sessions);
         destroy_session (session);
         return NULL;
     }
+    latency_hist_since (&hello_latency, accepted);
+
+    /* Get user information from the calling process while the client replies */
+    if (getsockopt (fd, SOL_SOCKET, SO_PEERCRED, &ucred, &len) >= 0)
+    {
+        session->username = username_lookup (ucred.uid);
+        session->pid = ucred.pid;
+    }
 
     /* Process hello's first */
     session->running = g_main_loop_is_running (g_loop);
     if (!session->running || !handle_hello (session))
     {
-        netconf_global_stats.in_bad_hellos++;
+        g_atomic_int_inc (&netconf_global_stats.in_bad_hellos);
         destroy_session (session);
         return NULL;
     }
+    latency_hist_since (&setup_latency, accepted);
+
+    /* Read the session data here rather than while the state is refreshed
+     * with the sessions locked */
+    session_data (session);
 
     /* Process chunked RPC's */
     while ((session->running = g_main_loop_is_running (g_loop)))
     {
         xmlDoc *doc = NULL;
         xmlNode *rpc, *child;
+        sch_xml_to_gnode_parms parms = NULL;
+        char *edit_op = NULL;
+        struct rpc_latency *latency;
+        gint64 start;
         char *message;
         int len;
 
         /* Receive message */
+        rpc_trace_begin (session);
         message = receive_message (session, &len);
         if (!session->running || !message)
         {
-            netconf_global_stats.dropped_sessions++;
+            g_atomic_int_inc (&netconf_global_stats.dropped_sessions);
             break;
         }
 
-        /* Parse RPC */
-        doc = xmlParseMemory (message, len);
+        /* Parse RPC. The configuration of an edit is converted as it is read. */
+        start = rpc_trace_now (session);
+        doc = edit_stream_parse (message, len, &parms, &edit_op);
+        if (!doc)
+            doc = xmlParseMemory (message, len);
+        rpc_trace_phase (session, RPC_PHASE_PARSE, start);
         if (!doc)
         {
             ERROR ("XML: Invalid Netconf message\n");
             g_free (message);
-            netconf_global_stats.dropped_sessions++;
+            g_atomic_int_inc (&netconf_global_stats.dropped_sessions);
             break;
         }
+
+        /* The document holds everything needed from here on */
+        g_free (message);
+        message = NULL;
         rpc = xmlDocGetRootElement (doc);
         if (!rpc || g_strcmp0 ((char *) rpc->name, "rpc") != 0)
         {
             ERROR ("XML: No root RPC element\n");
             xmlFreeDoc (doc);
             g_free (message);
-            netconf_global_stats.dropped_sessions++;
+            g_atomic_int_inc (&netconf_global_stats.dropped_sessions);
             break;
         }
 
@@ -2697,7 +6886,7 @@ netconf_handle_session (int fd)
             ERROR ("XML: No RPC child element\n");
             xmlFreeDoc (doc);
             g_free (message);
-            netconf_global_stats.dropped_sessions++;
+            g_atomic_int_inc (&netconf_global_stats.dropped_sessions);
             break;
         }
 
@@ -2707,20 +6896,26 @@ netconf_handle_session (int fd)
             send_rpc_error_full (session, rpc, NC_ERR_TAG_MISSING_ATTR, NC_ERR_TYPE_PROTOCOL,
                                  "RPC missing message-id attribute",
                                  "rpc", "message-id", false);
+            edit_parms_free (parms);
             xmlFreeDoc (doc);
             g_free (message);
-            netconf_global_stats.dropped_sessions++;
+            g_atomic_int_inc (&netconf_global_stats.dropped_sessions);
             break;
         }
 
+        /* Time handling and replying to each RPC */
+        rpc_count ((char *) child->name);
+        latency = rpc_latency_find ((char *) child->name);
+        start = g_get_monotonic_time ();
+
         if (g_strcmp0 ((char *) child->name, "close-session") == 0)
         {
             VERBOSE ("Closing session\n");
             send_rpc_ok (session, rpc, true);
             xmlFreeDoc (doc);
             g_free (message);
-            session->counters.in_rpcs++;
-            netconf_global_stats.session_totals.in_rpcs++;
+            g_atomic_int_inc (&session->counters.in_rpcs);
+            rpc_latency_record (session, latency, start);
             break;
         }
         else if (g_strcmp0 ((char *) child->name, "kill-session") == 0)
@@ -2741,7 +6936,12 @@ netconf_handle_session (int fd)
         else if (g_strcmp0 ((char *) child->name, "edit-config") == 0)
         {
             VERBOSE ("Handle RPC %s\n", (char *) child->name);
-            handle_edit (session, rpc);
+            handle_edit (session, rpc, parms, edit_op);
+        }
+        else if (g_strcmp0 ((char *) child->name, "validate") == 0)
+        {
+            VERBOSE ("Handle RPC %s\n", (char *) child->name);
+            handle_validate (session, rpc);
         }
         else if (g_strcmp0 ((char *) child->name, "lock") == 0)
         {
@@ -2753,6 +6953,31 @@ netconf_handle_session (int fd)
             VERBOSE ("Handle RPC %s\n", (char *) child->name);
             handle_unlock (session, rpc);
         }
+        else if (g_strcmp0 ((char *) child->name, "partial-lock") == 0)
+        {
+            VERBOSE ("Handle RPC %s\n", (char *) child->name);
+            handle_partial_lock (session, rpc);
+        }
+        else if (g_strcmp0 ((char *) child->name, "partial-unlock") == 0)
+        {
+            VERBOSE ("Handle RPC %s\n", (char *) child->name);
+            handle_partial_unlock (session, rpc);
+        }
+        else if (g_strcmp0 ((char *) child->name, "commit") == 0)
+        {
+            VERBOSE ("Handle RPC %s\n", (char *) child->name);
+            handle_commit (session, rpc);
+        }
+        else if (g_strcmp0 ((char *) child->name, "cancel-commit") == 0)
+        {
+            VERBOSE ("Handle RPC %s\n", (char *) child->name);
+            handle_cancel_commit (session, rpc);
+        }
+        else if (g_strcmp0 ((char *) child->name, "discard-changes") == 0)
+        {
+            VERBOSE ("Handle RPC %s\n", (char *) child->name);
+            handle_discard_changes (session, rpc);
+        }
         else
         {
             gchar *error_msg = g_strdup_printf ("Unknown RPC (%s)", child->name);
@@ -2762,10 +6987,12 @@ netconf_handle_session (int fd)
             g_free (error_msg);
             xmlFreeDoc (doc);
             g_free (message);
-            netconf_global_stats.dropped_sessions++;
+            g_atomic_int_inc (&netconf_global_stats.dropped_sessions);
             break;
         }
 
+        rpc_trace_end (session, (char *) child->name,
+                       rpc_latency_record (session, latency, start));
         xmlFreeDoc (doc);
         g_free (message);
     }
@@ -2788,16 +7015,63 @@ netconf_init (const char *path, const char *supported,  const char *cp, const ch
     /* Create a random starting session ID */
     srand (time (NULL));
     netconf_session_id = rand () % 32768;
+    open_sessions = g_hash_table_new (g_direct_hash, g_direct_equal);
+
+    /* Initialise locks */
+    reset_lock (&running_ds_lock);
+    reset_lock (&candidate_ds_lock);
 
-    /* Initialise lock */
-    reset_lock ();
+    /* Waiting for held locks */
+    apteryx_refresh (NETCONF_STATE_LOCK_WAIT_PATH "/*", _netconf_lock_wait_refresh);
+    apteryx_watch (NETCONF_CONFIG_LOCK_WAIT, _netconf_lock_wait);
+    apteryx_set_int (NETCONF_STATE, "lock-wait", netconf_lock_wait);
 
-    /* Set up Apteryx refresh on session information */
+    /* Set up Apteryx refresh on session information. Only changes are
+     * published, so start from nothing left over from an earlier run. */
+    apteryx_prune (NETCONF_STATE_SESSIONS_PATH);
+    apteryx_prune (NETCONF_STATE_STATISTICS_PATH);
     apteryx_refresh (NETCONF_STATE_SESSIONS_PATH "/*", _netconf_sessions_refresh);
     apteryx_refresh (NETCONF_STATE_STATISTICS_PATH "/*", _netconf_statistics_refresh);
     apteryx_watch (NETCONF_SESSION_STATUS, _netconf_clear_session);
     apteryx_watch (NETCONF_CONFIG_MAX_SESSIONS, _netconf_max_sessions);
     apteryx_set_int (NETCONF_STATE, "max-sessions", netconf_max_sessions);
+    apteryx_watch (NETCONF_CONFIG_STATE_REFRESH, _netconf_state_refresh);
+    apteryx_set_int (NETCONF_STATE, "state-refresh", netconf_state_refresh);
+
+    /* Threshold for the slow RPC log */
+    apteryx_watch (NETCONF_CONFIG_SLOW_RPC, _netconf_slow_rpc);
+    apteryx_set_int (NETCONF_STATE, "slow-rpc", netconf_slow_rpc);
+
+    /* Proxied database queries */
+    proxy_stats_table = g_hash_table_new_full (g_str_hash, g_str_equal, g_free, g_free);
+    proxy_cache = g_hash_table_new_full (g_str_hash, g_str_equal, g_free,
+                                         (GDestroyNotify) proxy_cache_entry_free);
+    proxy_workers = g_thread_pool_new (proxy_job_run, NULL, NETCONF_PROXY_WORKERS_MAX, FALSE, NULL);
+    apteryx_refresh (NETCONF_STATE_PROXIES_PATH "/*", _netconf_proxies_refresh);
+    apteryx_watch (NETCONF_CONFIG_PROXY_TIMEOUT, _netconf_proxy_timeout);
+    apteryx_watch (NETCONF_CONFIG_PROXY_CACHE_TTL, _netconf_proxy_cache_ttl);
+    apteryx_set_int (NETCONF_STATE, "proxy-timeout", netconf_proxy_timeout);
+    apteryx_set_int (NETCONF_STATE, "proxy-cache-ttl", netconf_proxy_cache_ttl);
+
+    /* Operational data cache */
+    state_cache_ttls = g_hash_table_new_full (g_str_hash, g_str_equal, g_free, NULL);
+    state_cache = g_hash_table_new_full (g_str_hash, g_str_equal, g_free,
+                                         (GDestroyNotify) state_cache_entry_free);
+    apteryx_watch (NETCONF_CONFIG_CACHE_TTL "/*", _netconf_cache_ttl);
+
+    /* Coalescing of identical concurrent reads */
+    get_flights = g_hash_table_new_full (g_str_hash, g_str_equal, g_free, NULL);
+    apteryx_refresh (NETCONF_STATE_COALESCING_PATH "/*", _netconf_coalescing_refresh);
+
+    /* Diff based edits */
+    apteryx_refresh (NETCONF_STATE_EDIT_DIFF_PATH "/*", _netconf_edit_diff_refresh);
+    apteryx_watch (NETCONF_CONFIG_EDIT_DIFF, _netconf_edit_diff);
+
+    /* Minimised edit prunes */
+    apteryx_refresh (NETCONF_STATE_EDIT_PRUNE_PATH "/*", _netconf_edit_prune_refresh);
+
+    /* Condition evaluation statistics */
+    apteryx_refresh (NETCONF_STATE_CONDITIONS_PATH "/*", _netconf_conditions_refresh);
 
     /* Register with the YANG condition parser */
     sch_condition_register (apteryx_netconf_debug, apteryx_netconf_verbose);
@@ -2808,7 +7082,51 @@ netconf_init (const char *path, const char *supported,  const char *cp, const ch
 void
 netconf_shutdown (void)
 {
+    /* Outstanding proxy queries hold their own references */
+    if (proxy_workers)
+        g_thread_pool_free (proxy_workers, TRUE, FALSE);
+    proxy_workers = NULL;
+    g_mutex_lock (&proxy_lock);
+    if (proxy_cache)
+        g_hash_table_destroy (proxy_cache);
+    proxy_cache = NULL;
+    g_mutex_unlock (&proxy_lock);
+    partial_lock_release_session (0);
+    g_mutex_lock (&candidate_lock);
+    candidate_clear ();
+    if (confirmed_commit.snapshots)
+        confirmed_commit_end (false);
+    g_mutex_unlock (&candidate_lock);
+    g_mutex_lock (&state_cache_lock);
+    if (state_cache)
+        g_hash_table_destroy (state_cache);
+    state_cache = NULL;
+    if (state_cache_ttls)
+        g_hash_table_destroy (state_cache_ttls);
+    state_cache_ttls = NULL;
+    g_mutex_unlock (&state_cache_lock);
+    g_mutex_lock (&published_lock);
+    if (published_sessions)
+        g_hash_table_destroy (published_sessions);
+    published_sessions = NULL;
+    if (published_statistics)
+        g_hash_table_destroy (published_statistics);
+    published_statistics = NULL;
+    apteryx_prune (NETCONF_STATE_SESSIONS_PATH);
+    apteryx_prune (NETCONF_STATE_STATISTICS_PATH);
+    g_mutex_unlock (&published_lock);
+    g_mutex_lock (&username_lock);
+    if (username_cache)
+        g_hash_table_destroy (username_cache);
+    username_cache = NULL;
+    g_mutex_unlock (&username_lock);
+    g_mutex_lock (&rpc_count_lock);
+    if (rpc_counts)
+        g_hash_table_destroy (rpc_counts);
+    rpc_counts = NULL;
+    g_mutex_unlock (&rpc_count_lock);
     /* Cleanup datamodels */
+    sch_cache_free ();
     if (g_schema)
         sch_free (g_schema);
 }
@@ -136,8 +136,12 @@ rc=$?; if [[ $rc != 0 ]]; then quit $rc; fi
 # Parameters
 if [ $ACTION == "test" ]; then
         PARAM="-b"
+        # Log slow RPCs to a file the tests can check
+        sed -i '1 s/$/ slow-rpc/' $BUILD/etc/apteryx/schema/netconf-logging-options
+        LOG=$BUILD/apteryx-netconf.log
 else
         PARAM="-v"
+        LOG=/dev/stdout
 fi
 
 # Start netconf
@@ -146,7 +150,7 @@ rm -f $BUILD/apteryx-netconf.sock
 # TEST_WRAPPER="valgrind --leak-check=full"
 # TEST_WRAPPER="valgrind --tool=cachegrind"
 G_SLICE=always-malloc LD_LIBRARY_PATH=$BUILD/usr/lib \
-        $TEST_WRAPPER ../apteryx-netconf $PARAM -m $BUILD/etc/apteryx/schema/ -l netconf-logging-options --unix $BUILD/apteryx-netconf.sock
+        stdbuf -oL $TEST_WRAPPER ../apteryx-netconf $PARAM -m $BUILD/etc/apteryx/schema/ -l netconf-logging-options --unix $BUILD/apteryx-netconf.sock > $LOG
 rc=$?; if [[ $rc != 0 ]]; then quit $rc; fi
 sleep 0.5
 cd $BUILD/../
@@ -15,6 +15,7 @@ password = 'friend'
 APTERYX = 'LD_LIBRARY_PATH=.build/usr/lib .build/usr/bin/apteryx'
 # APTERYX_URL='tcp://192.168.6.2:9999:'
 APTERYX_URL = ''
+NETCONF_LOG = '.build/apteryx-netconf.log'
 
 # TEST HELPERS
 
@@ -0,0 +1,345 @@
+import time
+from ncclient.operations import RPCError
+from lxml import etree
+from conftest import connect, apteryx_get, apteryx_set
+
+# CANDIDATE
+
+
+def _candidate_config(m, xpath):
+    xml = m.get_config(source='candidate', filter=('xpath', xpath)).data
+    print(etree.tostring(xml, pretty_print=True, encoding="unicode"))
+    return xml
+
+
+def test_candidate_edit_commit():
+    payload = """
+<config>
+  <test xmlns="http://test.com/ns/yang/testing">
+    <settings>
+        <priority>5</priority>
+    </settings>
+  </test>
+</config>
+"""
+    m = connect()
+    try:
+        response = m.edit_config(target='candidate', config=payload)
+        assert response.ok is True
+        # Running is untouched until the commit
+        assert apteryx_get("/test/settings/priority") == "1"
+        xml = _candidate_config(m, '/test/settings/priority')
+        assert xml.find('./{*}test/{*}settings/{*}priority').text == '5'
+        xml = m.get_config(source='running', filter=('xpath', '/test/settings/priority')).data
+        assert xml.find('./{*}test/{*}settings/{*}priority').text == '1'
+        # Unchanged data is read from running
+        xml = _candidate_config(m, '/test/settings')
+        assert xml.find('./{*}test/{*}settings/{*}debug').text == 'enable'
+        assert xml.find('./{*}test/{*}settings/{*}priority').text == '5'
+        response = m.commit()
+        assert response.ok is True
+        assert apteryx_get("/test/settings/priority") == "5"
+    finally:
+        m.discard_changes()
+        m.close_session()
+
+
+def test_candidate_edits_batched():
+    m = connect()
+    try:
+        for priority in range(2, 6):
+            payload = """
+<config>
+  <test xmlns="http://test.com/ns/yang/testing">
+    <settings>
+        <priority>%d</priority>
+    </settings>
+    <animals>
+        <animal>
+            <name>frog%d</name>
+        </animal>
+    </animals>
+  </test>
+</config>
+""" % (priority, priority)
+            m.edit_config(target='candidate', config=payload)
+        assert apteryx_get("/test/settings/priority") == "1"
+        assert apteryx_get("/test/animals/animal/frog5/name") == "Not found"
+        m.commit()
+        assert apteryx_get("/test/settings/priority") == "5"
+        for priority in range(2, 6):
+            assert apteryx_get("/test/animals/animal/frog%d/name" % priority) == "frog%d" % priority
+    finally:
+        m.discard_changes()
+        m.close_session()
+
+
+def test_candidate_delete():
+    payload = """
+<config xmlns:xc="urn:ietf:params:xml:ns:netconf:base:1.0">
+  <test xmlns="http://test.com/ns/yang/testing">
+    <animals>
+        <animal xc:operation="delete">
+            <name>cat</name>
+        </animal>
+    </animals>
+  </test>
+</config>
+"""
+    m = connect()
+    try:
+        m.edit_config(target='candidate', config=payload)
+        assert apteryx_get("/test/animals/animal/cat/name") == "cat"
+        xml = _candidate_config(m, '/test/animals')
+        names = [e.text for e in xml.findall('./{*}test/{*}animals/{*}animal/{*}name')]
+        assert 'cat' not in names
+        assert 'dog' in names
+        # The delete is now checked against the candidate
+        response = None
+        try:
+            response = m.edit_config(target='candidate', config=payload)
+        except RPCError as err:
+            assert err.tag == 'data-missing'
+        assert response is None
+        m.commit()
+        assert apteryx_get("/test/animals/animal/cat/name") == "Not found"
+        assert apteryx_get("/test/animals/animal/dog/name") == "dog"
+    finally:
+        m.discard_changes()
+        m.close_session()
+
+
+def test_candidate_discard_changes():
+    payload = """
+<config>
+  <test xmlns="http://test.com/ns/yang/testing">
+    <settings>
+        <priority>5</priority>
+    </settings>
+  </test>
+</config>
+"""
+    m = connect()
+    m.edit_config(target='candidate', config=payload)
+    response = m.discard_changes()
+    assert response.ok is True
+    xml = _candidate_config(m, '/test/settings/priority')
+    assert xml.find('./{*}test/{*}settings/{*}priority').text == '1'
+    m.commit()
+    assert apteryx_get("/test/settings/priority") == "1"
+    m.close_session()
+
+
+def test_candidate_lock_modified_fail():
+    payload = """
+<config>
+  <test xmlns="http://test.com/ns/yang/testing">
+    <settings>
+        <priority>5</priority>
+    </settings>
+  </test>
+</config>
+"""
+    m = connect()
+    try:
+        m.edit_config(target='candidate', config=payload)
+        response = None
+        try:
+            response = m.lock(target='candidate')
+        except RPCError as err:
+            assert err.tag == 'lock-denied'
+        assert response is None
+    finally:
+        m.discard_changes()
+        m.close_session()
+
+
+def test_candidate_lock_denied_session_id():
+    m1 = connect()
+    m2 = connect()
+    m3 = connect()
+    m1.lock(target='running')
+    m2.lock(target='candidate')
+    try:
+        response = None
+        try:
+            response = m3.lock(target='candidate')
+        except RPCError as err:
+            assert err.tag == 'lock-denied'
+            # The holder of the candidate is reported, not that of running
+            xml_error_info = etree.fromstring(err.info.encode('utf-8'))
+            assert xml_error_info.find('.//{*}session-id').text == m2.session_id
+        assert response is None
+    finally:
+        m3.close_session()
+        m2.close_session()
+        m1.close_session()
+
+
+def test_candidate_condition_sees_candidate():
+    wombat = """
+<config>
+  <test xmlns="http://test.com/ns/yang/testing">
+    <animals>
+        <animal>
+            <name>wombat</name>
+        </animal>
+    </animals>
+  </test>
+</config>
+"""
+    claws = """
+<config>
+  <test xmlns="http://test.com/ns/yang/testing">
+    <animals>
+        <animal>
+            <name>cat</name>
+            <claws>5</claws>
+        </animal>
+    </animals>
+  </test>
+</config>
+"""
+    m = connect()
+    try:
+        m.edit_config(target='candidate', config=wombat)
+        # The when condition on claws is met by the wombat in the candidate
+        response = m.edit_config(target='candidate', config=claws)
+        assert response.ok is True
+        assert apteryx_get("/test/animals/animal/wombat/name") == "Not found"
+    finally:
+        m.discard_changes()
+        m.close_session()
+
+
+def test_candidate_locked_edit_fail():
+    payload = """
+<config>
+  <test xmlns="http://test.com/ns/yang/testing">
+    <settings>
+        <priority>5</priority>
+    </settings>
+  </test>
+</config>
+"""
+    m1 = connect()
+    m2 = connect()
+    m1.lock(target='candidate')
+    response = None
+    try:
+        response = m2.edit_config(target='candidate', config=payload)
+    except RPCError as err:
+        assert err.tag == 'in-use'
+    assert response is None
+    m2.close_session()
+    # Closing the session holding the lock discards its changes
+    m1.edit_config(target='candidate', config=payload)
+    m1.close_session()
+    m = connect()
+    xml = _candidate_config(m, '/test/settings/priority')
+    assert xml.find('./{*}test/{*}settings/{*}priority').text == '1'
+    m.close_session()
+
+
+# CONFIRMED-COMMIT
+
+PRIORITY_5 = """
+<config>
+  <test xmlns="http://test.com/ns/yang/testing">
+    <settings>
+        <priority>5</priority>
+    </settings>
+    <animals>
+        <animal xmlns:xc="urn:ietf:params:xml:ns:netconf:base:1.0" xc:operation="delete">
+            <name>cat</name>
+        </animal>
+    </animals>
+  </test>
+</config>
+"""
+
+
+def test_confirmed_commit_timeout():
+    m = connect()
+    m.edit_config(target='candidate', config=PRIORITY_5)
+    m.commit(confirmed=True, timeout="2")
+    assert apteryx_get("/test/settings/priority") == "5"
+    assert apteryx_get("/test/animals/animal/cat/name") == "Not found"
+    time.sleep(3)
+    # Not confirmed so the changes are undone
+    assert apteryx_get("/test/settings/priority") == "1"
+    assert apteryx_get("/test/animals/animal/cat/name") == "cat"
+    assert apteryx_get("/test/animals/animal/cat/type") == "1"
+    m.close_session()
+
+
+def test_confirmed_commit_timeout_keeps_state():
+    payload = """
+<config>
+  <interfaces xmlns="http://example.com/ns/interfaces">
+    <interface>
+      <name>eth2</name>
+      <mtu>1500</mtu>
+    </interface>
+  </interfaces>
+</config>
+"""
+    m = connect()
+    m.edit_config(target='candidate', config=payload)
+    m.commit(confirmed=True, timeout="2")
+    assert apteryx_get("/interfaces/interface/eth2/mtu") == "1500"
+    # State changed by its provider in the meantime is not rolled back
+    apteryx_set("/interfaces/interface/eth2/status", "up")
+    time.sleep(3)
+    assert apteryx_get("/interfaces/interface/eth2/mtu") == "9000"
+    assert apteryx_get("/interfaces/interface/eth2/status") == "up"
+    m.close_session()
+
+
+def test_confirmed_commit_confirm():
+    m = connect()
+    m.edit_config(target='candidate', config=PRIORITY_5)
+    m.commit(confirmed=True, timeout="2")
+    m.commit()
+    time.sleep(3)
+    assert apteryx_get("/test/settings/priority") == "5"
+    assert apteryx_get("/test/animals/animal/cat/name") == "Not found"
+    m.close_session()
+
+
+def test_confirmed_commit_cancel():
+    m = connect()
+    m.edit_config(target='candidate', config=PRIORITY_5)
+    m.commit(confirmed=True)
+    assert apteryx_get("/test/settings/priority") == "5"
+    response = m.cancel_commit()
+    assert response.ok is True
+    assert apteryx_get("/test/settings/priority") == "1"
+    assert apteryx_get("/test/animals/animal/cat/name") == "cat"
+    m.close_session()
+
+
+def test_confirmed_commit_session_end():
+    m = connect()
+    m.edit_config(target='candidate', config=PRIORITY_5)
+    m.commit(confirmed=True)
+    m.close_session()
+    time.sleep(0.5)
+    assert apteryx_get("/test/settings/priority") == "1"
+    assert apteryx_get("/test/animals/animal/cat/name") == "cat"
+
+
+def test_confirmed_commit_other_session_fail():
+    m1 = connect()
+    m2 = connect()
+    m1.edit_config(target='candidate', config=PRIORITY_5)
+    m1.commit(confirmed=True)
+    response = None
+    try:
+        response = m2.commit()
+    except RPCError as err:
+        assert err.tag == 'invalid-value'
+    assert response is None
+    m1.cancel_commit()
+    m2.close_session()
+    m1.close_session()
@@ -1,7 +1,9 @@
 import pytest
+import time
 from ncclient.operations import RPCError
+from ncclient.xml_ import to_ele
 from lxml import etree
-from conftest import connect, apteryx_set, apteryx_proxy
+from conftest import connect, apteryx_set, apteryx_get, apteryx_prune, apteryx_proxy
 
 # EDIT-CONFIG
 
@@ -71,7 +73,7 @@ def test_edit_config_bad_target():
   </test>
 </config>
 """
-    _edit_config_test(payload, targ="candidate",
+    _edit_config_test(payload, targ="startup",
                       expect_err={"tag": "operation-not-supported", "type": "protocol"})
 
 
@@ -184,6 +186,104 @@ def test_edit_config_list_key_slash():
     _edit_config_test(payload, post_xpath="/test/animals", inc_str=["frog/y"])
 
 
+def test_edit_config_large_list():
+    animals = "".join("""
+        <animal>
+            <name>frog%d</name>
+            <type>little</type>
+        </animal>""" % i for i in range(500))
+    payload = """
+<config xmlns:xc="urn:ietf:params:xml:ns:netconf:base:1.0"
+        xmlns="urn:ietf:params:xml:ns:netconf:base:1.0">
+  <test>
+    <settings>
+        <priority>5</priority>
+    </settings>
+    <animals>%s
+    </animals>
+  </test>
+</config>
+""" % animals
+    _edit_config_test(payload)
+    assert apteryx_get("/test/settings/priority") == "5"
+    assert apteryx_get("/test/animals/animal/frog0/name") == "frog0"
+    assert apteryx_get("/test/animals/animal/frog499/name") == "frog499"
+    assert apteryx_get("/test/animals/animal/cat/name") == "cat"
+
+
+# EDIT-CONFIG (test-option)
+
+
+def test_edit_config_test_only():
+    payload = """
+<config xmlns:xc="urn:ietf:params:xml:ns:netconf:base:1.0"
+        xmlns="urn:ietf:params:xml:ns:netconf:base:1.0">
+  <test>
+    <settings>
+        <priority>5</priority>
+    </settings>
+    <animals>
+        <animal xc:operation="delete">
+            <name>cat</name>
+        </animal>
+    </animals>
+  </test>
+</config>
+"""
+    m = connect()
+    response = m.edit_config(target='running', config=payload, test_option='test-only')
+    assert response.ok is True
+    m.close_session()
+    # Nothing is written
+    assert apteryx_get("/test/settings/priority") == "1"
+    assert apteryx_get("/test/animals/animal/cat/name") == "cat"
+
+
+def test_edit_config_test_only_error():
+    payload = """
+<config xmlns:xc="urn:ietf:params:xml:ns:netconf:base:1.0"
+        xmlns="urn:ietf:params:xml:ns:netconf:base:1.0">
+  <test>
+    <settings>
+        <priority>5</priority>
+    </settings>
+    <animals>
+        <animal xc:operation="delete">
+            <name>frog</name>
+        </animal>
+    </animals>
+  </test>
+</config>
+"""
+    m = connect()
+    try:
+        m.edit_config(target='running', config=payload, test_option='test-only')
+    except RPCError as err:
+        _error_check(err, {"tag": "data-missing", "type": "application"})
+    else:
+        assert False, 'Should have received an RPCError'
+    m.close_session()
+    assert apteryx_get("/test/settings/priority") == "1"
+
+
+def test_edit_config_test_then_set():
+    payload = """
+<config xmlns:xc="urn:ietf:params:xml:ns:netconf:base:1.0"
+        xmlns="urn:ietf:params:xml:ns:netconf:base:1.0">
+  <test>
+    <settings>
+        <priority>5</priority>
+    </settings>
+  </test>
+</config>
+"""
+    m = connect()
+    response = m.edit_config(target='running', config=payload, test_option='test-then-set')
+    assert response.ok is True
+    m.close_session()
+    assert apteryx_get("/test/settings/priority") == "5"
+
+
 # EDIT-CONFIG (operation="delete")
 
 
@@ -444,6 +544,32 @@ def test_edit_config_replace_all():
     _edit_config_test(payload, post_xpath='/test/animals', inc_str=["cat"], exc_str=["dog", "mouse"])
 
 
+def test_edit_config_replace_nested_prune():
+    """
+    Replace all animals and remove one below it - only one prune is needed.
+    """
+    time.sleep(1.1)
+    before = int(apteryx_get("/netconf/state/edit-prune/saved"))
+    payload = """
+<config xmlns:xc="urn:ietf:params:xml:ns:netconf:base:1.0" xmlns="urn:ietf:params:xml:ns:netconf:base:1.0">
+  <test>
+    <animals xc:operation="replace">
+      <animal>
+        <name>cat</name>
+        <type>big</type>
+      </animal>
+      <animal xc:operation="remove">
+        <name>dog</name>
+      </animal>
+    </animals>
+  </test>
+</config>
+"""
+    _edit_config_test(payload, post_xpath='/test/animals', inc_str=["cat"], exc_str=["dog", "mouse"])
+    time.sleep(1.1)
+    assert int(apteryx_get("/netconf/state/edit-prune/saved")) == before + 1
+
+
 def test_edit_config_replace_one_full():
     """
     Replace one animal. Fully specify the replacement.
@@ -507,6 +633,39 @@ def test_edit_config_replace_leaf_list():
     _edit_config_test(payload, post_xpath="/test/animals/animal/parrot/toys", inc_str=["bell"])
 
 
+def test_edit_config_diff_replace_list_item():
+    payload = """
+<config xmlns:xc="urn:ietf:params:xml:ns:netconf:base:1.0"
+        xmlns="urn:ietf:params:xml:ns:netconf:base:1.0">
+  <test>
+    <animals>
+        <animal xc:operation="replace">
+            <name>cat</name>
+            <colour>brown</colour>
+        </animal>
+        <animal>
+            <name>dog</name>
+            <colour>brown</colour>
+        </animal>
+    </animals>
+  </test>
+</config>
+"""
+    apteryx_set("/netconf/config/edit-diff", "true")
+    try:
+        time.sleep(1.1)
+        skipped = int(apteryx_get("/netconf/state/edit-diff/skipped"))
+        xml = _edit_config_test(payload, post_xpath="/test/animals")
+        assert xml.find('./{*}test/{*}animals/{*}animal[{*}name="cat"]/{*}colour').text == 'brown'
+        assert xml.find('./{*}test/{*}animals/{*}animal[{*}name="cat"]/{*}type') is None
+        assert xml.find('./{*}test/{*}animals/{*}animal[{*}name="dog"]/{*}colour').text == 'brown'
+        # The keys and the unchanged colour of the dog are not written
+        time.sleep(1.1)
+        assert int(apteryx_get("/netconf/state/edit-diff/skipped")) - skipped == 3
+    finally:
+        apteryx_prune("/netconf/config/edit-diff")
+
+
 # EDIT-CONFIG (operation=create)
 #  create:  The configuration data identified by the element
 #     containing this attribute is added to the configuration if
@@ -1071,6 +1230,28 @@ def test_edit_config_must_condition_true():
     _edit_config_test(payload, post_xpath="/test/animals/animal[name='dog']", inc_str=["ben"])
 
 
+def test_edit_config_condition_stats():
+    time.sleep(1.1)
+    before = int(apteryx_get("/netconf/state/conditions/evaluated"))
+    payload = """
+<config xmlns:xc="urn:ietf:params:xml:ns:netconf:base:1.0"
+        xmlns="urn:ietf:params:xml:ns:netconf:base:1.0">
+  <test>
+    <animals>
+        <animal>
+            <name>dog</name>
+            <friend>ben</friend>
+        </animal>
+    </animals>
+  </test>
+</config>
+"""
+    _edit_config_test(payload)
+    time.sleep(1.1)
+    assert int(apteryx_get("/netconf/state/conditions/evaluated")) > before
+    assert int(apteryx_get("/netconf/state/conditions/time")) >= 0
+
+
 def test_edit_config_must_condition_false():
     payload = """
 <config xmlns:xc="urn:ietf:params:xml:ns:netconf:base:1.0"
@@ -1089,6 +1270,123 @@ def test_edit_config_must_condition_false():
 </config>
 """
     _edit_config_test(payload, expect_err={"tag": "invalid-value", "type": "protocol"})
+    # Nothing is deleted when the conditions fail
+    assert apteryx_get("/test/animals/animal/cat/name") == "cat"
+
+
+def test_edit_config_must_condition_false_rollback():
+    payload = """
+<config xmlns:xc="urn:ietf:params:xml:ns:netconf:base:1.0"
+        xmlns="urn:ietf:params:xml:ns:netconf:base:1.0">
+  <test>
+    <animals>
+      <animal xc:operation="delete">
+        <name>cat</name>
+      </animal>
+      <animal>
+        <name>dog</name>
+        <friend xc:operation="merge">ben</friend>
+      </animal>
+    </animals>
+  </test>
+</config>
+"""
+    m = connect()
+    try:
+        m.edit_config(target='running', config=payload, error_option='rollback-on-error')
+    except RPCError as err:
+        _error_check(err, {"tag": "invalid-value", "type": "protocol"})
+    else:
+        assert False, 'Should have received an RPCError'
+    m.close_session()
+    # The delete is put back
+    assert apteryx_get("/test/animals/animal/cat/name") == "cat"
+    assert apteryx_get("/test/animals/animal/cat/type") == "1"
+
+
+def test_edit_config_rollback_on_error():
+    payload = """
+<config xmlns:xc="urn:ietf:params:xml:ns:netconf:base:1.0"
+        xmlns="urn:ietf:params:xml:ns:netconf:base:1.0">
+  <test>
+    <settings>
+        <priority>5</priority>
+    </settings>
+  </test>
+</config>
+"""
+    m = connect()
+    response = m.edit_config(target='running', config=payload, error_option='rollback-on-error')
+    assert response.ok is True
+    m.close_session()
+    assert apteryx_get("/test/settings/priority") == "5"
+
+
+def test_edit_config_large():
+    animals = "".join("<animal><name>a%d</name><colour>c%d</colour></animal>" % (i, i) for i in range(2000))
+    payload = """
+<config xmlns="urn:ietf:params:xml:ns:netconf:base:1.0">
+  <test xmlns="http://test.com/ns/yang/testing">
+    <animals>%s</animals>
+  </test>
+</config>
+""" % animals
+    m = connect()
+    response = m.edit_config(target='running', config=payload)
+    assert response.ok is True
+    m.close_session()
+    assert apteryx_get("/test/animals/animal/a0/colour") == "c0"
+    assert apteryx_get("/test/animals/animal/a1999/name") == "a1999"
+    assert apteryx_get("/test/animals/animal/a1999/colour") == "c1999"
+    assert apteryx_get("/test/animals/animal/cat/name") == "cat"
+
+
+def test_edit_config_default_operation_after_config():
+    rpc = """
+<edit-config xmlns="urn:ietf:params:xml:ns:netconf:base:1.0">
+  <target><running/></target>
+  <config>
+    <test xmlns="http://test.com/ns/yang/testing">
+      <animals>
+        <animal>
+          <name>cat</name>
+          <colour>brown</colour>
+        </animal>
+      </animals>
+    </test>
+  </config>
+  <default-operation>replace</default-operation>
+</edit-config>
+"""
+    m = connect()
+    response = m.dispatch(to_ele(rpc))
+    assert response.ok is True
+    m.close_session()
+    # The whole of the test model is replaced, not merged into
+    assert apteryx_get("/test/animals/animal/cat/colour") == "brown"
+    assert apteryx_get("/test/animals/animal/dog/name") == "Not found"
+
+
+def test_edit_config_bad_error_option():
+    payload = """
+<config xmlns:xc="urn:ietf:params:xml:ns:netconf:base:1.0"
+        xmlns="urn:ietf:params:xml:ns:netconf:base:1.0">
+  <test>
+    <settings>
+        <priority>5</priority>
+    </settings>
+  </test>
+</config>
+"""
+    m = connect()
+    try:
+        m.edit_config(target='running', config=payload, error_option='bob')
+    except RPCError as err:
+        _error_check(err, {"tag": "invalid-value", "type": "protocol"})
+    else:
+        assert False, 'Should have received an RPCError'
+    m.close_session()
+    assert apteryx_get("/test/settings/priority") == "1"
 
 
 def test_edit_config_leaf_list_invalid_value():
@@ -1,7 +1,8 @@
 import pytest
+import time
 from ncclient.xml_ import to_ele
 from lxml import etree
-from conftest import connect, _get_test_with_filter, apteryx_set, apteryx_proxy, apteryx_prune
+from conftest import connect, _get_test_with_filter, apteryx_set, apteryx_get, apteryx_proxy, apteryx_prune
 
 
 def test_get_subtree_no_filter():
@@ -689,6 +690,46 @@ def test_get_subtree_select_key_value_other_field_exp_simple():
     _get_test_with_filter(select, expected)
 
 
+def test_get_subtree_state_cache_ttl():
+    select = '<test><state><counter/></state></test>'
+    apteryx_set("/netconf/config/cache-ttl/%2Ftest%2Fstate", "5000")
+    time.sleep(0.5)
+    try:
+        xml = _get_test_with_filter(select)
+        assert xml.find('./{*}test/{*}state/{*}counter').text == '42'
+        apteryx_set("/test/state/counter", "43")
+        # Within the lifetime of the cache the old value is returned
+        xml = _get_test_with_filter(select)
+        assert xml.find('./{*}test/{*}state/{*}counter').text == '42'
+        # The cache is never used for get-config
+        m = connect()
+        xml = m.get_config(source='running', filter=('subtree', '<test><settings><debug/></settings></test>')).data
+        assert xml.find('./{*}test/{*}settings/{*}debug').text == 'enable'
+        m.close_session()
+    finally:
+        apteryx_prune("/netconf/config/cache-ttl")
+    time.sleep(0.5)
+    xml = _get_test_with_filter(select)
+    assert xml.find('./{*}test/{*}state/{*}counter').text == '43'
+
+
+def test_get_subtree_select_key_value_other_field_exp_no_match():
+    select = """
+<test>
+    <animals>
+        <animal>
+            <name/>
+                <colour>purple</colour>
+        </animal>
+    </animals>
+</test>
+    """
+    xml = _get_test_with_filter(select)
+    assert xml.tag == '{urn:ietf:params:xml:ns:netconf:base:1.0}data'
+    assert len(xml.getchildren()) == 0
+    print(etree.tostring(xml, pretty_print=True, encoding="unicode"))
+
+
 def test_get_subtree_select_key_value_other_field_exp_deep():
     select = """
 <test>
@@ -794,6 +835,19 @@ def test_get_subtree_proxy_named_element():
     _get_test_with_filter(select, expected)
 
 
+def test_get_subtree_proxy_state():
+    apteryx_set("/logical-elements/logical-element/loop/name", "loopy")
+    apteryx_set("/logical-elements/logical-element/loop/root", "root")
+    apteryx_set("/apteryx/sockets/E18FE205",  "tcp://127.0.0.1:9999")
+    apteryx_proxy("/logical-elements/logical-element/loopy/*", "tcp://127.0.0.1:9999")
+    select = '<logical-elements><logical-element><name>loopy</name><test><animals><animal name="mouse"><type/></animal></animals></test></logical-element></logical-elements>'
+    _get_test_with_filter(select)
+    target = "%2Flogical-elements%2Flogical-element%2Floopy"
+    assert apteryx_get("/netconf-state/proxies/proxy/%s/target" % target) == "/logical-elements/logical-element/loopy"
+    assert int(apteryx_get("/netconf-state/proxies/proxy/%s/requests" % target)) > 0
+    assert int(apteryx_get("/netconf-state/proxies/proxy/%s/timeouts" % target)) == 0
+
+
 def test_get_subtree_if_feature():
     apteryx_set("/test/animals/animal/cat/friend", "smokey")
     apteryx_set("/test/animals/animal/cat/claws", "5")
@@ -1,7 +1,10 @@
 # from ncclient.operations import RPCError
+from ncclient.xml_ import to_ele
 from lxml import etree as ET
-from conftest import connect
+from conftest import connect, apteryx_set, apteryx_get, apteryx_prune
 import re
+import threading
+import time
 from pytest import mark
 from ncclient.operations import RPCError
 
@@ -35,16 +38,29 @@ def _edit_config_test(conn, payload, expect_err=None, post_xpath=None, inc_str=[
     return xml
 
 
-def test_lock_default_ds_fail():
+def test_lock_default_ds_ok():
+    m = connect()
+
+    # Lock the default (candidate) datastore
+    response = m.lock()
+    assert response.ok is True
+
+    m.close_session()
+
+
+def test_lock_unsupported_ds_fail():
     m = connect()
 
     # Lock target datastore
+    response = None
     try:
-        m.lock()
+        response = m.lock(target="startup")
     except Exception as e:
         assert e.tag == "operation-not-supported"
         assert e.type == "protocol"
 
+    assert response is None
+
     m.close_session()
 
 
@@ -61,9 +77,17 @@ def test_lock_ok():
     m.close_session()
 
 
-@mark.skip(reason="requires candidate datastore")
 def test_lock_candidate():
-    pass
+    m = connect()
+    response = None
+
+    # Lock target datastore
+    response = m.lock(target="candidate")
+    assert response.ok is True
+    match = re.search(OK_REGEX_PATTERN, response.xml)
+    assert match.group() == OK_REGEX_PATTERN
+
+    m.close_session()
 
 
 def test_lock_unlock_ok():
@@ -105,14 +129,46 @@ def test_unlock_fail():
     m.close_session()
 
 
-@mark.skip(reason="requires candidate datastore")
 def test_lock_candidate_unlock_running():
-    pass
+    m = connect()
+
+    response = m.lock(target="candidate")
+    assert response.ok is True
+
+    # Running is not locked
+    response = None
+    try:
+        response = m.unlock(target="running")
+    except Exception as e:
+        assert e.tag == "operation-failed"
+        assert e.type == "protocol"
+
+    assert response is None
+    response = m.unlock(target="candidate")
+    assert response.ok is True
+
+    m.close_session()
 
 
-@mark.skip(reason="requires candidate datastore")
 def test_lock_running_unlock_candidate():
-    pass
+    m = connect()
+
+    response = m.lock(target="running")
+    assert response.ok is True
+
+    # Candidate is not locked
+    response = None
+    try:
+        response = m.unlock(target="candidate")
+    except Exception as e:
+        assert e.tag == "operation-failed"
+        assert e.type == "protocol"
+
+    assert response is None
+    response = m.unlock(target="running")
+    assert response.ok is True
+
+    m.close_session()
 
 
 def test_lock_unlock_twice_ok():
@@ -407,17 +463,12 @@ def test_concurrent_lock_get():
     match = re.search(OK_REGEX_PATTERN, response.xml)
     assert match.group() == OK_REGEX_PATTERN
 
-    # Session 2: Attempt to perform get operation
-    try:
-        m2.get().data
-    except Exception as e:
-        assert e.tag == "in-use"
-        assert e.type == "application"
-        assert e.severity == "error"
-        assert e.message is not None
-        assert e.info is not None
-        xml_error_info = ET.fromstring(e.info.encode('utf-8'))
-        assert m1.session_id == xml_error_info.find('.//{*}session-id').text
+    # Session 2: Perform get operation - reads are not blocked by the lock
+    xml = m2.get().data
+    assert xml.find('./{*}test/{*}settings/{*}debug').text == 'enable'
+    assert xml.find('./{*}test/{*}state/{*}counter').text == '42'
+    xml = m2.get_config(source='running').data
+    assert xml.find('./{*}test/{*}settings/{*}debug').text == 'enable'
 
     # Session 1: Unlock target
     response = m1.unlock(target="running")
@@ -425,7 +476,7 @@ def test_concurrent_lock_get():
     assert match.group() == OK_REGEX_PATTERN
     assert response.ok is True
 
-    # Session 2: Attempt to perform get operation should succeed now
+    # Session 2: Perform get operation after the unlock
     xml = m2.get().data
     assert xml.find('./{*}test/{*}settings/{*}debug').text == 'enable'
     assert xml.find('./{*}test/{*}state/{*}counter').text == '42'
@@ -595,18 +646,9 @@ def test_concurrent_lock_edit_get():
     """
     _edit_config_test(m1, payload1, post_xpath="/test/animals", inc_str=["cat"])
 
-    # Session 2: Attempt to perform get operation should fail
-    try:
-        m2.get().data
-    except Exception as e:
-        assert e.tag == "in-use"
-        assert e.type == "application"
-        assert e.severity == "error"
-        assert e.message is not None
-        assert e.info is not None
-        xml_error_info = ET.fromstring(e.info.encode('utf-8'))
-        assert xml_error_info.find('.//{*}session-id').text is not None
-        assert m1.session_id == xml_error_info.find('.//{*}session-id').text
+    # Session 2: Perform get operation - sees the edit made under the lock
+    xml = m2.get(filter=('xpath', "/test/animals")).data
+    assert xml.find('./{*}test/{*}animals/{*}animal[{*}name="cat"]/{*}type').text == 'a-types:little'
 
     # Session 1: Unlock target
     response = m1.unlock(target="running")
@@ -614,7 +656,7 @@ def test_concurrent_lock_edit_get():
     assert match.group() == OK_REGEX_PATTERN
     assert response.ok is True
 
-    # Session 2: Attempt to peform get operation should succeed now
+    # Session 2: Perform get operation after the unlock
     xml = m2.get().data
     assert xml.find('./{*}test/{*}settings/{*}debug').text == 'enable'
     assert xml.find('./{*}test/{*}state/{*}counter').text == '42'
@@ -658,3 +700,328 @@ def test_concurrent_lock_kill_ok():
 
     # Session 2: close
     m2.close_session()
+
+
+# LOCK WAIT
+
+
+def test_lock_wait_ok():
+    apteryx_set("/netconf/config/lock-wait", "5000")
+    m1 = connect()
+    m2 = connect()
+    try:
+        m1.lock(target="running")
+        result = {}
+
+        def _lock():
+            result["response"] = m2.lock(target="running")
+
+        waiter = threading.Thread(target=_lock)
+        waiter.start()
+        time.sleep(0.5)
+        # Session 2 is queued until session 1 unlocks
+        assert "response" not in result
+        m1.unlock(target="running")
+        waiter.join()
+        assert result["response"].ok is True
+        m2.unlock(target="running")
+        time.sleep(1.1)
+        assert int(apteryx_get("/netconf-state/lock-wait/waits")) > 0
+        assert int(apteryx_get("/netconf-state/lock-wait/queued")) == 0
+    finally:
+        m1.close_session()
+        m2.close_session()
+        apteryx_prune("/netconf/config/lock-wait")
+
+
+def test_lock_wait_timeout_fail():
+    apteryx_set("/netconf/config/lock-wait", "500")
+    m1 = connect()
+    m2 = connect()
+    try:
+        m1.lock(target="running")
+        start = time.time()
+        response = None
+        try:
+            response = m2.lock(target="running")
+        except RPCError as err:
+            assert err.tag == "lock-denied"
+        assert response is None
+        assert time.time() - start >= 0.5
+    finally:
+        m1.close_session()
+        m2.close_session()
+        apteryx_prune("/netconf/config/lock-wait")
+
+
+def test_lock_wait_session_end():
+    apteryx_set("/netconf/config/lock-wait", "5000")
+    m1 = connect()
+    m2 = connect()
+    try:
+        m1.lock(target="running")
+        result = {}
+
+        def _lock():
+            result["response"] = m2.lock(target="running")
+
+        waiter = threading.Thread(target=_lock)
+        waiter.start()
+        time.sleep(0.5)
+        m1.close_session()
+        waiter.join()
+        assert result["response"].ok is True
+    finally:
+        m2.close_session()
+        apteryx_prune("/netconf/config/lock-wait")
+
+
+def test_lock_wait_fifo():
+    apteryx_set("/netconf/config/lock-wait", "5000")
+    m1 = connect()
+    m2 = connect()
+    m3 = connect()
+    try:
+        m1.lock(target="running")
+        order = []
+
+        def _lock(conn, name):
+            conn.lock(target="running")
+            order.append(name)
+
+        waiters = []
+        for conn, name in ((m2, "m2"), (m3, "m3")):
+            waiter = threading.Thread(target=_lock, args=(conn, name))
+            waiter.start()
+            waiters.append(waiter)
+            time.sleep(0.5)
+        assert order == []
+        # Waiters are granted the lock in the order they asked for it
+        m1.unlock(target="running")
+        waiters[0].join()
+        time.sleep(0.5)
+        assert order == ["m2"]
+        m2.unlock(target="running")
+        waiters[1].join()
+        assert order == ["m2", "m3"]
+        m3.unlock(target="running")
+    finally:
+        m1.close_session()
+        m2.close_session()
+        m3.close_session()
+        apteryx_prune("/netconf/config/lock-wait")
+
+
+def test_lock_wait_partial_lock_fail():
+    apteryx_set("/netconf/config/lock-wait", "5000")
+    m1 = connect()
+    m2 = connect()
+    try:
+        m1.lock(target="running")
+        result = {}
+
+        def _lock():
+            try:
+                result["response"] = m2.lock(target="running")
+            except RPCError as err:
+                result["error"] = err
+
+        waiter = threading.Thread(target=_lock)
+        waiter.start()
+        time.sleep(0.5)
+        # A partial lock taken while session 2 waits still denies it
+        _partial_lock(m1, "/test/settings")
+        m1.unlock(target="running")
+        waiter.join()
+        assert "response" not in result
+        assert result["error"].tag == "lock-denied"
+    finally:
+        m1.close_session()
+        m2.close_session()
+        apteryx_prune("/netconf/config/lock-wait")
+
+
+def test_lock_unlock_stress_counts():
+    # Sessions are capped at 10, so this covers 10 concurrent sessions rather than 50
+    apteryx_set("/netconf/config/max-sessions", "10")
+    apteryx_set("/netconf/config/lock-wait", "10000")
+    time.sleep(1.1)
+    before = int(apteryx_get("/netconf-state/statistics/in-rpcs"))
+    sessions = [connect() for i in range(10)]
+    barrier = threading.Barrier(len(sessions))
+    cycles = 5
+    results = [0] * len(sessions)
+
+    def _hammer(index):
+        barrier.wait()
+        for i in range(cycles):
+            sessions[index].lock(target="running")
+            sessions[index].unlock(target="running")
+            results[index] += 2
+
+    try:
+        threads = [threading.Thread(target=_hammer, args=(i,)) for i in range(len(sessions))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert sum(results) == len(sessions) * cycles * 2
+        # Running is free once every session has unlocked
+        assert sessions[0].lock(target="running").ok is True
+        sessions[0].unlock(target="running")
+    finally:
+        for m in sessions:
+            m.close_session()
+        apteryx_prune("/netconf/config/lock-wait")
+        apteryx_prune("/netconf/config/max-sessions")
+    time.sleep(1.1)
+    # Every lock, unlock and close-session is counted exactly
+    assert int(apteryx_get("/netconf-state/statistics/in-rpcs")) - before == sum(results) + 2 + len(sessions)
+
+
+# PARTIAL-LOCK
+
+PL_NS = "urn:ietf:params:xml:ns:netconf:partial-lock:1.0"
+
+SETTINGS_PAYLOAD = """
+<config>
+  <test xmlns="http://test.com/ns/yang/testing">
+    <settings>
+        <priority>5</priority>
+    </settings>
+  </test>
+</config>
+"""
+
+ANIMALS_PAYLOAD = """
+<config>
+  <test xmlns="http://test.com/ns/yang/testing">
+    <animals>
+        <animal>
+            <name>cat</name>
+            <colour>brown</colour>
+        </animal>
+    </animals>
+  </test>
+</config>
+"""
+
+
+def _partial_lock(conn, *selects):
+    rpc = '<partial-lock xmlns="%s">%s</partial-lock>' % (PL_NS, "".join("<select>%s</select>" % s for s in selects))
+    reply = conn.dispatch(to_ele(rpc))
+    print(reply.xml)
+    return reply._root.find('.//{%s}lock-id' % PL_NS).text
+
+
+def _partial_unlock(conn, lock_id):
+    return conn.dispatch(to_ele('<partial-unlock xmlns="%s"><lock-id>%s</lock-id></partial-unlock>' % (PL_NS, lock_id)))
+
+
+def test_partial_lock_unlock_ok():
+    m = connect()
+    lock_id = _partial_lock(m, "/test/settings")
+    assert int(lock_id) > 0
+    response = _partial_unlock(m, lock_id)
+    assert response.ok is True
+    m.close_session()
+
+
+def test_partial_lock_disjoint_edit_ok():
+    m1 = connect()
+    m2 = connect()
+    _partial_lock(m1, "/test/settings")
+    # Session 2 can edit outside the locked scope
+    _edit_config_test(m2, ANIMALS_PAYLOAD, post_xpath="/test/animals/animal[name='cat']", inc_str=["brown"])
+    # But not inside it
+    _edit_config_test(m2, SETTINGS_PAYLOAD, expect_err="in-use")
+    # The lock holder can
+    _edit_config_test(m1, SETTINGS_PAYLOAD, post_xpath="/test/settings/priority", inc_str=["5"])
+    m1.close_session()
+    m2.close_session()
+
+
+def test_partial_lock_list_entry():
+    m1 = connect()
+    m2 = connect()
+    lock_id = _partial_lock(m1, "/t:test/t:animals/t:animal[t:name='cat']")
+    _edit_config_test(m2, ANIMALS_PAYLOAD, expect_err="in-use")
+    _edit_config_test(m2, SETTINGS_PAYLOAD)
+    _partial_unlock(m1, lock_id)
+    _edit_config_test(m2, ANIMALS_PAYLOAD)
+    m1.close_session()
+    m2.close_session()
+
+
+def test_partial_lock_locked_node():
+    m = connect()
+    rpc = '<partial-lock xmlns="%s"><select>/test/animals/animal[name=\'cat\']</select></partial-lock>' % PL_NS
+    reply = m.dispatch(to_ele(rpc))
+    # Locked nodes are reported as instance identifiers
+    nodes = [n.text for n in reply._root.findall('.//{%s}locked-node' % PL_NS)]
+    assert nodes == ["/t:test/t:animals/t:animal[t:name='cat']"]
+    _partial_unlock(m, reply._root.find('.//{%s}lock-id' % PL_NS).text)
+    m.close_session()
+
+
+def test_partial_lock_overlap_fail():
+    m1 = connect()
+    m2 = connect()
+    _partial_lock(m1, "/test/animals")
+    response = None
+    try:
+        response = _partial_lock(m2, "/test/animals/animal[name='cat']")
+    except RPCError as err:
+        assert err.tag == "lock-denied"
+    assert response is None
+    # A global lock is denied too
+    response = None
+    try:
+        response = m2.lock(target="running")
+    except RPCError as err:
+        assert err.tag == "lock-denied"
+    assert response is None
+    # Until session 1 ends
+    m1.close_session()
+    time.sleep(0.5)
+    assert m2.lock(target="running").ok is True
+    m2.close_session()
+
+
+def test_partial_lock_global_lock_fail():
+    m1 = connect()
+    m2 = connect()
+    m1.lock(target="running")
+    response = None
+    try:
+        response = _partial_lock(m2, "/test/settings")
+    except RPCError as err:
+        assert err.tag == "lock-denied"
+    assert response is None
+    m1.close_session()
+    m2.close_session()
+
+
+def test_partial_unlock_other_session_fail():
+    m1 = connect()
+    m2 = connect()
+    lock_id = _partial_lock(m1, "/test/settings")
+    response = None
+    try:
+        response = _partial_unlock(m2, lock_id)
+    except RPCError as err:
+        assert err.tag == "invalid-value"
+    assert response is None
+    m1.close_session()
+    m2.close_session()
+
+
+def test_partial_lock_bad_select_fail():
+    m = connect()
+    response = None
+    try:
+        response = _partial_lock(m, "//animal")
+    except RPCError as err:
+        assert err.tag == "invalid-value"
+    assert response is None
+    m.close_session()
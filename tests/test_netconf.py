@@ -1,6 +1,10 @@
+import os
+import threading
+import time
 from ncclient.operations import RPCError
+from ncclient.xml_ import to_ele
 from lxml import etree
-from conftest import connect
+from conftest import connect, apteryx_set, apteryx_get, apteryx_prune, NETCONF_LOG
 
 # CAPABILITIES
 
@@ -14,12 +18,13 @@ def test_server_capabilities():
     # assert ":startup" in m.server_capabilities
     assert ":xpath" in m.server_capabilities
     assert ":with-defaults" in m.server_capabilities
+    assert ":candidate" in m.server_capabilities
+    assert ":confirmed-commit" in m.server_capabilities
+    assert ":validate" in m.server_capabilities
+    assert ":rollback-on-error" in m.server_capabilities
+    assert ":partial-lock" in m.server_capabilities
 
-    assert ":candidate" not in m.server_capabilities
-    assert ":rollback-on-error" not in m.server_capabilities
     assert ":url" not in m.server_capabilities
-    assert ":confirmed-commit" not in m.server_capabilities
-    assert ":validate" not in m.server_capabilities
     assert ":power-control" not in m.server_capabilities
     assert ":notification" not in m.server_capabilities
     assert ":interleave" not in m.server_capabilities
@@ -72,7 +77,7 @@ def test_rpc_ok():
 def test_rpc_error():
     m = connect()
     try:
-        m.get_config(source='candidate', filter=('xpath', "/test/settings/debug"))
+        m.get_config(source='startup', filter=('xpath', "/test/settings/debug"))
     except RPCError as e:
         reply = e
     xml = reply.xml.getparent()
@@ -99,7 +104,7 @@ def test_get_config_unsupported_datastore():
     m = connect()
     response = None
     try:
-        response = m.get_config(source='candidate', filter=('xpath', "/test/settings/debug"))
+        response = m.get_config(source='startup', filter=('xpath', "/test/settings/debug"))
     except RPCError as err:
         print(err)
         assert err.tag == 'operation-not-supported'
@@ -119,7 +124,180 @@ def test_get_config_no_state():
     # Ignore the rest!
     m.close_session()
 
-# TODO VALIDATE
+
+def test_get_config_filter_no_state():
+    m = connect()
+    xml = m.get_config(source='running', filter=('subtree', '<test/>')).data
+    print(etree.tostring(xml, pretty_print=True, encoding="unicode"))
+    assert xml.find('./{*}test/{*}settings/{*}debug').text == 'enable'
+    assert xml.find('./{*}test/{*}animals/{*}animal/{*}name').text == 'cat'
+    assert xml.find('./{*}test/{*}state') is None
+    xml = m.get_config(source='running', filter=('xpath', "/test/state")).data
+    print(etree.tostring(xml, pretty_print=True, encoding="unicode"))
+    assert len(xml.getchildren()) == 0
+    m.close_session()
+
+
+# GET
+
+
+def _coalescing_stats():
+    time.sleep(1.1)
+    return int(apteryx_get("/netconf/state/coalescing/executed")), int(apteryx_get("/netconf/state/coalescing/coalesced"))
+
+
+def test_get_coalesced_identical():
+    executed, coalesced = _coalescing_stats()
+    sessions = [connect() for i in range(4)]
+    barrier = threading.Barrier(len(sessions))
+    replies = [None] * len(sessions)
+
+    def _get(index):
+        barrier.wait()
+        replies[index] = sessions[index].get()
+
+    threads = [threading.Thread(target=_get, args=(i,)) for i in range(len(sessions))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for m in sessions:
+        m.close_session()
+    # Every request gets its own reply with the shared data
+    for reply in replies:
+        assert reply.data.find('./{*}test/{*}state/{*}counter').text == '42'
+    assert len(set(reply._root.get('message-id') for reply in replies)) == len(sessions)
+    after_executed, after_coalesced = _coalescing_stats()
+    # Whether the gets overlap depends on timing, so only check they were all counted
+    assert (after_executed - executed) + (after_coalesced - coalesced) == len(sessions)
+
+
+def _latency(path):
+    return dict((leaf, int(apteryx_get("%s/%s" % (path, leaf)))) for leaf in ("count", "p50", "p90", "p99", "max"))
+
+
+def test_get_config_latency():
+    m = connect()
+    for i in range(5):
+        m.get_config(source='running', filter=('xpath', "/test/settings/debug"))
+    time.sleep(1.1)
+    latency = _latency("/netconf-state/statistics/latency/get-config")
+    assert latency["count"] >= 5
+    assert latency["p50"] <= latency["p90"] <= latency["p99"] <= latency["max"]
+    latency = _latency("/netconf-state/sessions/session/%s/latency" % m.session_id)
+    assert latency["count"] == 5
+    assert latency["p50"] <= latency["p90"] <= latency["p99"] <= latency["max"]
+    m.close_session()
+
+
+def test_traffic_counters():
+    time.sleep(1.1)
+    stats = "/netconf-state/statistics"
+    in_bytes = int(apteryx_get(stats + "/in-bytes"))
+    out_bytes = int(apteryx_get(stats + "/out-bytes"))
+    get_configs = apteryx_get(stats + "/rpcs/get-config")
+    get_configs = 0 if get_configs == "Not found" else int(get_configs)
+    m = connect()
+    for i in range(3):
+        m.get_config(source='running', filter=('xpath', "/test/settings/debug"))
+    time.sleep(1.1)
+    session = "/netconf-state/sessions/session/%s" % m.session_id
+    assert int(apteryx_get(session + "/in-chunks")) == 3
+    assert int(apteryx_get(session + "/out-chunks")) >= 3
+    assert 0 < int(apteryx_get(session + "/max-request")) <= int(apteryx_get(session + "/in-bytes"))
+    assert 0 < int(apteryx_get(session + "/max-reply")) <= int(apteryx_get(session + "/out-bytes"))
+    m.close_session()
+    time.sleep(1.1)
+    assert int(apteryx_get(stats + "/in-bytes")) > in_bytes
+    assert int(apteryx_get(stats + "/out-bytes")) > out_bytes
+    assert int(apteryx_get(stats + "/rpcs/get-config")) == get_configs + 3
+
+
+def test_rpc_counts_by_name():
+    # An unknown RPC gets an error and the session is closed
+    for i in range(2):
+        m = connect()
+        try:
+            m.dispatch(to_ele('<unknown-rpc xmlns="urn:ietf:params:xml:ns:netconf:base:1.0"/>'))
+        except RPCError:
+            pass
+    time.sleep(1.1)
+    assert int(apteryx_get("/netconf-state/statistics/rpcs/unknown-rpc")) >= 2
+
+
+def test_get_slow_rpc_log():
+    apteryx_set("/netconf/config/slow-rpc", "0")
+    with open(NETCONF_LOG) as log:
+        log.seek(0, os.SEEK_END)
+        m = connect()
+        try:
+            assert apteryx_get("/netconf/state/slow-rpc") == "0"
+            # Every RPC is traced and logged
+            xml = m.get(filter=('xpath', "/test/state/counter")).data
+            assert xml.find('./{*}test/{*}state/{*}counter').text == '42'
+            xml = m.get(filter=('subtree', '<test xmlns="http://test.com/ns/yang/testing"><settings/></test>')).data
+            assert xml.find('./{*}test/{*}settings/{*}debug').text == 'enable'
+        finally:
+            m.close_session()
+            apteryx_prune("/netconf/config/slow-rpc")
+        lines = [line for line in log.read().splitlines() if line.startswith("SLOW-RPC: manager@")]
+    print("\n".join(lines))
+    gets = [line for line in lines if " get " in line]
+    assert len(gets) == 2
+    assert "filter:/test/state/counter" in gets[0]
+    assert "<settings/>" in gets[1]
+    for line in gets:
+        for phase in ["parse:", "query:", "send:", "in:", "out:"]:
+            assert phase in line
+    assert apteryx_get("/netconf/state/slow-rpc") == "1000"
+
+
+# VALIDATE
+
+
+def test_validate_config():
+    config = """
+<config>
+  <test xmlns="http://test.com/ns/yang/testing">
+    <settings>
+        <priority>5</priority>
+    </settings>
+  </test>
+</config>
+"""
+    m = connect()
+    response = m.validate(source=to_ele(config))
+    assert response.ok is True
+    assert apteryx_get("/test/settings/priority") == "1"
+    m.close_session()
+
+
+def test_validate_config_invalid():
+    config = """
+<config>
+  <test xmlns="http://test.com/ns/yang/testing">
+    <state>
+        <counter>7734</counter>
+    </state>
+  </test>
+</config>
+"""
+    m = connect()
+    response = None
+    try:
+        response = m.validate(source=to_ele(config))
+    except RPCError as err:
+        assert err.tag == 'invalid-value'
+    assert response is None
+    m.close_session()
+
+
+def test_validate_datastore():
+    m = connect()
+    assert m.validate(source='running').ok is True
+    assert m.validate(source='candidate').ok is True
+    m.close_session()
+
 # TODO COPY-CONFIG
 # TODO DELETE-CONFIG
 # TODO LOCK/UNLOCK
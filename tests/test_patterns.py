@@ -43,6 +43,22 @@ def test_pattern_debug():
     _pattern_test(payload, tm)
 
 
+def test_pattern_repeated_values():
+    payload = """
+<config xmlns:xc="urn:ietf:params:xml:ns:netconf:base:1.0"
+        xmlns="urn:ietf:params:xml:ns:netconf:base:1.0">
+  <test>
+    <settings>
+      <priority>{pval}</priority>
+    </settings>
+  </test>
+</config>
+"""
+    # Results reused for values seen before must still be correct
+    tm = (("5", True), ("11", False), ("5", True), ("11", False), ("^1$", False), ("^1$", False))
+    _pattern_test(payload, tm)
+
+
 def test_range_priority():
     payload = """
 <config xmlns:xc="urn:ietf:params:xml:ns:netconf:base:1.0"
@@ -134,3 +150,12 @@ def test_patterns_variable_1():
            "jklpasdfgjklpasdfgjklpasdfgjklpasdfgjklpasdfgjkldspasdfgjklpa.cfg", True),
           ("xyzflash:a.cfgabd", False))
     _patterns_variable_test("variable_1", tm)
+
+
+def test_patterns_variable_1_repeated_values():
+    # Results reused for values seen before must still be correct. The pattern
+    # must match the whole value, and ^ and $ in a value are not anchors.
+    tm = (("flash:/a.cfg", True), ("^flash:/a.cfg$", False), ("flash:/a.cfg", True),
+          ("^flash:/a.cfg$", False), ("xflash:/a.cfg", False), ("flash:/a.cfgx", False),
+          ("xflash:/a.cfg", False), ("usb:/a.cfg", True))
+    _patterns_variable_test("variable_1", tm)
@@ -1,4 +1,4 @@
-from conftest import connect
+from conftest import connect, apteryx_set, apteryx_get, apteryx_prune
 from random import randint
 import re
 import time
@@ -226,6 +226,68 @@ def test_multi_kill():
     assert (response.ok is True)
 
 
+def test_many_sessions_state_kill():
+    apteryx_set("/netconf/config/max-sessions", "10")
+    sessions = []
+    try:
+        for i in range(10):
+            sessions.append(connect())
+        time.sleep(1.1)
+        # Every open session is reported
+        for m in sessions:
+            assert apteryx_get("/netconf-state/sessions/session/%s/session-id" % m.session_id) == m.session_id
+        # Any session can be found by ID
+        response = sessions[0].kill_session(sessions[-1].session_id)
+        assert (response.ok is True)
+        time.sleep(1.1)
+        assert (sessions[-1].connected is False)
+        assert apteryx_get("/netconf-state/sessions/session/%s/session-id" % sessions[-1].session_id) == "Not found"
+        assert apteryx_get("/netconf-state/sessions/session/%s/session-id" % sessions[1].session_id) == sessions[1].session_id
+    finally:
+        for m in sessions[:-1]:
+            m.close_session()
+        apteryx_prune("/netconf/config/max-sessions")
+
+
+def test_session_state_refresh():
+    apteryx_set("/netconf/config/state-refresh", "100")
+    m = connect()
+    try:
+        assert apteryx_get("/netconf/state/state-refresh") == "100"
+        path = "/netconf-state/sessions/session/%s" % m.session_id
+        time.sleep(0.2)
+        before = int(apteryx_get(path + "/in-rpcs"))
+        m.get_config(source='running', filter=('xpath', "/test/settings/debug"))
+        time.sleep(0.2)
+        # Only the changed counter is republished, the rest are kept
+        assert int(apteryx_get(path + "/in-rpcs")) == before + 1
+        assert apteryx_get(path + "/transport") == "netconf-ssh"
+        assert apteryx_get(path + "/status") == "active"
+    finally:
+        m.close_session()
+        apteryx_prune("/netconf/config/state-refresh")
+    assert apteryx_get("/netconf/state/state-refresh") == "1000"
+    time.sleep(1.1)
+    assert apteryx_get(path + "/session-id") == "Not found"
+
+
+def test_session_setup_latency():
+    time.sleep(1.1)
+    path = "/netconf-state/statistics/latency/session-setup/count"
+    before = apteryx_get(path)
+    before = 0 if before == "Not found" else int(before)
+    sessions = [connect() for i in range(2)]
+    time.sleep(1.1)
+    assert int(apteryx_get(path)) == before + 2
+    assert int(apteryx_get("/netconf-state/statistics/latency/hello/count")) >= 2
+    # Both sessions are for the same user, the second from the cache
+    username = apteryx_get("/netconf-state/sessions/session/%s/username" % sessions[0].session_id)
+    assert username != "Not found"
+    assert apteryx_get("/netconf-state/sessions/session/%s/username" % sessions[1].session_id) == username
+    for m in sessions:
+        m.close_session()
+
+
 def test_max_session():
     """
     max-sessions defaults to 4. verify that we can make 4 connections, but